@@ -0,0 +1,160 @@
+# script/benchmark_chunking.py
+#
+# Measures diff chunking time for gpt_review.py on a synthetic diff.
+# Compares the original per-line tokenizer path (encoding resolved and
+# one encode call per diff line) with the cached, batched tokenizer.
+#
+# Usage: python script/benchmark_chunking.py [--lines 50000] [--repeat 3]
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import gpt_review  # noqa: E402
+
+
+# Diff shapes: (hunks per file, lines per hunk) ranges
+DIFF_SHAPES = {
+    "mixed": ((1, 6), (5, 80)),
+    "many-small": ((1, 2), (3, 12)),
+    "few-large": ((4, 10), (150, 400)),
+}
+
+
+def generate_synthetic_diff(total_lines: int, seed: int = 1234, shape: str = "mixed") -> str:
+    """
+    Builds a unified diff of roughly total_lines lines, spread across
+    TypeScript, SCSS and JSON files with hunks sized according to shape.
+    """
+    hunks_per_file, hunk_lines = DIFF_SHAPES[shape]
+    rng = random.Random(seed)
+    templates = [
+        "  const {name} = this.{service}.get{entity}ById({arg});",
+        "  this.{name}.set({arg} * {n});",
+        "  if (!{name}) {{ return of([]); }}",
+        "  .{name} {{ margin: {n}px; color: var(--{service}); }}",
+        '  "{name}": {{ "id": {n}, "price": {arg}.{n} }},',
+        "  // TODO: move {name} into {service}",
+    ]
+    words = ["product", "invoice", "customer", "total", "auth", "router", "signal", "form"]
+    extensions = [".ts", ".html", ".scss", ".json"]
+
+    out = []
+    file_index = 0
+    while len(out) < total_lines:
+        path = f"src/app/features/{rng.choice(words)}/{rng.choice(words)}-{file_index}{rng.choice(extensions)}"
+        out.append(f"diff --git a/{path} b/{path}\n")
+        out.append(f"index {rng.getrandbits(28):07x}..{rng.getrandbits(28):07x} 100644\n")
+        out.append(f"--- a/{path}\n")
+        out.append(f"+++ b/{path}\n")
+        for _ in range(rng.randint(*hunks_per_file)):
+            hunk_len = rng.randint(*hunk_lines)
+            start = rng.randint(1, 500)
+            out.append(f"@@ -{start},{hunk_len} +{start},{hunk_len} @@\n")
+            for _ in range(hunk_len):
+                line = rng.choice(templates).format(
+                    name=rng.choice(words),
+                    service=rng.choice(words),
+                    entity=rng.choice(words).capitalize(),
+                    arg=rng.choice(words),
+                    n=rng.randint(0, 999),
+                )
+                out.append(rng.choice(["+", "-", " "]) + line + "\n")
+        file_index += 1
+
+    return "".join(out[:total_lines])
+
+
+def legacy_get_token_count(text: str, model_name: str) -> int:
+    """Original per-call token count: resolves the encoding on every call."""
+    if gpt_review.get_encoding(model_name) is None:
+        # tiktoken missing or encoding files unreachable: same fallback as gpt_review
+        return max(1, len(text) // 4)
+
+    try:
+        try:
+            encoding = gpt_review.tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            encoding = gpt_review.tiktoken.get_encoding("o200k_base")
+
+        return len(encoding.encode(text))
+    except Exception:
+        return max(1, len(text) // 4)
+
+
+def legacy_create_chunks(diff_content: str, max_tokens_per_chunk: int, model_name: str):
+    """Original greedy chunker calling legacy_get_token_count once per line."""
+    safe_max = max(1, max_tokens_per_chunk - gpt_review.CHUNK_OVERHEAD_TOKENS)
+
+    chunks = []
+    current_chunk_lines = []
+    current_token_count = 0
+
+    for line in diff_content.splitlines(keepends=True):
+        line_token_count = legacy_get_token_count(line, model_name)
+
+        if current_token_count + line_token_count > safe_max and current_chunk_lines:
+            chunks.append("".join(current_chunk_lines))
+            current_chunk_lines = [line]
+            current_token_count = line_token_count
+        else:
+            current_chunk_lines.append(line)
+            current_token_count += line_token_count
+
+    if current_chunk_lines:
+        chunks.append("".join(current_chunk_lines))
+
+    return chunks
+
+
+def time_best_of(func, repeat: int):
+    """Returns (best wall seconds, last result) over repeat runs."""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gpt_review.py diff chunking.")
+    parser.add_argument("--lines", type=int, default=50000, help="Synthetic diff size in lines.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per variant; best time is reported.")
+    parser.add_argument("--model", default=gpt_review.OPENAI_MODEL, help="Model name used for tokenization.")
+    parser.add_argument(
+        "--max-chunk-tokens",
+        type=int,
+        default=gpt_review.MAX_CHUNK_INPUT_TOKENS,
+        help="Chunk budget passed to the chunker.",
+    )
+    args = parser.parse_args()
+
+    diff_content = generate_synthetic_diff(args.lines)
+    print(
+        f"Synthetic diff: {args.lines} lines, {len(diff_content) / 1024:.0f} KiB "
+        f"(model: {args.model}, tiktoken encoding loaded: {gpt_review.get_encoding(args.model) is not None})"
+    )
+
+    # Warm up encoder loading so neither variant pays the one-off file load
+    gpt_review.get_token_count("warm up", args.model)
+
+    legacy_time, legacy_chunks = time_best_of(
+        lambda: legacy_create_chunks(diff_content, args.max_chunk_tokens, args.model), args.repeat
+    )
+    batched_time, batched_chunks = time_best_of(
+        lambda: gpt_review.create_chunks(diff_content, args.max_chunk_tokens, args.model), args.repeat
+    )
+
+    print(f"Legacy per-line tokenizer : {legacy_time:8.3f}s  ({len(legacy_chunks)} chunks)")
+    print(f"Cached batched tokenizer  : {batched_time:8.3f}s  ({len(batched_chunks)} chunks)")
+    if batched_time > 0:
+        print(f"Speed-up                  : {legacy_time / batched_time:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
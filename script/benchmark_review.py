@@ -0,0 +1,218 @@
+# script/benchmark_review.py
+#
+# End-to-end throughput benchmark for gpt_review.py that spends no real
+# tokens: each scenario starts the local mock OpenAI server with injected
+# latency / 429s / 5xx errors, generates a synthetic diff, runs the review
+# script against it and reads back its run metrics.
+#
+# Reports wall time, chunks per minute, token utilisation against TPM_LIMIT
+# and coverage under MAX_SCRIPT_DURATION_SECONDS, so scheduling and chunking
+# changes can be compared run to run (e.g. in CI with --json).
+#
+# The two-tier scenario runs the slow scenario again with a fast triage model
+# (REVIEW_TRIAGE_MODEL) in front; with both selected, the wall time and
+# full-review tokens the routing saved are measured side by side. Use
+# --diff-file with a real PR diff (e.g. `git diff main...feature`) to see
+# what it saves on your own changes; the mock decides which chunks escalate.
+#
+# Usage:
+#   python script/benchmark_review.py [--lines 20000] [--shape mixed] [--diff-file pr.diff]
+#       [--scenario baseline --scenario rate-limited] [--json results.json]
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+
+from benchmark_chunking import DIFF_SHAPES, generate_synthetic_diff  # noqa: E402
+from mock_openai_server import start_mock_server  # noqa: E402
+
+# Mock server behaviour per scenario (see MockOpenAIServer)
+SCENARIOS = {
+    "baseline": {"latency": 0.5},
+    "slow": {"latency": 3.0},
+    "rate-limited": {"latency": 0.5, "rate_limit_rate": 0.2, "retry_after": 2.0},
+    "flaky": {"latency": 0.5, "server_error_rate": 0.15},
+    # Live quota below the configured TPM_LIMIT; pacing has to follow the x-ratelimit-* headers
+    "quota": {"latency": 0.5, "tpm_limit": 40000},
+    # "slow" behind a fast triage model that escalates 30% of chunks
+    "two-tier": {"latency": 3.0, "model_latency": {"mock-triage": 0.3}, "triage_flag_rate": 0.3},
+}
+# Extra review script environment per scenario
+SCENARIO_ENV = {
+    "two-tier": {"REVIEW_TRIAGE_MODEL": "mock-triage"},
+}
+
+
+def run_scenario(name: str, diff_path: str, work_dir: str, args) -> dict:
+    """Runs gpt_review.py once against a fresh mock server and returns its measurements."""
+    server = start_mock_server(seed=args.seed, **SCENARIOS[name])
+    output_file = os.path.join(work_dir, f"review-{name}.txt")
+    metrics_file = os.path.join(work_dir, f"metrics-{name}.json")
+    env = dict(
+        os.environ,
+        OPENAI_BASE_URL=server.base_url,
+        OPENAI_API_KEY="benchmark",
+        DIFF_FILE=diff_path,
+        TPM_LIMIT=str(args.tpm_limit),
+        MAX_SCRIPT_DURATION_SECONDS=str(args.max_seconds),
+        REVIEW_OUTPUT_FILE=output_file,
+        REVIEW_METRICS_FILE=metrics_file,
+        REVIEW_CACHE_DIR="",
+        # Start the scheduler's latency prior near the mock latency; the
+        # production default assumes real model response times
+        ESTIMATED_CALL_SECONDS=str(max(1, math.ceil(SCENARIOS[name]["latency"]))),
+        REVIEW_TRIAGE_MODEL="",
+    )
+    env.update(SCENARIO_ENV.get(name, {}))
+
+    start = time.monotonic()
+    try:
+        completed = subprocess.run(
+            [sys.executable, os.path.join(SCRIPT_DIR, "gpt_review.py")],
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+    finally:
+        wall = time.monotonic() - start
+        server.shutdown()
+        server.server_close()
+
+    try:
+        with open(metrics_file, encoding="utf-8") as f:
+            metrics = json.load(f)
+    except (OSError, ValueError):
+        metrics = {}
+
+    if completed.returncode != 0 or not metrics:
+        print(f"⚠️ Scenario {name} exited with {completed.returncode}:", file=sys.stderr)
+        print(completed.stderr[-2000:], file=sys.stderr)
+
+    counters = metrics.get("counters", {})
+    api = metrics.get("api", {})
+    total_chunks = counters.get("chunks_total", 0)
+    reviewed = counters.get("chunks_reviewed", 0)
+    tokens_used = api.get("prompt_tokens", 0) + api.get("completion_tokens", 0)
+    routing = metrics.get("routing")
+    triage_model = routing["triage_model"] if routing else None
+    tokens_by_model = {
+        model: totals["prompt_tokens"] + totals["completion_tokens"]
+        for model, totals in api.get("by_model", {}).items()
+    }
+    full_review_tokens = tokens_used - tokens_by_model.get(triage_model, 0)
+    minutes = wall / 60
+
+    return {
+        "scenario": name,
+        "exit_code": completed.returncode,
+        "wall_seconds": round(wall, 2),
+        "chunks_total": total_chunks,
+        "chunks_reviewed": reviewed,
+        "chunks_per_minute": round(reviewed / minutes, 2) if minutes else 0.0,
+        "coverage": round(reviewed / total_chunks, 3) if total_chunks else 0.0,
+        "tokens_used": tokens_used,
+        "full_review_tokens": full_review_tokens,
+        "tokens_by_model": tokens_by_model,
+        # Tokens per minute of wall time relative to TPM_LIMIT (triage has its own
+        # budget); runs shorter than a minute can exceed 1.0 because the limiter's
+        # bucket starts full
+        "tpm_utilisation": round(full_review_tokens / (args.tpm_limit * minutes), 3) if minutes else 0.0,
+        "api_calls": api.get("calls", 0),
+        "retries": counters.get("retries", 0),
+        "rate_limit_wait_seconds": metrics.get("phase_seconds", {}).get("rate_limit_wait", 0.0),
+        "chunking_seconds": metrics.get("phase_seconds", {}).get("chunking", 0.0),
+        "routing": routing,
+        "server": dict(server.stats),
+    }
+
+
+def print_table(results):
+    header = f"{'scenario':<14}{'wall s':>8}{'chunks':>9}{'chunks/min':>12}{'coverage':>10}{'TPM use':>9}{'retries':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['scenario']:<14}{r['wall_seconds']:>8.1f}"
+            f"{r['chunks_reviewed']:>4}/{r['chunks_total']:<4}"
+            f"{r['chunks_per_minute']:>12.1f}{r['coverage']:>10.0%}"
+            f"{r['tpm_utilisation']:>9.0%}{r['retries']:>9}"
+        )
+
+
+def print_routing(results):
+    """Estimated and, next to the slow scenario, measured savings of two-tier runs."""
+    by_name = {r["scenario"]: r for r in results}
+    for r in results:
+        routing = r["routing"]
+        if not routing:
+            continue
+        print(
+            f"{r['scenario']}: triage cleared {routing['chunks_cleared']}/{routing['chunks_triaged']} chunks "
+            f"for {routing['triage_tokens']} triage tokens; estimated saving "
+            f"{routing['full_review_tokens_avoided_estimate']} full-review tokens, "
+            f"{routing['wall_seconds_saved_estimate']:.1f}s"
+        )
+        single = by_name.get("slow")
+        if single is not None and single["coverage"] == r["coverage"] == 1.0:
+            print(
+                f"  measured against slow: wall {single['wall_seconds']:.1f}s -> {r['wall_seconds']:.1f}s, "
+                f"full-review tokens {single['full_review_tokens']} -> {r['full_review_tokens']}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of gpt_review.py.")
+    parser.add_argument("--lines", type=int, default=20000, help="Synthetic diff size in lines.")
+    parser.add_argument("--shape", choices=sorted(DIFF_SHAPES), default="mixed", help="Hunk size profile of the diff.")
+    parser.add_argument("--diff-file", help="Benchmark this diff (e.g. a real PR) instead of a synthetic one.")
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help="Scenario to run (repeatable). Defaults to all.",
+    )
+    parser.add_argument("--tpm-limit", type=int, default=200000, help="TPM_LIMIT passed to the review script.")
+    parser.add_argument("--max-seconds", type=int, default=120, help="MAX_SCRIPT_DURATION_SECONDS for each run.")
+    parser.add_argument("--seed", type=int, default=1234, help="Seed for the diff and failure injection.")
+    parser.add_argument("--json", dest="json_path", help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    scenarios = args.scenario or list(SCENARIOS)
+
+    with tempfile.TemporaryDirectory(prefix="gpt-review-bench-") as work_dir:
+        if args.diff_file:
+            diff_path = os.path.abspath(args.diff_file)
+            description = f"Diff: {args.diff_file}"
+        else:
+            diff_path = os.path.join(work_dir, "synthetic.diff")
+            with open(diff_path, "w", encoding="utf-8") as f:
+                f.write(generate_synthetic_diff(args.lines, seed=args.seed, shape=args.shape))
+            description = f"Synthetic diff: {args.lines} lines ({args.shape})"
+        print(f"{description}, TPM_LIMIT={args.tpm_limit}, MAX_SCRIPT_DURATION_SECONDS={args.max_seconds}")
+
+        results = []
+        for name in scenarios:
+            print(f"Running scenario {name}...")
+            results.append(run_scenario(name, diff_path, work_dir, args))
+
+    print()
+    print_table(results)
+    print_routing(results)
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"diff_file": args.diff_file, "lines": args.lines, "shape": args.shape, "results": results}, f, indent=2
+            )
+        print(f"Results written to {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# script/benchmark_startup.py
+#
+# Measures what gpt_review.py costs on runs that have nothing to review:
+# wall time and peak RSS of a fresh interpreter for each skip path (no API
+# key, empty diff, every file filtered out), next to importing the module
+# alone and importing it together with openai and tiktoken (the cost every
+# run paid before those were loaded lazily). No network access is needed.
+#
+# Usage: python script/benchmark_startup.py [--repeat 5] [--json results.json]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+GPT_REVIEW = os.path.join(SCRIPT_DIR, "gpt_review.py")
+
+# A lockfile-only change, which the default REVIEW_EXCLUDE_GLOBS filter out
+FILTERED_DIFF = """diff --git a/package-lock.json b/package-lock.json
+index 1111111..2222222 100644
+--- a/package-lock.json
++++ b/package-lock.json
+@@ -1,3 +1,3 @@
+ {
+-  "version": "1.0.0",
++  "version": "1.0.1",
+ }
+"""
+
+
+def scenarios(work_dir: str) -> dict:
+    """Scenario name -> (command, extra environment)."""
+    empty_diff = os.path.join(work_dir, "empty.diff")
+    filtered_diff = os.path.join(work_dir, "filtered.diff")
+    with open(empty_diff, "w", encoding="utf-8"):
+        pass
+    with open(filtered_diff, "w", encoding="utf-8") as f:
+        f.write(FILTERED_DIFF)
+
+    review = [sys.executable, GPT_REVIEW]
+    return {
+        "import-only": ([sys.executable, "-c", "import gpt_review"], {}),
+        "import-eager": ([sys.executable, "-c", "import gpt_review, openai, tiktoken, httpx"], {}),
+        "no-api-key": (review, {"OPENAI_API_KEY": "", "DIFF_FILE": empty_diff}),
+        "empty-diff": (review, {"DIFF_FILE": empty_diff}),
+        "filtered-diff": (review, {"DIFF_FILE": filtered_diff}),
+    }
+
+
+def measure(command, env) -> tuple:
+    """Runs command once; returns (wall seconds, peak RSS in MB, exit code)."""
+    start = time.monotonic()
+    process = subprocess.Popen(command, env=env, cwd=SCRIPT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # wait4 reports the resource usage of this child alone
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.monotonic() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    rss_bytes = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return wall, rss_bytes / (1024 * 1024), process.returncode
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time and peak RSS of gpt_review.py skip paths.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per scenario; the median wall time is reported.")
+    parser.add_argument("--json", dest="json_path", help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="gpt-review-startup-") as work_dir:
+        base_env = dict(
+            os.environ,
+            OPENAI_API_KEY="benchmark",
+            REVIEW_OUTPUT_FILE=os.path.join(work_dir, "review.txt"),
+            REVIEW_METRICS_FILE=os.path.join(work_dir, "metrics.json"),
+            # An unroutable API; no skip path should get as far as calling it
+            OPENAI_BASE_URL="http://127.0.0.1:9/v1",
+        )
+        for name, (command, extra_env) in scenarios(work_dir).items():
+            env = dict(base_env, **extra_env)
+            runs = [measure(command, env) for _ in range(max(1, args.repeat))]
+            results.append({
+                "scenario": name,
+                "wall_seconds": round(statistics.median(run[0] for run in runs), 3),
+                "peak_rss_mb": round(max(run[1] for run in runs), 1),
+                "exit_code": runs[-1][2],
+            })
+
+    header = f"{'scenario':<15}{'wall s':>9}{'peak RSS MB':>13}{'exit':>6}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['scenario']:<15}{r['wall_seconds']:>9.3f}{r['peak_rss_mb']:>13.1f}{r['exit_code']:>6}")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"repeat": args.repeat, "results": results}, f, indent=2)
+        print(f"Results written to {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,144 +1,329 @@
 # script/debug_openai_connection.py
-import openai
+#
+# Connectivity diagnostics for the OpenAI API. Three probes run concurrently
+# under one global deadline, each reporting DNS, TCP connect, TLS handshake
+# and first-byte timings:
+#   - stdlib: raw socket + ssl, the same stack urllib uses
+#   - httpx:  the pooled client gpt_review.py uses (see http_client.py)
+#   - openai: the OpenAI library listing models with OPENAI_API_KEY
+#
+# Usage: python script/debug_openai_connection.py [--deadline 10] [--env]
+# gpt_review.py imports preflight_check() to skip runs that cannot succeed.
+import argparse
+import concurrent.futures
+import dataclasses
+import json
 import os
+import socket
+import ssl
 import sys
-import traceback # For detailed exception info
-import urllib.request # For basic HTTPS test
-import ssl # For SSL context info
-import httpx # For direct httpx test
-import json # For printing environment variables
-
-print("--- Environment Variables Visible to Python ---")
-# Print all environment variables, be cautious if any are sensitive beyond the API key
-# This is for debugging the 'Illegal header value' error.
-try:
-    # Redact the API key if it's in the environment for this printout
-    env_vars_copy = os.environ.copy()
-    if 'OPENAI_API_KEY' in env_vars_copy:
-        key = env_vars_copy['OPENAI_API_KEY']
-        # Also show if key has whitespace issues *before* stripping for debug print
-        print(f"DEBUG: Raw OPENAI_API_KEY from env (repr): {repr(key)}")
-        env_vars_copy['OPENAI_API_KEY'] = f"{key.strip()[:5]}...{key.strip()[-4:]}" if len(key.strip()) > 8 else "***"
-
-    # Sort for consistent output
-    sorted_env_vars = dict(sorted(env_vars_copy.items()))
-    print(json.dumps(sorted_env_vars, indent=2))
-except Exception as e:
-    print(f"Could not print all environment variables: {e}")
-print("--- End of Environment Variables ---\n")
-
-
-print(f"Python version: {sys.version}")
-print(f"OpenAI library version: {openai.__version__}")
-print(f"HTTPX library version: {httpx.__version__}")
-print(f"SSL version: {ssl.OPENSSL_VERSION}")
-print(f"Default SSL CA cert file: {ssl.get_default_verify_paths().cafile}")
-
-# --- Basic HTTPS Test with urllib ---
-print("\n--- Attempting basic HTTPS connection with urllib ---")
-urllib_test_successful = False
-try:
-    context = ssl.create_default_context()
-    req = urllib.request.Request("https://api.openai.com/v1/models", headers={'User-Agent': 'Python-urllib-debug'})
-    with urllib.request.urlopen(req, context=context, timeout=10) as response:
-        print(f"urllib: Successfully connected. Status: {response.status}")
-        if response.status == 401: # Expected for this unauthenticated request
-            print("urllib: Received 401 Unauthorized, which means connection to api.openai.com was successful.")
-            urllib_test_successful = True
-        else:
-            print(f"urllib: Received unexpected status {response.status}")
-except urllib.error.HTTPError as e:
-    print(f"urllib: HTTPError. Status: {e.code}, Reason: {e.reason}")
-    if e.code == 401:
-        print("urllib: Received 401 Unauthorized, which means connection to api.openai.com was successful.")
-        urllib_test_successful = True
-    else:
-        print(f"urllib: Received unexpected HTTPError: {e}")
-except urllib.error.URLError as e:
-    print(f"urllib: URLError (often connection related). Reason: {e.reason}")
-except Exception as e:
-    print(f"urllib: An unexpected error occurred: {str(e)}")
-print(f"--- End of urllib HTTPS connection test (Success: {urllib_test_successful}) ---\n")
-
-
-# --- Direct HTTPretty Test ---
-print("--- Attempting direct HTTPS connection with httpx ---")
-httpx_test_successful = False
-try:
-    # No API key needed for this specific endpoint, we expect 401 if connection is fine
-    with httpx.Client() as client:
-        response = client.get("https://api.openai.com/v1/models", headers={'User-Agent': 'Python-httpx-debug'}, timeout=10)
-        print(f"httpx: Successfully connected. Status: {response.status_code}")
-        if response.status_code == 401:
-            print("httpx: Received 401 Unauthorized, which means connection to api.openai.com was successful.")
-            httpx_test_successful = True
+import time
+from urllib.parse import urlsplit
+
+import httpx
+import openai
+
+from http_client import ConnectionStats, build_http_client  # Same pooled transport as gpt_review.py
+
+# --- Configuration ---
+DEFAULT_BASE_URL = "https://api.openai.com/v1"
+DIAGNOSTICS_DEADLINE_SECONDS = float(os.getenv("DIAGNOSTICS_DEADLINE_SECONDS", "10"))
+
+# Env var names containing these are redacted by --env
+SECRET_NAME_PARTS = ("KEY", "TOKEN", "SECRET", "PASSWORD")
+
+
+@dataclasses.dataclass
+class ProbeResult:
+    name: str
+    # True when the API answered at all (any HTTP status counts as reachable)
+    reachable: bool = False
+    status: int = None
+    # Phase timings in seconds; None when the phase did not happen (e.g. a reused connection)
+    dns: float = None
+    tcp_connect: float = None
+    tls_handshake: float = None
+    first_byte: float = None
+    total: float = None
+    error: str = None
+    # Set by the openai probe when the key itself was rejected (401 invalid_api_key)
+    auth_failed: bool = False
+
+
+class PhaseTimer:
+    """httpcore trace callback recording connect, TLS and first-byte durations for one probe."""
+
+    STEPS = {
+        "connection.connect_tcp": "tcp_connect",
+        "connection.start_tls": "tls_handshake",
+    }
+
+    def __init__(self, result: ProbeResult):
+        self.result = result
+        self._started = {}
+        self._request_sent_at = None
+
+    def __call__(self, event_name, info):
+        step, _, phase = event_name.rpartition(".")
+        now = time.monotonic()
+        if phase == "started":
+            self._started[step] = now
+            if step.endswith(".send_request_headers"):
+                self._request_sent_at = now
+            return
+        if phase != "complete" or step not in self._started:
+            return
+
+        if step in self.STEPS:
+            setattr(self.result, self.STEPS[step], now - self._started[step])
+        elif step.endswith(".receive_response_headers") and self._request_sent_at is not None:
+            # Request written to response headers read: server time plus one round trip
+            self.result.first_byte = now - self._request_sent_at
+
+    def install(self, client: httpx.Client):
+        """Adds this timer to every request of client, after any trace already set."""
+
+        def on_request(request):
+            previous = request.extensions.get("trace")
+
+            def trace(event_name, info):
+                if previous is not None:
+                    previous(event_name, info)
+                self(event_name, info)
+
+            request.extensions["trace"] = trace
+
+        client.event_hooks["request"].append(on_request)
+
+
+def _resolve(host: str, port: int, result: ProbeResult):
+    start = time.monotonic()
+    addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    result.dns = time.monotonic() - start
+    return addresses
+
+
+def _url_parts(base_url: str):
+    parts = urlsplit(base_url)
+    secure = parts.scheme == "https"
+    return parts, parts.hostname, parts.port or (443 if secure else 80), secure
+
+
+def probe_stdlib(base_url: str, deadline: float) -> ProbeResult:
+    """GET {base_url}/models over a raw socket, timing each phase by hand."""
+    result = ProbeResult("stdlib")
+    start = time.monotonic()
+    parts, host, port, secure = _url_parts(base_url)
+    sock = None
+    try:
+        addresses = _resolve(host, port, result)
+
+        phase_start = time.monotonic()
+        sock = socket.create_connection(addresses[0][4][:2], timeout=max(0.1, deadline - time.monotonic()))
+        result.tcp_connect = time.monotonic() - phase_start
+
+        if secure:
+            phase_start = time.monotonic()
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=host)
+            result.tls_handshake = time.monotonic() - phase_start
+
+        request = (
+            f"GET {parts.path.rstrip('/')}/models HTTP/1.1\r\n"
+            f"Host: {host}\r\nUser-Agent: Python-stdlib-debug\r\nConnection: close\r\n\r\n"
+        )
+        phase_start = time.monotonic()
+        sock.sendall(request.encode("ascii"))
+        status_line = sock.recv(1024)
+        result.first_byte = time.monotonic() - phase_start
+
+        result.status = int(status_line.split(b" ", 2)[1])
+        result.reachable = True
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    finally:
+        if sock is not None:
+            sock.close()
+        result.total = time.monotonic() - start
+    return result
+
+
+def probe_httpx(base_url: str, deadline: float, stats: ConnectionStats = None) -> ProbeResult:
+    """GET {base_url}/models through the pooled httpx client gpt_review.py uses."""
+    result = ProbeResult("httpx")
+    start = time.monotonic()
+    _, host, port, _ = _url_parts(base_url)
+    try:
+        _resolve(host, port, result)
+        with build_http_client(1, stats) as client:
+            PhaseTimer(result).install(client)
+            response = client.get(
+                f"{base_url.rstrip('/')}/models",
+                headers={"User-Agent": "Python-httpx-debug"},
+                timeout=max(0.1, deadline - time.monotonic()),
+            )
+        result.status = response.status_code
+        result.reachable = True
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    finally:
+        result.total = time.monotonic() - start
+    return result
+
+
+def probe_openai(base_url: str, api_key: str, deadline: float, stats: ConnectionStats = None) -> ProbeResult:
+    """Lists models with the OpenAI library, which also checks the API key."""
+    result = ProbeResult("openai")
+    start = time.monotonic()
+    _, host, port, _ = _url_parts(base_url)
+    if not api_key:
+        result.error = "skipped: OPENAI_API_KEY not set"
+        return result
+
+    try:
+        _resolve(host, port, result)
+        with build_http_client(1, stats) as http_client:
+            PhaseTimer(result).install(http_client)
+            client = openai.OpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=http_client,
+                max_retries=0,
+                timeout=max(0.1, deadline - time.monotonic()),
+            )
+            client.models.list()
+        result.status = 200
+        result.reachable = True
+    except openai.APIStatusError as e:
+        # The API answered; only a rejected key makes the review doomed. Other
+        # 401/403s (e.g. a restricted key without the model-read scope) say
+        # nothing about chat completions.
+        result.status = e.status_code
+        result.reachable = True
+        result.auth_failed = e.status_code == 401 and getattr(e, "code", None) == "invalid_api_key"
+        result.error = f"{type(e).__name__}: {e.message}"
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    finally:
+        result.total = time.monotonic() - start
+    return result
+
+
+def run_diagnostics(api_key: str = None, base_url: str = None, deadline_seconds: float = None,
+                    probes=("stdlib", "httpx", "openai"), stats: ConnectionStats = None) -> list:
+    """
+    Runs the selected probes concurrently and returns their results in probe
+    order. Probes still running at the deadline are reported as timed out.
+    """
+    base_url = base_url or os.getenv("OPENAI_BASE_URL") or DEFAULT_BASE_URL
+    deadline_seconds = DIAGNOSTICS_DEADLINE_SECONDS if deadline_seconds is None else deadline_seconds
+    deadline = time.monotonic() + deadline_seconds
+
+    probe_calls = {
+        "stdlib": lambda: probe_stdlib(base_url, deadline),
+        "httpx": lambda: probe_httpx(base_url, deadline, stats),
+        "openai": lambda: probe_openai(base_url, api_key, deadline, stats),
+    }
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(probes), thread_name_prefix="probe")
+    futures = {name: executor.submit(probe_calls[name]) for name in probes}
+    concurrent.futures.wait(futures.values(), timeout=deadline_seconds)
+    # Don't wait for stragglers; their own timeouts end them shortly after the deadline
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    results = []
+    for name, future in futures.items():
+        if future.done() and not future.cancelled():
+            results.append(future.result())
         else:
-            print(f"httpx: Received unexpected status {response.status_code}. Response: {response.text[:200]}")
-except httpx.RequestError as e:
-    print(f"httpx: RequestError (problem during request): {e}")
-    print("httpx Traceback:")
-    traceback.print_exc()
-except Exception as e:
-    print(f"httpx: An unexpected error occurred: {e}")
-    print("httpx Traceback:")
-    traceback.print_exc()
-print(f"--- End of httpx direct connection test (Success: {httpx_test_successful}) ---\n")
-
-
-# --- OpenAI Library Test ---
-print("--- Attempting connection with OpenAI library ---")
-api_key_from_env = os.getenv('OPENAI_API_KEY')
-
-if not api_key_from_env:
-    print("Error: OPENAI_API_KEY was not found in the environment for the Python script.")
-    sys.exit(1)
-
-# ** FIX: Strip whitespace (like newlines) from the key **
-api_key_to_use = api_key_from_env.strip()
-
-if not api_key_to_use: # Check if key is empty after stripping
-    print("Error: OPENAI_API_KEY is empty after stripping whitespace.")
-    sys.exit(1)
-
-print(f"OpenAI lib is using API Key: {api_key_to_use[:5]}...{api_key_to_use[-4:]}") # Print stripped key info
-
-try:
-    # Use the stripped key
-    client = openai.OpenAI(api_key=api_key_to_use)
-    print("✅ OpenAI client initialized successfully.")
-    models = client.models.list() # This is the line that makes the network call
-    print("✅ Successfully listed models from OpenAI.")
-    if models.data:
-        print("Available Models (sample):", [m.id for m in models.data[:5]])
-    else:
-        print("No models data returned, but connection was successful.")
-    print("Debug script (OpenAI part) completed successfully.")
-
-except openai.AuthenticationError as e:
-    print(f"❌ OpenAI Authentication Error: {e}")
-    print("Please check if the OPENAI_API_KEY is correct and has permissions.")
-    sys.exit(1)
-except openai.APIConnectionError as e:
-    print(f"❌ OpenAI APIConnectionError: {e}") # This is what we were seeing
-    print("This indicates a problem connecting to OpenAI's API servers with the OpenAI library.")
-    print("Traceback:")
-    traceback.print_exc() # Print full traceback for connection errors
-    sys.exit(1)
-except openai.APIError as e: # Catch other specific OpenAI API errors
-    print(f"❌ OpenAI APIError: {e}")
-    sys.exit(1)
-except Exception as e:
-    print(f"❌ An unexpected error occurred during OpenAI library test: {e}")
-    print("Traceback:")
-    traceback.print_exc()
-    sys.exit(1)
-
-# Final check: if urllib and httpx direct tests passed, but openai lib failed, it's very specific.
-if urllib_test_successful and httpx_test_successful:
-    print("\nINFO: Both urllib and direct httpx tests succeeded, but the OpenAI library call might have still failed.")
-    print("This suggests the issue is highly specific to how the OpenAI library constructs its requests or interacts with httpx.")
-elif urllib_test_successful and not httpx_test_successful:
-    print("\nINFO: urllib test succeeded, but direct httpx test FAILED.")
-    print("This points to an issue specifically with httpx or its environment interaction (e.g., header issues).")
-else:
-    print("\nINFO: One or both basic connection tests (urllib/httpx) failed. Review their specific errors.")
+            results.append(ProbeResult(name, total=deadline_seconds, error=f"timed out after {deadline_seconds:g}s"))
+    return results
+
+
+def preflight_check(api_key: str, base_url: str = None, deadline_seconds: float = 5.0):
+    """
+    Fast check used by gpt_review.py before any chunking work. Returns
+    (ok, message): not ok when no probe reached the API or the key was rejected.
+    """
+    results = run_diagnostics(api_key, base_url, deadline_seconds, probes=("stdlib", "openai"))
+    by_name = {result.name: result for result in results}
+
+    if by_name["openai"].auth_failed:
+        return False, f"OpenAI API rejected the API key ({by_name['openai'].error})"
+    if not any(result.reachable for result in results):
+        errors = "; ".join(f"{result.name}: {result.error}" for result in results)
+        return False, f"OpenAI API unreachable within {deadline_seconds:g}s ({errors})"
+
+    probe = by_name["openai"] if by_name["openai"].reachable else by_name["stdlib"]
+    return True, f"OpenAI API reachable ({format_timings(probe)})"
+
+
+def _ms(seconds) -> str:
+    return "-" if seconds is None else f"{seconds * 1000:.0f}ms"
+
+
+def format_timings(result: ProbeResult) -> str:
+    return (
+        f"dns {_ms(result.dns)}, tcp {_ms(result.tcp_connect)}, tls {_ms(result.tls_handshake)}, "
+        f"first byte {_ms(result.first_byte)}, total {_ms(result.total)}"
+    )
+
+
+def print_environment():
+    """Prints the environment with secrets redacted, plus whitespace checks on the API key."""
+    key = os.environ.get("OPENAI_API_KEY")
+    if key is not None:
+        print(
+            f"OPENAI_API_KEY: {len(key)} chars, "
+            f"surrounding whitespace: {'yes (stripped before use)' if key != key.strip() else 'no'}"
+        )
+
+    redacted = {
+        name: ("***" if any(part in name.upper() for part in SECRET_NAME_PARTS) else value)
+        for name, value in sorted(os.environ.items())
+    }
+    print(json.dumps(redacted, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent, time-boxed OpenAI connectivity diagnostics.")
+    parser.add_argument("--deadline", type=float, default=DIAGNOSTICS_DEADLINE_SECONDS, help="Global deadline in seconds.")
+    parser.add_argument("--base-url", default=None, help="API base URL (default: OPENAI_BASE_URL or api.openai.com).")
+    parser.add_argument("--env", action="store_true", help="Also print the (redacted) environment.")
+    args = parser.parse_args()
+
+    if args.env:
+        print("--- Environment Variables Visible to Python ---")
+        print_environment()
+        print("--- End of Environment Variables ---\n")
+
+    print(f"Python version: {sys.version}")
+    print(f"OpenAI library version: {openai.__version__}")
+    print(f"HTTPX library version: {httpx.__version__}")
+    print(f"SSL version: {ssl.OPENSSL_VERSION}")
+    print(f"Default SSL CA cert file: {ssl.get_default_verify_paths().cafile}")
+
+    api_key = (os.getenv("OPENAI_API_KEY") or "").strip()
+    base_url = args.base_url or os.getenv("OPENAI_BASE_URL") or DEFAULT_BASE_URL
+    print(f"\n--- Probing {base_url} (deadline {args.deadline:g}s) ---")
+
+    stats = ConnectionStats()
+    results = run_diagnostics(api_key, base_url, args.deadline, stats=stats)
+    for result in results:
+        outcome = f"HTTP {result.status}" if result.status is not None else "no response"
+        marker = "✅" if result.reachable and not result.auth_failed else "❌"
+        print(f"{marker} {result.name:<7} {outcome:<12} {format_timings(result)}")
+        if result.error:
+            print(f"   {result.error}")
+    print(stats.summary())
+
+    if any(result.auth_failed for result in results):
+        print("\nThe API is reachable but rejected OPENAI_API_KEY; check the key and its permissions.")
+        sys.exit(1)
+    if not any(result.reachable for result in results):
+        print("\nNo probe reached the API. Compare the errors above: a DNS failure or a TCP/TLS timeout")
+        print("points at the runner's network, while a failure in only one probe points at that client.")
+        sys.exit(1)
+    print("\nAt least one probe reached the API.")
+
+
+if __name__ == "__main__":
+    main()
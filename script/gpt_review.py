@@ -1,22 +1,73 @@
 # script/gpt_review.py
-import openai
 import os
 import sys
 import json
 import time
 import traceback
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import dataclasses
+import email.utils
+import fnmatch
+import functools
+import hashlib
+import heapq
+import importlib.util
+import itertools
+import random
+import re
+import struct
+import tempfile
+import textwrap
+import threading
+
+
+class _LazyModule:
+    """
+    Stand-in for a module that is imported on first attribute access.
+    importlib's module locks make concurrent first accesses wait for one
+    complete import, so job and chunk threads may race for it.
+    """
 
-try:
-    import tiktoken
-    TIKTOKEN_AVAILABLE = True
-except ImportError:
-    TIKTOKEN_AVAILABLE = False
-    print(
-        "Warning: tiktoken library not found. Falling back to character-based "
-        "token estimation for chunking. For more accurate chunking, please "
-        "install tiktoken (`pip install tiktoken`) in the runner's environment.",
-        file=sys.stderr,
-    )
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute: str):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+
+def _lazy_import(name: str):
+    """
+    Returns module `name`, imported only when first used, or None if it is
+    not installed. Skip paths (no API key, empty or fully filtered diff)
+    then exit without paying for openai's import.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    try:
+        if importlib.util.find_spec(name) is None:
+            return None
+    except ModuleNotFoundError:  # Parent package missing
+        return None
+    return _LazyModule(name)
+
+
+# Heavy dependencies load on first use; the local modules below import openai/httpx.
+openai = _lazy_import("openai")
+debug_openai_connection = _lazy_import("debug_openai_connection")
+http_client = _lazy_import("http_client")
+
+tiktoken = _lazy_import("tiktoken")
+TIKTOKEN_AVAILABLE = tiktoken is not None
+
+# Optional: spans are also exported through OpenTelemetry when it is installed
+otel_trace = _lazy_import("opentelemetry.trace")
+OTEL_AVAILABLE = otel_trace is not None
 
 # --- Configuration ---
 DEFAULT_PROMPT_TEMPLATE = (
@@ -39,6 +90,13 @@ LIGHT_PROMPT_TEMPLATE = (
 
 # Allow override from workflow/env, default stays same
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-5.1")  # or "gpt-4.1"
+MINOR_CHANGE_PROMPT_TEMPLATE = (
+    "You are reviewing styling, configuration or data file changes (SCSS/CSS, "
+    "JSON, YAML, fixtures) from a MEAN stack project. Only point out real "
+    "problems: invalid or inconsistent values, broken selectors or variables, "
+    "committed secrets, environment-specific settings and accidental data "
+    "changes. Be brief, and say so if nothing needs attention."
+)
 
 # TPM Settings - allow override
 YOUR_TPM_LIMIT = int(os.getenv("TPM_LIMIT", "30000"))  # tokens per minute
@@ -46,19 +104,179 @@ if YOUR_TPM_LIMIT <= 0:
     print("❌ Configuration Error: TPM_LIMIT must be > 0", file=sys.stderr)
     sys.exit(1)
 
+# RPM Settings - allow override
+YOUR_RPM_LIMIT = int(os.getenv("RPM_LIMIT", "500"))  # requests per minute
+if YOUR_RPM_LIMIT <= 0:
+    print("❌ Configuration Error: RPM_LIMIT must be > 0", file=sys.stderr)
+    sys.exit(1)
+
+# Number of chunks kept in flight at once - allow override
+REVIEW_CONCURRENCY = int(os.getenv("REVIEW_CONCURRENCY", "3"))
+if REVIEW_CONCURRENCY <= 0:
+    print("❌ Configuration Error: REVIEW_CONCURRENCY must be > 0", file=sys.stderr)
+    sys.exit(1)
+
 # Chunking settings - allow override
 MAX_CHUNK_INPUT_TOKENS = int(os.getenv("MAX_CHUNK_INPUT_TOKENS", "4000"))
-TOKENS_PER_CALL_ESTIMATE = int(os.getenv("TOKENS_PER_CALL_ESTIMATE", "9000"))
+# Output cap per review mode, sent as max_completion_tokens and reserved
+# against the limiter together with the exact prompt size before each call.
+# For reasoning models (gpt-5.x, o-series) the cap includes the hidden
+# reasoning tokens, so a low cap can be spent before any review text is
+# written. A reply cut off at the cap is re-queued once with the cap
+# multiplied by COMPLETION_BUDGET_RETRY_FACTOR, and never cached or recorded
+# as reviewed.
+COMPLETION_TOKEN_BUDGETS = {
+    "light": int(os.getenv("MAX_COMPLETION_TOKENS_LIGHT", "1500")),
+    "default": int(os.getenv("MAX_COMPLETION_TOKENS_DEFAULT", "3000")),
+    "strict": int(os.getenv("MAX_COMPLETION_TOKENS_STRICT", "6000")),
+}
+if min(COMPLETION_TOKEN_BUDGETS.values()) <= 0:
+    print("❌ Configuration Error: MAX_COMPLETION_TOKENS_* must be > 0", file=sys.stderr)
+    sys.exit(1)
+COMPLETION_BUDGET_RETRY_FACTOR = float(os.getenv("COMPLETION_BUDGET_RETRY_FACTOR", "2"))
+
+# Chat format framing per message (role, separators) and for priming the reply
+CHAT_MESSAGE_OVERHEAD_TOKENS = 4
+CHAT_REPLY_OVERHEAD_TOKENS = 3
+
+# Pre-built tokenizers (and tiktoken's downloaded BPE files) are kept here so
+# runs don't re-download and re-parse them; cache this directory in CI. "" disables.
+TOKENIZER_CACHE_DIR = os.getenv(
+    "TOKENIZER_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "gpt-review", "tokenizer")
+)
 
 if MAX_CHUNK_INPUT_TOKENS <= 0:
     print("❌ Configuration Error: MAX_CHUNK_INPUT_TOKENS must be > 0", file=sys.stderr)
     sys.exit(1)
 
+# Retry settings for rate-limited / transient failures - allow override
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))
+RETRY_BASE_DELAY_SECONDS = float(os.getenv("RETRY_BASE_DELAY_SECONDS", "2"))
+# Caps the exponential backoff only; a server-requested wait is honoured in full
+RETRY_MAX_DELAY_SECONDS = float(os.getenv("RETRY_MAX_DELAY_SECONDS", "60"))
+
+# Diff pre-filter - comma-separated globs; patterns without "/" match file names
+REVIEW_EXCLUDE_GLOBS = os.getenv(
+    "REVIEW_EXCLUDE_GLOBS",
+    "package-lock.json,yarn.lock,pnpm-lock.yaml,*.lock,db.json,api/*.json,public/*,"
+    "dist/*,*.min.js,*.min.css,*.map,*.png,*.jpg,*.jpeg,*.gif,*.ico,*.svg,*.woff,*.woff2",
+)
+REVIEW_INCLUDE_GLOBS = os.getenv("REVIEW_INCLUDE_GLOBS", "")  # empty = everything not excluded
+REVIEW_MAX_FILE_DIFF_KB = int(os.getenv("REVIEW_MAX_FILE_DIFF_KB", "200"))
+REVIEW_MAX_LINE_CHARS = int(os.getenv("REVIEW_MAX_LINE_CHARS", "2000"))  # longer lines = minified
+
+# Local analysis of the hunks left after filtering (see HunkAnalyzer):
+# whitespace-only hunks and pure renames are listed instead of reviewed, and
+# style/config files go to the "minor" route, reviewed with
+# MINOR_CHANGE_PROMPT_TEMPLATE, the light completion budget and
+# REVIEW_MINOR_MODEL (e.g. a cheaper model).
+REVIEW_COLLAPSE_TRIVIAL = os.getenv("REVIEW_COLLAPSE_TRIVIAL", "1") == "1"
+REVIEW_ROUTE_BY_KIND = os.getenv("REVIEW_ROUTE_BY_KIND", "1") == "1"
+REVIEW_MINOR_MODEL = os.getenv("REVIEW_MINOR_MODEL") or OPENAI_MODEL
+
+# Two-tier review: when set (e.g. "gpt-5-mini"), this model triages every
+# chunk first and only chunks it flags are sent to the route's model.
+# Triage has its own TPM/RPM budget; errors and unclear verdicts escalate.
+REVIEW_TRIAGE_MODEL = os.getenv("REVIEW_TRIAGE_MODEL", "").strip()
+TRIAGE_TPM_LIMIT = int(os.getenv("TRIAGE_TPM_LIMIT", "200000"))
+TRIAGE_RPM_LIMIT = int(os.getenv("TRIAGE_RPM_LIMIT", "500"))
+# Reasoning models spend part of this before answering; a cut-off verdict escalates
+TRIAGE_MAX_COMPLETION_TOKENS = int(os.getenv("TRIAGE_MAX_COMPLETION_TOKENS", "600"))
+if min(TRIAGE_TPM_LIMIT, TRIAGE_RPM_LIMIT, TRIAGE_MAX_COMPLETION_TOKENS) <= 0:
+    print("❌ Configuration Error: TRIAGE_TPM_LIMIT, TRIAGE_RPM_LIMIT and TRIAGE_MAX_COMPLETION_TOKENS must be > 0",
+          file=sys.stderr)
+    sys.exit(1)
+TRIAGE_PROMPT_TEMPLATE = (
+    "You are triaging a chunk of a code diff from a MEAN stack project before "
+    "a senior engineer reviews it in depth. Start your reply with exactly one "
+    "of these lines:\n"
+    "VERDICT: OK - nothing notable (formatting, renames, comments, trivial or "
+    "obviously correct changes)\n"
+    "VERDICT: REVIEW - anything that could hide a bug, security, performance "
+    "or design problem\n"
+    "Then give one short sentence of reasoning. When unsure, answer REVIEW."
+)
+
+# Review cache - a directory CI can restore between runs; empty disables it
+REVIEW_CACHE_DIR = os.getenv("REVIEW_CACHE_DIR", "")
+REVIEW_CACHE_MAX_AGE_DAYS = float(os.getenv("REVIEW_CACHE_MAX_AGE_DAYS", "14"))
+REVIEW_CACHE_MAX_MB = float(os.getenv("REVIEW_CACHE_MAX_MB", "50"))
+
+# Incremental review state - a per-PR file CI can restore between pushes;
+# hunks unchanged since the last run are not sent again. Empty disables it.
+REVIEW_STATE_FILE = os.getenv("REVIEW_STATE_FILE", "")
+# Commit being reviewed, recorded in the state file (PR head SHA in CI)
+REVIEW_HEAD_SHA = os.getenv("REVIEW_HEAD_SHA") or os.getenv("GITHUB_SHA", "")
+
 # Reserve some tokens for system prompt + chunk intro safety margin
 CHUNK_OVERHEAD_TOKENS = int(os.getenv("CHUNK_OVERHEAD_TOKENS", "250"))
 
+# Hunks are bin-packed in windows of this many chunks' worth of tokens, so
+# chunks stream out while the rest of the diff is still being read
+PACK_WINDOW_CHUNKS = int(os.getenv("PACK_WINDOW_CHUNKS", "16"))
+
+# Lines tokenized per encoder call when counting a whole diff
+TOKENIZE_BLOCK_LINES = int(os.getenv("TOKENIZE_BLOCK_LINES", "2000"))
+
+# Deadline-aware scheduling - allow override
+SCHEDULE_PREFETCH_CHUNKS = int(os.getenv("SCHEDULE_PREFETCH_CHUNKS", "2"))  # read ahead while in diff order
+SCHEDULE_LOOKAHEAD_CHUNKS = int(os.getenv("SCHEDULE_LOOKAHEAD_CHUNKS", "64"))  # buffered once prioritising
+ESTIMATED_CALL_SECONDS = float(os.getenv("ESTIMATED_CALL_SECONDS", "30"))  # until real calls are observed
+
 # Overall Script Time Limit
 MAX_SCRIPT_DURATION_SECONDS = int(os.getenv("MAX_SCRIPT_DURATION_SECONDS", str(7 * 60)))  # 7 minutes
+TIME_LIMIT_NOTICE = (
+    f"\n\n--- REVIEW TRUNCATED DUE TO TIME LIMIT "
+    f"({MAX_SCRIPT_DURATION_SECONDS // 60} minutes) ---"
+)
+
+# Where the review is written; rewritten atomically as chunks complete
+REVIEW_OUTPUT_FILE = os.getenv("REVIEW_OUTPUT_FILE", "review.txt")
+
+# Pace requests from the API's x-ratelimit-* headers instead of only TPM_LIMIT / RPM_LIMIT
+RATE_LIMIT_FROM_HEADERS = os.getenv("RATE_LIMIT_FROM_HEADERS", "1") == "1"
+
+# "sync" reviews chunks with live, paced API calls; "batch" submits every
+# chunk as one Batch API job (cheaper, no TPM pacing, may take hours)
+REVIEW_EXECUTION_MODE = os.getenv("REVIEW_EXECUTION_MODE", "sync").strip().lower()
+if REVIEW_EXECUTION_MODE not in ("sync", "batch"):
+    print("❌ Configuration Error: REVIEW_EXECUTION_MODE must be 'sync' or 'batch'", file=sys.stderr)
+    sys.exit(1)
+
+# Collect the results of an earlier batch (same diff) instead of submitting a new one
+REVIEW_BATCH_ID = os.getenv("REVIEW_BATCH_ID", "").strip()
+BATCH_POLL_INTERVAL_SECONDS = float(os.getenv("BATCH_POLL_INTERVAL_SECONDS", "30"))
+BATCH_REQUESTS_FILE = os.getenv("BATCH_REQUESTS_FILE") or os.path.join(
+    os.path.dirname(REVIEW_OUTPUT_FILE), "review_batch_requests.jsonl"
+)
+# Batch API limit on requests per batch
+BATCH_MAX_REQUESTS = 50000
+
+# Reduce chunk reviews into one report: near-duplicate findings are merged
+# per file and ranked. REVIEW_CONSOLIDATE=0 keeps one section per chunk.
+REVIEW_CONSOLIDATE = os.getenv("REVIEW_CONSOLIDATE", "1") == "1"
+# Word-bigram Jaccard similarity at which two findings count as duplicates
+REVIEW_DEDUP_SIMILARITY = float(os.getenv("REVIEW_DEDUP_SIMILARITY", "0.6"))
+# Optional final call that rewrites the merged findings as a compact ranked
+# report; its input is trimmed (lowest-ranked findings first) to this budget
+REVIEW_CONSOLIDATE_CALL = os.getenv("REVIEW_CONSOLIDATE_CALL", "0") == "1"
+REVIEW_CONSOLIDATE_MAX_INPUT_TOKENS = int(os.getenv("REVIEW_CONSOLIDATE_MAX_INPUT_TOKENS", "8000"))
+CONSOLIDATION_PROMPT_TEMPLATE = (
+    "You are consolidating code review findings for one pull request. The "
+    "findings below were produced chunk by chunk and are grouped by file. "
+    "Merge duplicates, drop trivial or contradictory points, and return a "
+    "compact report ranked by severity, grouped by file. Keep concrete code "
+    "suggestions and file references."
+)
+
+# Connectivity/API-key check before any chunking work; 0 disables it
+REVIEW_PREFLIGHT_SECONDS = float(os.getenv("REVIEW_PREFLIGHT_SECONDS", "5"))
+
+# Run metrics JSON (defaults to review_metrics.json next to the review file)
+REVIEW_METRICS_FILE = os.getenv("REVIEW_METRICS_FILE") or os.path.join(
+    os.path.dirname(REVIEW_OUTPUT_FILE), "review_metrics.json"
+)
+REVIEW_TRACE = os.getenv("REVIEW_TRACE", "0") == "1"  # record per-call spans
 
 # --- Get Environment Variables ---
 api_key_from_env = os.getenv("OPENAI_API_KEY")
@@ -66,23 +284,124 @@ diff_file_path = os.getenv("DIFF_FILE")
 pr_labels_json = os.getenv("PR_LABELS_JSON")
 
 
+# One record per mergeable token in a pre-built tokenizer file: rank, byte length
+_TOKEN_RECORD = struct.Struct(">IH")
+
+
+def _tokenizer_cache_path(encoding_name: str) -> str:
+    # Keyed by tiktoken version, in case its pattern or special tokens change
+    version = getattr(tiktoken, "__version__", "0")
+    return os.path.join(TOKENIZER_CACHE_DIR, f"{encoding_name}-{version}.bin")
+
+
+def load_prebuilt_encoding(encoding_name: str):
+    """Builds the encoding from its pre-built file, or returns None if there is none (or it is unreadable)."""
+    try:
+        with open(_tokenizer_cache_path(encoding_name), "rb") as f:
+            header = json.loads(f.readline())
+            data = f.read()
+    except (OSError, ValueError):
+        return None
+
+    try:
+        mergeable_ranks = {}
+        offset = 0
+        for _ in range(header["tokens"]):
+            rank, length = _TOKEN_RECORD.unpack_from(data, offset)
+            offset += _TOKEN_RECORD.size
+            mergeable_ranks[data[offset:offset + length]] = rank
+            offset += length
+        return tiktoken.Encoding(
+            name=header["name"],
+            pat_str=header["pat_str"],
+            mergeable_ranks=mergeable_ranks,
+            special_tokens=header["special_tokens"],
+        )
+    except Exception as e:
+        print(f"Warning: Ignoring unreadable pre-built tokenizer for {encoding_name}: {e}", file=sys.stderr)
+        return None
+
+
+def save_prebuilt_encoding(encoding):
+    """Writes encoding's ranks and settings where load_prebuilt_encoding() finds them."""
+    try:
+        # tiktoken exposes no public accessor for the constructor arguments
+        mergeable_ranks = encoding._mergeable_ranks
+        header = {
+            "name": encoding.name,
+            "pat_str": encoding._pat_str,
+            "special_tokens": encoding._special_tokens,
+            "tokens": len(mergeable_ranks),
+        }
+        records = b"".join(
+            _TOKEN_RECORD.pack(rank, len(token)) + token for token, rank in mergeable_ranks.items()
+        )
+        path = _tokenizer_cache_path(encoding.name)
+        os.makedirs(TOKENIZER_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=TOKENIZER_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(json.dumps(header).encode("utf-8") + b"\n" + records)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"Warning: Could not save pre-built tokenizer: {e}", file=sys.stderr)
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model_name: str):
+    """
+    Resolves the tiktoken encoding for a model once and caches it, in memory
+    and (pre-built) under TOKENIZER_CACHE_DIR. Returns None when tiktoken is
+    unavailable or the encoding cannot be loaded.
+    """
+    if not TIKTOKEN_AVAILABLE:
+        print(
+            "Warning: tiktoken library not found. Falling back to character-based "
+            "token estimation for chunking. For more accurate chunking, please "
+            "install tiktoken (`pip install tiktoken`) in the runner's environment.",
+            file=sys.stderr,
+        )
+        return None
+
+    try:
+        encoding_name = tiktoken.encoding_name_for_model(model_name)
+    except KeyError:
+        # Newer models (e.g., gpt-5.1) may not be mapped yet in tiktoken.
+        encoding_name = "o200k_base"
+
+    if TOKENIZER_CACHE_DIR:
+        encoding = load_prebuilt_encoding(encoding_name)
+        if encoding is not None:
+            return encoding
+        # Keep tiktoken's download next to the pre-built file
+        os.environ.setdefault("TIKTOKEN_CACHE_DIR", TOKENIZER_CACHE_DIR)
+
+    try:
+        encoding = tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        print(
+            f"Warning: Failed to load tiktoken encoding for model {model_name}: {e}. "
+            "Falling back to char-based estimate.",
+            file=sys.stderr,
+        )
+        return None
+
+    if TOKENIZER_CACHE_DIR:
+        save_prebuilt_encoding(encoding)
+    return encoding
+
+
 def get_token_count(text: str, model_name: str) -> int:
     """
     Returns integer token count for a piece of text.
     Uses tiktoken if available; otherwise falls back to rough char estimate.
     """
-    if not TIKTOKEN_AVAILABLE:
+    encoding = get_encoding(model_name)
+    if encoding is None:
         # align with workflow heuristic: ~1 token per 4 chars
         return max(1, len(text) // 4)
 
     try:
-        try:
-            encoding = tiktoken.encoding_for_model(model_name)
-        except KeyError:
-            # Newer models (e.g., gpt-5.1) may not be mapped yet in tiktoken.
-            encoding = tiktoken.get_encoding("o200k_base")
-
-        return len(encoding.encode(text))
+        return len(encoding.encode_ordinary(text))
     except Exception as e:
         print(
             f"Warning: Failed token count for model {model_name}: {e}. "
@@ -92,316 +411,3136 @@ def get_token_count(text: str, model_name: str) -> int:
         return max(1, len(text) // 4)
 
 
-def create_chunks(diff_content: str, max_tokens_per_chunk: int, model_name: str):
-    """
-    Splits diff content into chunks of roughly max_tokens_per_chunk
-    (minus overhead for prompts/intro).
-    """
-    safe_max = max(1, max_tokens_per_chunk - CHUNK_OVERHEAD_TOKENS)
+def count_message_tokens(messages, model_name: str) -> int:
+    """Prompt tokens of a chat request: every message's content plus the chat format framing."""
+    return CHAT_REPLY_OVERHEAD_TOKENS + sum(
+        CHAT_MESSAGE_OVERHEAD_TOKENS + get_token_count(message["content"], model_name)
+        for message in messages
+    )
 
-    chunks = []
-    current_chunk_lines = []
-    current_token_count = 0
 
-    lines = diff_content.splitlines(keepends=True)
+class TokenByteLengths(dict):
+    """Lazily filled token id -> byte length table for one encoding."""
 
-    for line in lines:
-        line_token_count = get_token_count(line, model_name)
+    def __init__(self, encoding):
+        super().__init__()
+        self.encoding = encoding
 
-        if current_token_count + line_token_count > safe_max and current_chunk_lines:
-            chunks.append("".join(current_chunk_lines))
-            current_chunk_lines = [line]
-            current_token_count = line_token_count
-        else:
-            current_chunk_lines.append(line)
-            current_token_count += line_token_count
+    def __missing__(self, token):
+        length = len(self.encoding.decode_single_token_bytes(token))
+        self[token] = length
+        return length
 
-    if current_chunk_lines:
-        chunks.append("".join(current_chunk_lines))
 
-    # Fallback if we somehow didn't create chunks but have content
-    if not chunks and diff_content:
-        avg_chars_per_token = 4
-        max_chars_per_chunk = safe_max * avg_chars_per_token
-        step = int(max_chars_per_chunk) or 1
+@functools.lru_cache(maxsize=None)
+def get_token_byte_lengths(model_name: str):
+    """Returns the shared token byte length table for a model's encoding."""
+    return TokenByteLengths(get_encoding(model_name))
 
-        for i in range(0, len(diff_content), step):
-            chunks.append(diff_content[i:i + step])
 
-    return chunks if chunks else [diff_content]
+def get_line_token_counts(lines, model_name: str) -> list:
+    """
+    Returns per-line token counts for a list of lines (with line endings).
 
+    Lines are encoded in blocks with a single encoder call each; tokens are
+    attributed back to the line their bytes start on, so the counts sum to
+    the token count of the block.
+    """
+    encoding = get_encoding(model_name)
+    if encoding is None:
+        return [max(1, len(line) // 4) for line in lines]
+
+    token_byte_lengths = get_token_byte_lengths(model_name)
+    counts = []
+    step = max(1, TOKENIZE_BLOCK_LINES)
+    for start in range(0, len(lines), step):
+        block = lines[start:start + step]
+        try:
+            tokens = encoding.encode_ordinary("".join(block))
+            token_lengths = map(token_byte_lengths.__getitem__, tokens)
+            # Byte offset at which each token starts within the block
+            token_starts = list(itertools.accumulate(token_lengths, initial=0))[:-1]
+            line_ends = itertools.accumulate(len(line.encode("utf-8")) for line in block)
+            # Tokens are attributed to the line their first byte falls on
+            tokens_before = [bisect.bisect_left(token_starts, end) for end in line_ends]
+            block_counts = [
+                after - before
+                for before, after in zip([0] + tokens_before[:-1], tokens_before)
+            ]
+        except Exception as e:
+            print(
+                f"Warning: Failed batch token count for model {model_name}: {e}. "
+                "Falling back to char-based estimate.",
+                file=sys.stderr,
+            )
+            block_counts = [len(line) // 4 for line in block]
 
-def main():
-    script_start_time = time.time()
+        # Every line costs at least one token, as with per-line counting
+        counts.extend(max(1, c) for c in block_counts)
 
-    # --- Validate API key ---
-    if not api_key_from_env:
-        error_message = "❌ Configuration Error: OPENAI_API_KEY secret not set."
-        print(error_message, file=sys.stderr)
-        with open("review.txt", "w", encoding="utf-8") as f:
-            f.write(error_message)
-        sys.exit(1)
+    return counts
 
-    api_key = api_key_from_env.strip()
-    if not api_key:
-        error_message = "❌ Configuration Error: OPENAI_API_KEY is empty after stripping whitespace."
-        print(error_message, file=sys.stderr)
-        with open("review.txt", "w", encoding="utf-8") as f:
-            f.write(error_message)
-        sys.exit(1)
 
-    # --- Determine prompt by labels ---
-    prompt_template_to_use = DEFAULT_PROMPT_TEMPLATE
-    review_mode = "default"
+@dataclasses.dataclass
+class DiffFile:
+    path: str
+    header_lines: list
+    # Each hunk is a list of lines starting with its "@@" header line
+    hunks: list
+    # Characters of diff text for this file, including lines not kept
+    size: int = 0
+    skip_reason: str = None
+    # Review route ("code" or "minor") set by HunkAnalyzer
+    route: str = "code"
 
-    try:
-        labels_data = json.loads(pr_labels_json or "[]")
-        label_names = {
-            label.get("name")
-            for label in labels_data
-            if isinstance(label.get("name"), str)
-        }
 
-        if "gpt-review-strict" in label_names:
-            prompt_template_to_use = STRICT_PROMPT_TEMPLATE
-            review_mode = "strict"
-        elif "gpt-review-light" in label_names:
-            prompt_template_to_use = LIGHT_PROMPT_TEMPLATE
-            review_mode = "light"
-        elif "gpt-review-default" in label_names:
-            prompt_template_to_use = DEFAULT_PROMPT_TEMPLATE
-            review_mode = "default"
+def _diff_git_path(header_line: str) -> str:
+    """Returns the new-side path from a "diff --git a/... b/..." line."""
+    rest = header_line[len("diff --git "):].rstrip("\r\n")
+    marker = rest.rfind(" b/")
+    return rest[marker + 3:] if marker != -1 else rest
 
-        print(f"Determined review mode: {review_mode}")
-    except Exception as e:
-        print(
-            f"Warning: Label parsing failed: {e}. Falling back to default prompt.",
-            file=sys.stderr,
-        )
 
-    # --- Read diff file ---
-    if not diff_file_path:
-        error_message = (
-            f"❌ GPT Review failed (mode: {review_mode}): "
-            "DIFF_FILE environment variable not set."
-        )
-        print(error_message, file=sys.stderr)
-        with open("review.txt", "w", encoding="utf-8") as f:
-            f.write(error_message)
-        sys.exit(1)
+def iter_diff_files(lines, skip_reason_for_path=None):
+    """
+    Groups unified diff lines by file ("diff --git" header) and hunk ("@@").
+    Anything before the first file header is yielded as a file with no path.
 
-    try:
-        with open(diff_file_path, "r", encoding="utf-8") as f:
-            diff_content = f.read()
-    except Exception as e:
-        error_message = (
-            f"❌ GPT Review failed (mode: {review_mode}): "
-            f"Error reading diff file '{diff_file_path}' - {e}"
-        )
-        print(error_message, file=sys.stderr)
-        with open("review.txt", "w", encoding="utf-8") as f:
-            f.write(error_message)
-        sys.exit(1)
+    If skip_reason_for_path returns a reason for a file's path, that file's
+    lines are only measured, not kept, so excluded files cost no memory.
+    """
+    current = None
+    for line in lines:
+        if line.startswith("diff --git "):
+            if current is not None:
+                yield current
+            path = _diff_git_path(line)
+            current = DiffFile(path, [line], [])
+            if skip_reason_for_path is not None:
+                current.skip_reason = skip_reason_for_path(path)
+        elif current is None:
+            current = DiffFile("", [line], [])
+        elif current.skip_reason is not None:
+            pass
+        elif line.startswith("@@"):
+            current.hunks.append([line])
+        elif current.hunks:
+            current.hunks[-1].append(line)
+        else:
+            current.header_lines.append(line)
+        current.size += len(line)
 
-    if not diff_content.strip():
-        print("Warning: Diff content is empty or whitespace only.", file=sys.stderr)
-        with open("review.txt", "w", encoding="utf-8") as f:
-            f.write("❓ Review skipped: Diff content is empty or whitespace only.")
-        sys.exit(0)
+    if current is not None:
+        yield current
 
-    # --- Chunk diff ---
-    diff_chunks = create_chunks(diff_content, MAX_CHUNK_INPUT_TOKENS, OPENAI_MODEL)
-    print(f"Diff split into {len(diff_chunks)} chunks.")
 
-    all_review_parts = []
-    overall_api_call_succeeded = True
-    time_limit_reached = False
+def _split_globs(value: str) -> list:
+    return [glob.strip() for glob in value.split(",") if glob.strip()]
 
-    client = openai.OpenAI(api_key=api_key)
 
-    for i, chunk_text in enumerate(diff_chunks):
-        elapsed_time = time.time() - script_start_time
+def _matches_any(path: str, globs) -> bool:
+    name = path.rsplit("/", 1)[-1]
+    return any(
+        fnmatch.fnmatch(path, glob) if "/" in glob else fnmatch.fnmatch(name, glob)
+        for glob in globs
+    )
 
-        if elapsed_time > MAX_SCRIPT_DURATION_SECONDS:
-            print(
-                f"Warning: Script execution time limit "
-                f"({MAX_SCRIPT_DURATION_SECONDS}s) reached. "
-                "Stopping further chunk processing.",
-                file=sys.stderr,
-            )
-            all_review_parts.append(
-                f"\n\n--- REVIEW TRUNCATED DUE TO TIME LIMIT "
-                f"({MAX_SCRIPT_DURATION_SECONDS // 60} minutes) ---"
-            )
-            time_limit_reached = True
-            overall_api_call_succeeded = False
-            break
 
-        print(
-            f"Processing chunk {i+1} of {len(diff_chunks)} "
-            f"(Elapsed time: {elapsed_time:.0f}s)..."
+@dataclasses.dataclass
+class SkippedFile:
+    path: str
+    reason: str
+    estimated_tokens: int
+
+
+class DiffFilter:
+    """
+    Drops files that are not worth a review before they are tokenized:
+    excluded or not-included paths, oversized diffs, binary patches and
+    minified/generated content. Skipped files are recorded with a rough
+    (~4 chars per token) estimate of the tokens they would have cost.
+    """
+
+    def __init__(self, include_globs, exclude_globs, max_file_chars: int, max_line_chars: int):
+        self.include_globs = include_globs
+        self.exclude_globs = exclude_globs
+        self.max_file_chars = max_file_chars
+        self.max_line_chars = max_line_chars
+        self.skipped = []
+
+    def skip_reason_for_path(self, path: str):
+        if not path:
+            return None
+        if _matches_any(path, self.exclude_globs):
+            return "excluded by pattern"
+        if self.include_globs and not _matches_any(path, self.include_globs):
+            return "not in include patterns"
+        return None
+
+    def _skip_reason_for_content(self, diff_file: DiffFile):
+        if diff_file.size > self.max_file_chars:
+            return f"diff larger than {self.max_file_chars // 1024} KB"
+        if any(
+            line.startswith("Binary files ") or line.startswith("GIT binary patch")
+            for line in diff_file.header_lines
+        ):
+            return "binary file"
+        if any(len(line) > self.max_line_chars for hunk in diff_file.hunks for line in hunk):
+            return "minified or generated content"
+        return None
+
+    def filter_files(self, lines):
+        """Yields the DiffFiles from diff lines that should be reviewed, one file at a time."""
+        for diff_file in iter_diff_files(lines, self.skip_reason_for_path):
+            reason = diff_file.skip_reason or self._skip_reason_for_content(diff_file)
+            if reason is None:
+                yield diff_file
+                continue
+
+            self.skipped.append(SkippedFile(diff_file.path, reason, max(1, diff_file.size // 4)))
+            print(f"Skipping {diff_file.path}: {reason}.")
+
+    def reviewable_chars(self, lines) -> int:
+        """Characters of diff text in the files filter_files would keep; records nothing."""
+        return sum(
+            diff_file.size
+            for diff_file in iter_diff_files(lines, self.skip_reason_for_path)
+            if not (diff_file.skip_reason or self._skip_reason_for_content(diff_file))
         )
 
-        chunk_intro = ""
-        if len(diff_chunks) > 1:
-            chunk_intro = (
-                f"This is chunk {i+1} of {len(diff_chunks)} of a larger code diff. "
-                "Please focus your review on this specific chunk, considering it "
-                "in the context of a larger set of changes.\n\n"
-            )
+    def skipped_summary(self, max_listed: int = 50) -> str:
+        """List of skipped files for review.txt; empty if nothing was skipped."""
+        if not self.skipped:
+            return ""
 
-        messages = [
-            {"role": "system", "content": prompt_template_to_use},
-            {"role": "user", "content": chunk_intro + chunk_text},
+        saved_tokens = sum(f.estimated_tokens for f in self.skipped)
+        lines = [
+            f"--- Skipped {len(self.skipped)} file(s) without review "
+            f"(~{saved_tokens} tokens saved) ---"
         ]
-
-        try:
-            print(
-                f"Attempting API call for chunk {i+1} "
-                f"(Model: {OPENAI_MODEL}, Mode: {review_mode})..."
-            )
-            response = client.chat.completions.create(
-                model=OPENAI_MODEL,
-                messages=messages,
+        for skipped_file in self.skipped[:max_listed]:
+            lines.append(
+                f"- {skipped_file.path}: {skipped_file.reason} (~{skipped_file.estimated_tokens} tokens)"
             )
+        if len(self.skipped) > max_listed:
+            lines.append(f"- ... and {len(self.skipped) - max_listed} more")
+        return "\n".join(lines)
 
-            chunk_review_text = response.choices[0].message.content
 
-            tokens_used_this_call = TOKENS_PER_CALL_ESTIMATE
-            if response.usage and response.usage.total_tokens:
-                tokens_used_this_call = response.usage.total_tokens
-                print(f"Tokens used for chunk {i+1}: {tokens_used_this_call}")
+@dataclasses.dataclass
+class _PackItem:
+    order: int
+    file_index: int
+    lines: list
+    tokens: int
+    # hunk_fingerprint of the hunk (or header-only entry) this item came from
+    hunk_key: str = None
+    # Items of different review routes never share a chunk
+    route: str = "code"
 
-            all_review_parts.append(
-                f"--- Review for Chunk {i+1}/{len(diff_chunks)} ---\n{chunk_review_text}"
-            )
-            print(f"Chunk {i+1} processed successfully.")
 
-            # Throttle before next chunk
-            if i < len(diff_chunks) - 1:
-                elapsed_time_now = time.time() - script_start_time
-                delay_seconds = (tokens_used_this_call / YOUR_TPM_LIMIT) * 60.0 + 1.0
+_HUNK_RANGE_RE = re.compile(r"^@@ -\d+(?:,\d+)? \+\d+(?:,\d+)? @@")
 
-                min_sleep = 2.0
-                max_sleep = 45.0
-                delay_seconds = max(min_sleep, min(delay_seconds, max_sleep))
 
-                if elapsed_time_now + delay_seconds > MAX_SCRIPT_DURATION_SECONDS:
-                    print(
-                        f"Warning: Calculated delay ({delay_seconds:.2f}s) "
-                        f"for chunk {i+1} would exceed total time limit. "
-                        "Not sleeping and stopping further processing.",
-                        file=sys.stderr,
-                    )
-                    all_review_parts.append(
-                        f"\n\n--- REVIEW TRUNCATED DUE TO TIME LIMIT "
-                        f"({MAX_SCRIPT_DURATION_SECONDS // 60} minutes) ---"
-                    )
-                    time_limit_reached = True
-                    overall_api_call_succeeded = False
-                    break
+def hunk_fingerprint(path: str, hunk_lines) -> str:
+    """
+    Content hash of one hunk that ignores its "@@" line numbers, so a hunk
+    shifted by edits elsewhere in the file still matches across pushes.
+    """
+    digest = hashlib.sha256()
+    digest.update(path.encode("utf-8") + b"\0")
+    for position, line in enumerate(hunk_lines):
+        if position == 0:
+            line = _HUNK_RANGE_RE.sub("@@", line)
+        digest.update(line.encode("utf-8", "replace"))
+    return digest.hexdigest()[:32]
 
-                print(f"Delaying for {delay_seconds:.2f} seconds to respect TPM limit...")
-                time.sleep(delay_seconds)
 
-        except openai.RateLimitError as e:
-            error_msg_part = (
-                f"❌ Rate limit exceeded on chunk {i+1} (mode: {review_mode}): {e}"
-            )
-            print(error_msg_part, file=sys.stderr)
-            all_review_parts.append(error_msg_part)
-            overall_api_call_succeeded = False
-
-            remaining = MAX_SCRIPT_DURATION_SECONDS - (time.time() - script_start_time)
-            if remaining <= 0:
-                all_review_parts.append(
-                    f"\n\n--- REVIEW TRUNCATED DUE TO TIME LIMIT "
-                    f"({MAX_SCRIPT_DURATION_SECONDS // 60} minutes) ---"
-                )
-                time_limit_reached = True
+def _split_hunk(hunk_lines, line_counts, budget: int):
+    """
+    Splits an oversized hunk into pieces of at most `budget` tokens. Every
+    piece after the first starts with the repeated "@@" line.
+    Yields (lines, tokens) pairs.
+    """
+    hunk_header, hunk_header_tokens = hunk_lines[0], line_counts[0]
+    piece, piece_tokens = [hunk_header], hunk_header_tokens
+
+    for line, line_tokens in zip(hunk_lines[1:], line_counts[1:]):
+        if piece_tokens + line_tokens > budget and len(piece) > 1:
+            yield piece, piece_tokens
+            piece, piece_tokens = [hunk_header], hunk_header_tokens
+        piece.append(line)
+        piece_tokens += line_tokens
+
+    yield piece, piece_tokens
+
+
+def _first_fit_decreasing(items, header_tokens, safe_max: int):
+    """
+    Packs items into as few bins as possible, one review route per bin. An
+    item costs its own tokens plus its file header's tokens unless the bin
+    already holds that file.
+    """
+    items = sorted(items, key=lambda item: item.tokens + header_tokens[item.file_index], reverse=True)
+    smallest_item = min((item.tokens for item in items), default=0)
+
+    bins = []
+    open_bins = []
+    for item in items:
+        for pack in open_bins:
+            if pack["route"] != item.route:
+                continue
+            cost = item.tokens
+            if item.file_index not in pack["files"]:
+                cost += header_tokens[item.file_index]
+            if pack["tokens"] + cost <= safe_max:
+                break
+        else:
+            pack = {"tokens": 0, "files": set(), "items": [], "route": item.route}
+            bins.append(pack)
+            open_bins.append(pack)
+            cost = item.tokens + header_tokens[item.file_index]
+
+        pack["tokens"] += cost
+        pack["files"].add(item.file_index)
+        pack["items"].append(item)
+        if safe_max - pack["tokens"] < smallest_item:
+            # Nothing left can fit; stop scanning this bin
+            open_bins.remove(pack)
+
+    # One bin per route can leave two part-filled chunks where one call would
+    # do; a minor bin that fits into a code bin joins it and is reviewed as code.
+    code_bins = [pack for pack in bins if pack["route"] == "code"]
+    for pack in sorted((pack for pack in bins if pack["route"] != "code"), key=lambda pack: pack["tokens"]):
+        for target in code_bins:
+            if target["tokens"] + pack["tokens"] <= safe_max:
+                target["tokens"] += pack["tokens"]
+                target["files"] |= pack["files"]
+                target["items"].extend(pack["items"])
+                bins.remove(pack)
                 break
 
-            sleep_time = min(60, remaining)
-            print(f"Waiting for {sleep_time:.0f} seconds due to rate limit...")
-            time.sleep(sleep_time)
-            continue
+    return bins
+
+
+@dataclasses.dataclass
+class DiffChunk:
+    text: str
+    tokens: int
+    # Changed (+/-) line count per file path in this chunk
+    changed_lines: dict
+    # Fingerprints of the hunks in this chunk, in diff order
+    hunk_keys: list = dataclasses.field(default_factory=list)
+    # Review route (see build_review_routes); "minor" only if every file in it is
+    route: str = "code"
+
+    @property
+    def paths(self) -> list:
+        return list(self.changed_lines)
+
+
+def _render_bin(files, pack, safe_max: int) -> DiffChunk:
+    """Joins a bin's hunks in diff order, with each file's header before its first hunk."""
+    chunk_lines = []
+    changed_lines = {}
+    hunk_keys = []
+    previous_file = None
+    for item in sorted(pack["items"], key=lambda item: item.order):
+        path = files[item.file_index].path
+        if item.file_index != previous_file:
+            chunk_lines.extend(files[item.file_index].header_lines)
+            previous_file = item.file_index
+            changed_lines.setdefault(path, 0)
+        chunk_lines.extend(item.lines)
+        changed_lines[path] += sum(1 for line in item.lines if line[:1] in ("+", "-"))
+        # Pieces of a split hunk share one key
+        if item.hunk_key and item.hunk_key not in hunk_keys:
+            hunk_keys.append(item.hunk_key)
+    return DiffChunk("".join(chunk_lines), min(pack["tokens"], safe_max), changed_lines, hunk_keys, pack["route"])
+
+
+def iter_chunks_from_files(diff_files, max_tokens_per_chunk: int, model_name: str):
+    """
+    Lazily packs parsed diff files into chunks of roughly max_tokens_per_chunk
+    (minus overhead for prompts/intro) without cutting hunks apart.
+
+    Whole hunks are bin-packed first-fit-decreasing, and each chunk repeats
+    the header of every file it touches. Only a hunk too large for a chunk
+    on its own is split, each piece repeating the file and hunk headers.
+    Packing happens per window of PACK_WINDOW_CHUNKS chunks' worth of hunks,
+    so only one window (plus the file being read) is held in memory. The
+    least-full chunk of a window is carried over and topped up by the next.
+    """
+    safe_max = max(1, max_tokens_per_chunk - CHUNK_OVERHEAD_TOKENS)
+    window_limit = safe_max * max(1, PACK_WINDOW_CHUNKS)
+
+    files = []
+    header_tokens = []
+    items = []
+    window_tokens = 0
+
+    for diff_file in diff_files:
+        file_index = len(files)
+        files.append(diff_file)
+        file_lines = diff_file.header_lines + [line for hunk in diff_file.hunks for line in hunk]
+        line_counts = get_line_token_counts(file_lines, model_name)
+        header_tokens.append(sum(line_counts[:len(diff_file.header_lines)]))
+        window_tokens += sum(line_counts)
+
+        if not diff_file.hunks:
+            # Header-only entries: renames, mode changes, binary files
+            hunk_key = hunk_fingerprint(diff_file.path, diff_file.header_lines)
+            items.append(_PackItem(len(items), file_index, [], 0, hunk_key, diff_file.route))
+        else:
+            offset = len(diff_file.header_lines)
+            for hunk in diff_file.hunks:
+                hunk_counts = line_counts[offset:offset + len(hunk)]
+                offset += len(hunk)
 
-        except openai.APIConnectionError as e:
-            error_msg_part = (
-                f"❌ API connection error on chunk {i+1} (mode: {review_mode}): {e}"
-            )
-            print(error_msg_part, file=sys.stderr)
-            all_review_parts.append(error_msg_part)
-            overall_api_call_succeeded = False
-            break
+                hunk_key = hunk_fingerprint(diff_file.path, hunk)
+                budget = safe_max - header_tokens[file_index]
+                for piece, piece_tokens in _split_hunk(hunk, hunk_counts, budget):
+                    items.append(_PackItem(len(items), file_index, piece, piece_tokens, hunk_key, diff_file.route))
 
-        except openai.AuthenticationError as e:
-            error_msg_part = (
-                f"❌ Authentication error on chunk {i+1} (mode: {review_mode}): {e}"
-            )
-            print(error_msg_part, file=sys.stderr)
-            all_review_parts.append(error_msg_part)
-            overall_api_call_succeeded = False
-            break
+        if window_tokens < window_limit:
+            continue
 
-        except openai.BadRequestError as e:
-            error_msg_part = (
-                f"❌ Invalid request on chunk {i+1} (mode: {review_mode}): {e}"
+        bins = _first_fit_decreasing(items, header_tokens, safe_max)
+        carry = min(bins, key=lambda pack: pack["tokens"])
+        # Keep chunks, and the hunks inside them, in original diff order
+        for pack in sorted(bins, key=lambda pack: min(item.order for item in pack["items"])):
+            if pack is not carry:
+                yield _render_bin(files, pack, safe_max)
+
+        carried_files = {}
+        next_files, next_header_tokens, next_items = [], [], []
+        for item in sorted(carry["items"], key=lambda item: item.order):
+            if item.file_index not in carried_files:
+                carried_files[item.file_index] = len(next_files)
+                next_files.append(files[item.file_index])
+                next_header_tokens.append(header_tokens[item.file_index])
+            next_items.append(
+                _PackItem(
+                    len(next_items), carried_files[item.file_index], item.lines, item.tokens, item.hunk_key, item.route
+                )
             )
-            print(error_msg_part, file=sys.stderr)
-            all_review_parts.append(error_msg_part)
-            overall_api_call_succeeded = False
-            break  # stop further chunks; likely persistent
+        files, header_tokens, items = next_files, next_header_tokens, next_items
+        window_tokens = carry["tokens"]
 
-        except openai.APIError as e:
-            error_msg_part = (
-                f"❌ OpenAI API error on chunk {i+1} (mode: {review_mode}): {e}"
-            )
-            print(error_msg_part, file=sys.stderr)
-            all_review_parts.append(error_msg_part)
-            overall_api_call_succeeded = False
-            break  # stop further chunks; likely persistent
+    if items:
+        bins = _first_fit_decreasing(items, header_tokens, safe_max)
+        for pack in sorted(bins, key=lambda pack: min(item.order for item in pack["items"])):
+            yield _render_bin(files, pack, safe_max)
 
-        except Exception as e:
-            error_msg_part = (
-                f"❌ Unexpected error on chunk {i+1} (mode: {review_mode}): {e}"
-            )
-            print(error_msg_part, file=sys.stderr)
-            traceback.print_exc()
-            all_review_parts.append(error_msg_part)
-            overall_api_call_succeeded = False
-            break
 
-    final_review_text = "\n\n".join(all_review_parts)
-    if not final_review_text.strip():
-        final_review_text = (
-            "⚠️ Review generation process completed, but no content was generated "
-            "or an error occurred."
+def create_chunks(diff_content: str, max_tokens_per_chunk: int, model_name: str):
+    """
+    Splits diff content into chunks of roughly max_tokens_per_chunk
+    (minus overhead for prompts/intro); see iter_chunks_from_files.
+    """
+    chunks = [
+        chunk.text
+        for chunk in iter_chunks_from_files(
+            iter_diff_files(diff_content.splitlines(keepends=True)),
+            max_tokens_per_chunk,
+            model_name,
         )
+    ]
 
-    if time_limit_reached and "REVIEW TRUNCATED DUE TO TIME LIMIT" not in final_review_text:
-        final_review_text += (
-            f"\n\n--- REVIEW TRUNCATED DUE TO TIME LIMIT "
-            f"({MAX_SCRIPT_DURATION_SECONDS // 60} minutes) ---"
-        )
+    # Fallback if we somehow didn't create chunks but have content
+    if not chunks and diff_content:
+        safe_max = max(1, max_tokens_per_chunk - CHUNK_OVERHEAD_TOKENS)
+        avg_chars_per_token = 4
+        max_chars_per_chunk = safe_max * avg_chars_per_token
+        step = int(max_chars_per_chunk) or 1
 
-    try:
-        with open("review.txt", "w", encoding="utf-8") as f:
-            f.write(final_review_text)
+        for i in range(0, len(diff_content), step):
+            chunks.append(diff_content[i:i + step])
 
-        if overall_api_call_succeeded and all_review_parts and not time_limit_reached:
-            print("Overall review generated successfully and written to review.txt.")
-        elif time_limit_reached:
-            print("Review process truncated due to time limit; partial results written to review.txt.")
-        else:
-            print("Review process completed with errors or no content; details written to review.txt.")
-    except Exception as e:
-        print(f"FATAL: Error writing review.txt file: {e}", file=sys.stderr)
-        sys.exit(1)
+    return chunks if chunks else [diff_content]
 
-    # If we had errors (but still produced some text), don't fail the PR pipeline
-    # unless you want strict CI. Keep consistent with other repos.
-    sys.exit(0)
+
+# Review value per changed line, by kind of file: source code first, config last
+PATH_KIND_WEIGHTS = {"source": 1.0, "test": 0.6, "other": 0.5, "style": 0.4, "config": 0.2}
+
+_SOURCE_EXTENSIONS = {".ts", ".tsx", ".js", ".jsx", ".mjs", ".cjs", ".html", ".py"}
+_STYLE_EXTENSIONS = {".css", ".scss", ".sass", ".less"}
+_CONFIG_EXTENSIONS = {".json", ".yml", ".yaml", ".toml", ".ini", ".xml", ".lock", ".md", ".txt", ".env"}
+
+
+def classify_path(path: str) -> str:
+    """Returns "source", "test", "style", "config" or "other" for a diff path."""
+    name = path.rsplit("/", 1)[-1].lower()
+    extension = os.path.splitext(name)[1]
+
+    if re.search(r"\.(spec|test)\.[jt]sx?$", name):
+        return "test"
+    if extension in _SOURCE_EXTENSIONS:
+        return "source"
+    if extension in _STYLE_EXTENSIONS:
+        return "style"
+    if extension in _CONFIG_EXTENSIONS or name.startswith("."):
+        return "config"
+    return "other"
+
+
+def chunk_priority(chunk: DiffChunk) -> float:
+    """Review value of a chunk: changed lines weighted by the kind of file they are in."""
+    return sum(
+        PATH_KIND_WEIGHTS[classify_path(path)] * max(1, count)
+        for path, count in chunk.changed_lines.items()
+    )
+
+
+_LANGUAGES = {
+    ".ts": "typescript", ".tsx": "typescript", ".js": "javascript", ".jsx": "javascript",
+    ".mjs": "javascript", ".cjs": "javascript", ".html": "html", ".py": "python",
+    ".css": "css", ".scss": "scss", ".sass": "sass", ".less": "less",
+    ".json": "json", ".yml": "yaml", ".yaml": "yaml", ".md": "markdown",
+}
+# Indentation is syntax here (or, in markdown lists and code blocks and
+# HTML <pre>, content), so re-indenting is a real change
+_INDENT_SENSITIVE_LANGUAGES = {"python", "yaml", "sass", "markdown", "html"}
+# Line breaks mean nothing here, so re-wrapping is not a change. Elsewhere a
+# line break can end a statement (e.g. JavaScript's automatic semicolon
+# insertion), so only whitespace within lines is ignored.
+_FREE_FORM_LANGUAGES = {"css", "scss", "less", "json"}
+
+# Kind of change of a file's hunks, by classify_path kind, and the route reviewing it
+CHANGE_KINDS = {"source": "logic", "other": "logic", "test": "test", "style": "style", "config": "config"}
+ROUTE_BY_CHANGE_KIND = {"logic": "code", "test": "code", "style": "minor", "config": "minor"}
+
+
+def language_for_path(path: str) -> str:
+    return _LANGUAGES.get(os.path.splitext(path.lower())[1], "other")
+
+
+# String literals keep their whitespace when comparing code
+_STRING_LITERAL_RE = re.compile(r"""(["'`])(?:\\.|(?!\1)[^\\])*\1""")
+
+
+def _normalise_code(text: str) -> str:
+    """Collapses whitespace runs to one space, except inside string literals."""
+    parts = []
+    position = 0
+    for match in _STRING_LITERAL_RE.finditer(text):
+        parts.append(" ".join(text[position:match.start()].split()))
+        parts.append(match.group(0))
+        position = match.end()
+    parts.append(" ".join(text[position:].split()))
+    return " ".join(part for part in parts if part)
+
+
+def is_whitespace_only(hunk_lines, language: str) -> bool:
+    """
+    True if a hunk changes nothing but whitespace: its old side (context
+    and removed lines, in order) and new side (context and added lines)
+    read the same once whitespace is normalised, so moved code does not
+    count. Whitespace inside string literals is kept, and blank lines are
+    ignored. Re-wrapping counts only for free-form languages; for
+    indentation-sensitive ones only trailing whitespace is ignored.
+    """
+    old_side, new_side = [], []
+    changed = False
+    for line in hunk_lines[1:]:
+        text = line[1:].rstrip("\r\n")
+        if line.startswith("-"):
+            old_side.append(text)
+            changed = True
+        elif line.startswith("+"):
+            new_side.append(text)
+            changed = True
+        elif not line.startswith("\\"):  # "\ No newline at end of file"
+            old_side.append(text)
+            new_side.append(text)
+    if not changed:
+        return False
+
+    if language in _INDENT_SENSITIVE_LANGUAGES:
+        def normalise(lines):
+            return [line.rstrip() for line in lines if line.strip()]
+    elif language in _FREE_FORM_LANGUAGES:
+        def normalise(lines):
+            return _normalise_code("\n".join(lines))
+    else:
+        def normalise(lines):
+            return [_normalise_code(line) for line in lines if line.strip()]
+    return normalise(old_side) == normalise(new_side)
+
+
+def _rename_paths(header_lines):
+    """(old, new) paths of a rename without content changes, or None."""
+    old = new = None
+    for line in header_lines:
+        if line.startswith("rename from "):
+            old = line[len("rename from "):].rstrip("\r\n")
+        elif line.startswith("rename to "):
+            new = line[len("rename to "):].rstrip("\r\n")
+        elif line.startswith(("old mode ", "new mode ")):
+            return None  # A mode change is worth a look
+    return (old, new) if old and new else None
+
+
+@dataclasses.dataclass
+class CollapsedHunk:
+    path: str
+    kind: str  # "whitespace" or "rename"
+    # "@@" line of the hunk; empty for renames
+    hunk_header: str = ""
+
+
+class HunkAnalyzer:
+    """
+    Local static pass over the diff files left after filtering, before any
+    tokenization. Tags every hunk by language and kind of change (logic,
+    test, style, config, whitespace, rename), drops whitespace-only hunks
+    and pure renames so they cost no API call, and sets the review route of
+    each remaining file.
+    """
+
+    def __init__(self, collapse_trivial: bool = REVIEW_COLLAPSE_TRIVIAL, route_by_kind: bool = REVIEW_ROUTE_BY_KIND):
+        self.collapse_trivial = collapse_trivial
+        self.route_by_kind = route_by_kind
+        self.collapsed = []
+        self.kind_counts = collections.Counter()
+        self.language_counts = collections.Counter()
+
+    def _collapse(self, path: str, kind: str, language: str, hunk_header: str = ""):
+        self.collapsed.append(CollapsedHunk(path, kind, hunk_header.rstrip("\r\n")))
+        self.kind_counts[kind] += 1
+        self.language_counts[language] += 1
+
+    def analyze_files(self, diff_files):
+        """Yields the diff files that still need a review, without their collapsed hunks."""
+        for diff_file in diff_files:
+            language = language_for_path(diff_file.path)
+            kind = CHANGE_KINDS[classify_path(diff_file.path)]
+
+            if not diff_file.hunks:
+                rename = _rename_paths(diff_file.header_lines) if self.collapse_trivial else None
+                if rename is not None:
+                    self._collapse(f"{rename[0]} → {rename[1]}", "rename", language)
+                    continue
+            elif self.collapse_trivial:
+                kept_hunks = []
+                for hunk in diff_file.hunks:
+                    if is_whitespace_only(hunk, language):
+                        self._collapse(diff_file.path, "whitespace", language, hunk[0])
+                    else:
+                        kept_hunks.append(hunk)
+                if not kept_hunks:
+                    continue
+                diff_file.hunks = kept_hunks
+
+            self.kind_counts[kind] += max(1, len(diff_file.hunks))
+            self.language_counts[language] += max(1, len(diff_file.hunks))
+            diff_file.route = ROUTE_BY_CHANGE_KIND[kind] if self.route_by_kind else "code"
+            yield diff_file
+
+    def record_metrics(self, metrics):
+        for kind, count in self.kind_counts.items():
+            metrics.incr(f"hunks_{kind}", count)
+        for language, count in self.language_counts.items():
+            metrics.incr(f"hunks_lang_{language}", count)
+        metrics.incr("hunks_collapsed", len(self.collapsed))
+
+    def collapsed_summary(self, max_listed: int = 50) -> str:
+        """List of collapsed hunks for review.txt; empty if nothing was collapsed."""
+        if not self.collapsed:
+            return ""
+
+        whitespace = sum(1 for hunk in self.collapsed if hunk.kind == "whitespace")
+        renames = len(self.collapsed) - whitespace
+        lines = [
+            f"--- Not sent for review: {whitespace} whitespace-only hunk(s), "
+            f"{renames} rename(s) without changes ---"
+        ]
+        for hunk in self.collapsed[:max_listed]:
+            if hunk.kind == "rename":
+                lines.append(f"- {hunk.path}: renamed without changes")
+            else:
+                lines.append(f"- {hunk.path}: whitespace only ({hunk.hunk_header})")
+        if len(self.collapsed) > max_listed:
+            lines.append(f"- ... and {len(self.collapsed) - max_listed} more")
+        return "\n".join(lines)
+
+
+_DURATION_PART_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+
+def parse_reset_duration(value):
+    """
+    Parses rate-limit reset durations such as "1s", "250ms" or "6m0s"
+    (the x-ratelimit-reset-* header format). Returns seconds or None.
+    """
+    if not value:
+        return None
+
+    parts = _DURATION_PART_RE.findall(value.strip())
+    if not parts:
+        return None
+
+    scale = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+    return sum(float(number) * scale[unit] for number, unit in parts)
+
+
+def get_retry_after_seconds(headers):
+    """
+    Returns the server-requested wait from retry-after-ms, retry-after
+    (seconds or HTTP date) or x-ratelimit-reset-tokens, or None if absent.
+    """
+    if not headers:
+        return None
+
+    try:
+        retry_after_ms = headers.get("retry-after-ms")
+        if retry_after_ms:
+            return float(retry_after_ms) / 1000.0
+    except ValueError:
+        pass
+
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            try:
+                retry_at = email.utils.parsedate_to_datetime(retry_after)
+                return max(0.0, retry_at.timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+
+    return parse_reset_duration(headers.get("x-ratelimit-reset-tokens"))
+
+
+def compute_retry_delay(error, attempt: int) -> float:
+    """
+    Seconds to wait before retry number `attempt` (0-based) of a failed call.
+    Honours server retry headers when present, however long they ask for
+    (callers give up if it outlasts the run), otherwise uses exponential
+    backoff capped at RETRY_MAX_DELAY_SECONDS; both get random jitter so
+    concurrent retries spread out.
+    """
+    response = getattr(error, "response", None)
+    server_delay = get_retry_after_seconds(getattr(response, "headers", None))
+
+    if server_delay is not None:
+        return server_delay + random.uniform(0, RETRY_BASE_DELAY_SECONDS)
+
+    backoff = min(RETRY_BASE_DELAY_SECONDS * (2 ** attempt), RETRY_MAX_DELAY_SECONDS)
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
+
+# Suffixes of the x-ratelimit-* response headers read by TokenBucketLimiter.observe_headers
+RATE_LIMIT_HEADERS = (
+    "limit-tokens",
+    "limit-requests",
+    "remaining-tokens",
+    "remaining-requests",
+    "reset-tokens",
+    "reset-requests",
+)
+
+
+class TokenBucketLimiter:
+    """
+    Thread-safe limiter shared by all in-flight chunk requests.
+
+    Tracks two continuously refilling buckets, one for tokens per minute and
+    one for requests per minute. Callers reserve an estimated token cost
+    before a call and settle it against the real usage afterwards.
+    """
+
+    def __init__(self, tpm_limit: int, rpm_limit: int):
+        self.tpm_limit = tpm_limit
+        self.rpm_limit = rpm_limit
+        self._tokens = float(tpm_limit)
+        self._requests = float(rpm_limit)
+        self._blocked_until = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._acquire_lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        self._tokens = min(self.tpm_limit, self._tokens + elapsed * self.tpm_limit / 60.0)
+        self._requests = min(self.rpm_limit, self._requests + elapsed * self.rpm_limit / 60.0)
+
+    def acquire(self, tokens: int, max_wait: float):
+        """
+        Blocks until one request and `tokens` tokens are available, then takes them.
+        Returns the seconds spent waiting, or None if the wait would exceed max_wait.
+        """
+        # A single call larger than the whole budget would otherwise never fit
+        tokens = min(tokens, self.tpm_limit)
+        start = time.monotonic()
+
+        # Callers queue on _acquire_lock so budget is handed out in arrival
+        # (i.e. chunk) order instead of to whichever sleeper wakes first.
+        if not self._acquire_lock.acquire(timeout=max(0.0, max_wait)):
+            return None
+
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    self._refill(now)
+
+                    wait = max(
+                        self._blocked_until - now,
+                        (tokens - self._tokens) * 60.0 / self.tpm_limit,
+                        (1 - self._requests) * 60.0 / self.rpm_limit,
+                    )
+                    if wait <= 0:
+                        self._tokens -= tokens
+                        self._requests -= 1
+                        return now - start
+
+                if now - start + wait > max_wait:
+                    return None
+
+                time.sleep(wait)
+        finally:
+            self._acquire_lock.release()
+
+    def settle(self, reserved: int, actual: int):
+        """Corrects a reservation once the real token usage of a call is known."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.tpm_limit, self._tokens + min(reserved, self.tpm_limit) - actual)
+
+    def block_for(self, seconds: float):
+        """Holds back every caller for `seconds`, e.g. after a rate-limit response."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def observe_headers(self, headers):
+        """
+        Syncs both buckets with the x-ratelimit-* headers of an API response,
+        so pacing follows the organisation's live quota instead of the
+        configured one. Returns the parsed values, or None if none were sent.
+        """
+        if not headers:
+            return None
+
+        observed = {}
+        for name in RATE_LIMIT_HEADERS:
+            value = headers.get(f"x-ratelimit-{name}")
+            if value is None:
+                continue
+            try:
+                parsed = parse_reset_duration(value) if name.startswith("reset") else int(float(value))
+            except ValueError:
+                continue
+            if parsed is not None:
+                observed[name] = parsed
+        if not observed:
+            return None
+
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+
+            if observed.get("limit-tokens", 0) > 0:
+                self.tpm_limit = observed["limit-tokens"]
+            if observed.get("limit-requests", 0) > 0:
+                self.rpm_limit = observed["limit-requests"]
+
+            # The server's remaining budget already accounts for every request
+            # it has received, so it replaces the local estimate outright.
+            if "remaining-tokens" in observed:
+                self._tokens = min(self.tpm_limit, float(observed["remaining-tokens"]))
+            if "remaining-requests" in observed:
+                self._requests = min(self.rpm_limit, float(observed["remaining-requests"]))
+
+        return observed
+
+
+class FairShareLimiter:
+    """
+    Shares one TokenBucketLimiter between concurrent review jobs (one per PR).
+
+    Waiting callers are served round-robin by job, so a PR with many chunks
+    cannot starve the others of budget. Each job reviews through the view
+    returned by job(), which ChunkReviewer uses like a plain limiter.
+    """
+
+    def __init__(self, limiter: TokenBucketLimiter):
+        self.limiter = limiter
+        self._condition = threading.Condition()
+        self._waiting = {}  # job id -> deque of waiting callers, in arrival order
+        self._turns = collections.deque()  # job ids with waiting callers, next turn first
+        self._granting = False
+        self._active_jobs = set()
+
+    @contextlib.contextmanager
+    def job(self, job_id: str):
+        """Registers a job for the duration of the block and yields its limiter view."""
+        with self._condition:
+            self._active_jobs.add(job_id)
+        try:
+            yield _JobLimiter(self, job_id)
+        finally:
+            with self._condition:
+                self._active_jobs.discard(job_id)
+
+    @property
+    def active_jobs(self) -> int:
+        with self._condition:
+            return max(1, len(self._active_jobs))
+
+    def _withdraw(self, job_id: str, ticket):
+        queue = self._waiting[job_id]
+        queue.remove(ticket)
+        if not queue:
+            del self._waiting[job_id]
+            self._turns.remove(job_id)
+        self._condition.notify_all()
+
+    def acquire(self, job_id: str, tokens: int, max_wait: float):
+        """Like TokenBucketLimiter.acquire, but waits for job_id's turn first."""
+        start = time.monotonic()
+        deadline = start + max_wait
+        ticket = object()
+
+        with self._condition:
+            if job_id not in self._waiting:
+                self._waiting[job_id] = collections.deque()
+                self._turns.append(job_id)
+            queue = self._waiting[job_id]
+            queue.append(ticket)
+
+            while self._granting or self._turns[0] != job_id or queue[0] is not ticket:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._withdraw(job_id, ticket)
+                    return None
+                self._condition.wait(remaining)
+            self._granting = True
+
+        try:
+            waited = self.limiter.acquire(tokens, max_wait=max(0.0, deadline - time.monotonic()))
+        finally:
+            with self._condition:
+                self._granting = False
+                # This job goes to the back of the line, behind every other waiting job
+                self._turns.popleft()
+                queue.popleft()
+                if queue:
+                    self._turns.append(job_id)
+                else:
+                    del self._waiting[job_id]
+                self._condition.notify_all()
+
+        return None if waited is None else time.monotonic() - start
+
+
+class _JobLimiter:
+    """One job's view of a FairShareLimiter."""
+
+    def __init__(self, shared: FairShareLimiter, job_id: str):
+        self.shared = shared
+        self.job_id = job_id
+
+    @property
+    def tpm_limit(self) -> float:
+        # Used for deadline estimates: a job can count on its share of the budget
+        return self.shared.limiter.tpm_limit / self.shared.active_jobs
+
+    def acquire(self, tokens: int, max_wait: float):
+        return self.shared.acquire(self.job_id, tokens, max_wait)
+
+    def settle(self, reserved: int, actual: int):
+        self.shared.limiter.settle(reserved, actual)
+
+    def block_for(self, seconds: float):
+        self.shared.limiter.block_for(seconds)
+
+    def observe_headers(self, headers):
+        return self.shared.limiter.observe_headers(headers)
+
+
+class ReviewCache:
+    """
+    Content-addressed on-disk store of chunk reviews.
+
+    Entries are keyed by a hash of the chunk text, model and prompt
+    template, so unchanged chunks are not sent again on later pushes.
+    Entries older than max_age_days are dropped and the directory is trimmed
+    to max_bytes, least recently used first.
+    """
+
+    def __init__(self, directory: str, max_age_days: float, max_bytes: int):
+        self.directory = directory
+        self.max_age_seconds = max_age_days * 86400
+        self.max_bytes = max_bytes
+        # Lookups of full reviews; triage verdicts are counted apart
+        self.hits = 0
+        self.misses = 0
+        self.triage_hits = 0
+        self.triage_misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(chunk_text: str, model_name: str, prompt_template: str) -> str:
+        digest = hashlib.sha256()
+        for part in (model_name, prompt_template, chunk_text):
+            encoded = part.encode("utf-8")
+            # Length-prefix each part so different splits never collide
+            digest.update(len(encoded).to_bytes(8, "big"))
+            digest.update(encoded)
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key: str, triage: bool = False):
+        """Returns the cached review text (or triage verdict) for key, or None on a miss."""
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age_seconds:
+                raise FileNotFoundError(path)
+            with open(path, "r", encoding="utf-8") as f:
+                review_text = json.load(f)["review"]
+            # Refresh mtime so eviction is least-recently-used
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                if triage:
+                    self.triage_misses += 1
+                else:
+                    self.misses += 1
+            return None
+
+        with self._lock:
+            if triage:
+                self.triage_hits += 1
+            else:
+                self.hits += 1
+        return review_text
+
+    def put(self, key: str, review_text: str, model_name: str, review_mode: str):
+        """Stores a review; written via temp file + rename so readers never see partial entries."""
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "review": review_text,
+                        "model": model_name,
+                        "mode": review_mode,
+                        "created": time.time(),
+                    },
+                    f,
+                )
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Warning: Could not write review cache entry {path}: {e}", file=sys.stderr)
+
+    def evict(self):
+        """Removes expired entries, then the least recently used until under max_bytes."""
+        entries = []
+        now = time.time()
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                # Expired entries and temp files left by killed runs
+                if now - stat.st_mtime > self.max_age_seconds or name.endswith(".tmp"):
+                    self._remove(path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            self._remove(path)
+            total_bytes -= size
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class ReviewState:
+    """
+    Per-PR record of the chunk reviews earlier runs produced and the hunks
+    each one covered. On the next push, hunks whose content is unchanged are
+    dropped before chunking and their earlier reviews are carried forward,
+    so only new or edited hunks are sent again.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: str, prompt_key: str):
+        self.path = path
+        # Reviews only carry over while the model and prompt stay the same
+        self.prompt_key = prompt_key
+        self.previous_sha = None
+        self.reviews = []
+        self.carried_hunks = 0
+        self._review_by_hunk = {}
+        self._seen_hunks = set()
+        self._chunk_hunks = []
+        self._chunk_paths = []
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            print(f"No review state at {self.path}; reviewing the whole diff.")
+            return
+        except (OSError, ValueError) as e:
+            print(f"Warning: Ignoring unreadable review state {self.path}: {e}", file=sys.stderr)
+            return
+
+        if data.get("version") != self.VERSION or data.get("prompt_key") != self.prompt_key:
+            print("Review state was written for other models or prompts; reviewing the whole diff.")
+            return
+
+        self.previous_sha = data.get("head_sha") or None
+        self.reviews = data.get("reviews", [])
+        for position, review in enumerate(self.reviews):
+            for hunk_key in review.get("hunks", []):
+                self._review_by_hunk[hunk_key] = position
+        print(
+            f"Loaded review state from {self.path}: {len(self.reviews)} earlier chunk reviews"
+            + (f" (last reviewed {self.previous_sha[:12]})." if self.previous_sha else ".")
+        )
+
+    def _already_reviewed(self, hunk_key: str) -> bool:
+        if hunk_key not in self._review_by_hunk:
+            return False
+        self._seen_hunks.add(hunk_key)
+        self.carried_hunks += 1
+        return True
+
+    def pending_files(self, diff_files):
+        """Yields diff files with already-reviewed hunks removed; files left empty are dropped."""
+        for diff_file in diff_files:
+            if not diff_file.hunks:
+                if not self._already_reviewed(hunk_fingerprint(diff_file.path, diff_file.header_lines)):
+                    yield diff_file
+                continue
+
+            hunks = [
+                hunk for hunk in diff_file.hunks
+                if not self._already_reviewed(hunk_fingerprint(diff_file.path, hunk))
+            ]
+            if hunks:
+                yield dataclasses.replace(diff_file, hunks=hunks)
+
+    def track_chunks(self, diff_chunks):
+        """Passes chunks through, remembering each one's hunks and files for save()."""
+        for chunk in diff_chunks:
+            self._chunk_hunks.append(chunk.hunk_keys)
+            self._chunk_paths.append(chunk.paths)
+            yield chunk
+
+    def carried_forward(self):
+        """Earlier reviews that still cover at least one hunk of the diff, as (review, complete) pairs."""
+        carried = []
+        for review in self.reviews:
+            hunks = review.get("hunks", [])
+            present = [hunk_key for hunk_key in hunks if hunk_key in self._seen_hunks]
+            if present:
+                carried.append((review, len(present) == len(hunks)))
+        return carried
+
+    def render_carried_forward(self) -> str:
+        carried = self.carried_forward()
+        if not carried:
+            return ""
+
+        parts = [
+            f"--- {len(carried)} earlier review(s) carried forward for "
+            f"{self.carried_hunks} unchanged hunk(s) ---"
+        ]
+        for review, complete in carried:
+            sha = (review.get("sha") or "")[:7] or "an earlier run"
+            stale_note = "" if complete else "; some of its hunks changed and were reviewed again"
+            parts.append(
+                f"--- Carried forward from {sha} ({', '.join(review.get('paths', [])) or 'no file'}{stale_note}) ---\n"
+                f"{review.get('text', '')}"
+            )
+        return "\n\n".join(parts)
+
+    def save(self, head_sha: str, chunk_reviews):
+        """
+        Writes the carried-forward reviews plus this run's successful ones.
+        Cut-off reviews are left out, so their hunks are reviewed again.
+        """
+        reviews = []
+        for review, _ in self.carried_forward():
+            reviews.append({**review, "hunks": [h for h in review["hunks"] if h in self._seen_hunks]})
+        for index, chunk_review in enumerate(chunk_reviews):
+            if (chunk_review is None or not chunk_review.succeeded or chunk_review.truncated
+                    or index >= len(self._chunk_hunks)):
+                continue
+            reviews.append({
+                "sha": head_sha,
+                "paths": self._chunk_paths[index],
+                "hunks": self._chunk_hunks[index],
+                "text": chunk_review.text,
+            })
+
+        data = {
+            "version": self.VERSION,
+            "prompt_key": self.prompt_key,
+            "head_sha": head_sha or self.previous_sha,
+            "reviews": reviews,
+        }
+        try:
+            write_review_file(json.dumps(data), self.path)
+            print(f"Review state saved to {self.path} ({len(reviews)} chunk reviews).")
+        except OSError as e:
+            print(f"Warning: Could not write review state {self.path}: {e}", file=sys.stderr)
+
+
+class RunMetrics:
+    """
+    Counters, per-phase timings, per-call records and optional spans for one
+    run, written as JSON next to the review so TPM_LIMIT,
+    MAX_CHUNK_INPUT_TOKENS and REVIEW_CONCURRENCY can be tuned from data.
+    """
+
+    def __init__(self, trace: bool = False):
+        self.started_at = time.time()
+        self._start = time.monotonic()
+        self.trace = trace
+        self.counters = {}
+        self.phase_seconds = {}
+        self.gauges = {}
+        self.calls = []
+        self.spans = []
+        # Derived summaries added at the end of a run, e.g. "routing"
+        self.sections = {}
+        self._lock = threading.Lock()
+        self._tracer = otel_trace.get_tracer("gpt_review") if trace and OTEL_AVAILABLE else None
+
+    def incr(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_time(self, phase: str, seconds: float):
+        with self._lock:
+            self.phase_seconds[phase] = self.phase_seconds.get(phase, 0.0) + seconds
+
+    def observe_gauge(self, name: str, value: float):
+        """Tracks the last, min and max of a sampled value, e.g. remaining rate-limit budget."""
+        if value is None:
+            return
+        with self._lock:
+            gauge = self.gauges.get(name)
+            if gauge is None:
+                self.gauges[name] = {"last": value, "min": value, "max": value}
+            else:
+                gauge["last"] = value
+                gauge["min"] = min(gauge["min"], value)
+                gauge["max"] = max(gauge["max"], value)
+
+    def record_call(
+        self,
+        chunk_index: int,
+        attempt: int,
+        latency: float,
+        outcome: str,
+        usage=None,
+        predicted_prompt_tokens: int = None,
+        model: str = None,
+    ):
+        record = {
+            "chunk": chunk_index + 1,
+            "attempt": attempt + 1,
+            "model": model,
+            "latency_seconds": round(latency, 3),
+            "outcome": outcome,
+            "predicted_prompt_tokens": predicted_prompt_tokens,
+            "prompt_tokens": getattr(usage, "prompt_tokens", None) or 0,
+            "completion_tokens": getattr(usage, "completion_tokens", None) or 0,
+        }
+        with self._lock:
+            self.calls.append(record)
+            self.phase_seconds["api_calls"] = self.phase_seconds.get("api_calls", 0.0) + latency
+
+    def set_section(self, name: str, data: dict):
+        with self._lock:
+            self.sections[name] = data
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        """Times a block; kept as a span when tracing (and exported to OpenTelemetry if present)."""
+        if not self.trace:
+            yield
+            return
+
+        start = time.monotonic()
+        otel_span = self._tracer.start_as_current_span(name, attributes=attributes) if self._tracer else None
+        try:
+            if otel_span is not None:
+                with otel_span:
+                    yield
+            else:
+                yield
+        finally:
+            with self._lock:
+                self.spans.append({
+                    "name": name,
+                    "start_offset_seconds": round(start - self._start, 3),
+                    "duration_seconds": round(time.monotonic() - start, 3),
+                    "thread": threading.current_thread().name,
+                    "attributes": attributes,
+                })
+
+    def timed_iter(self, iterable, phase: str):
+        """Yields from iterable, adding the time spent producing each item to `phase`."""
+        iterator = iter(iterable)
+        while True:
+            start = time.monotonic()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(phase, time.monotonic() - start)
+                return
+            self.add_time(phase, time.monotonic() - start)
+            yield item
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            calls = list(self.calls)
+            data = {
+                "started_at": self.started_at,
+                "wall_seconds": round(time.monotonic() - self._start, 3),
+                "counters": dict(self.counters),
+                "phase_seconds": {k: round(v, 3) for k, v in self.phase_seconds.items()},
+                "gauges": {k: dict(v) for k, v in self.gauges.items()},
+            }
+            data.update(self.sections)
+
+        latencies = sorted(call["latency_seconds"] for call in calls)
+        data["api"] = {
+            "calls": len(calls),
+            "succeeded": sum(1 for call in calls if call["outcome"] == "ok"),
+            "prompt_tokens": sum(call["prompt_tokens"] for call in calls),
+            "completion_tokens": sum(call["completion_tokens"] for call in calls),
+            "latency_p50_seconds": latencies[len(latencies) // 2] if latencies else None,
+            "latency_max_seconds": latencies[-1] if latencies else None,
+        }
+        # Token accounting per tier when chunks go to more than one model
+        by_model = {}
+        for call in calls:
+            totals = by_model.setdefault(
+                call["model"] or OPENAI_MODEL,
+                {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency_seconds": 0.0},
+            )
+            totals["calls"] += 1
+            totals["prompt_tokens"] += call["prompt_tokens"]
+            totals["completion_tokens"] += call["completion_tokens"]
+            totals["latency_seconds"] = round(totals["latency_seconds"] + call["latency_seconds"], 3)
+        data["api"]["by_model"] = by_model
+        data["calls"] = calls
+        if self.trace:
+            data["spans"] = list(self.spans)
+        return data
+
+    def write(self, path: str):
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(self.to_dict(), f, indent=2)
+            print(f"Run metrics written to {path}.")
+        except OSError as e:
+            print(f"Warning: Could not write run metrics to {path}: {e}", file=sys.stderr)
+
+
+class LatencyEstimator:
+    """Exponentially weighted estimate of API call latency, seeded with a guess."""
+
+    def __init__(self, initial_seconds: float, smoothing: float = 0.3):
+        self.seconds = initial_seconds
+        self.smoothing = smoothing
+        self.observed = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            if self.observed == 0:
+                self.seconds = seconds
+            else:
+                self.seconds += self.smoothing * (seconds - self.seconds)
+            self.observed += 1
+
+
+@dataclasses.dataclass(frozen=True)
+class ReviewRoute:
+    """How chunks of one route are reviewed: prompt, model and completion budget."""
+    name: str
+    prompt_template: str
+    model: str
+    completion_budget: int
+
+
+def build_review_routes(prompt_template: str, review_mode: str) -> dict:
+    """
+    Route name -> ReviewRoute for one job. Code (logic and tests) gets the
+    prompt picked from the PR labels; minor changes (styles, config, data)
+    get MINOR_CHANGE_PROMPT_TEMPLATE and the light budget on REVIEW_MINOR_MODEL.
+    With REVIEW_TRIAGE_MODEL set there is also a "triage" route, which
+    screens chunks of both before they are sent.
+    """
+    routes = {
+        "code": ReviewRoute(
+            "code",
+            prompt_template,
+            OPENAI_MODEL,
+            COMPLETION_TOKEN_BUDGETS.get(review_mode, COMPLETION_TOKEN_BUDGETS["default"]),
+        ),
+        "minor": ReviewRoute(
+            "minor",
+            MINOR_CHANGE_PROMPT_TEMPLATE,
+            REVIEW_MINOR_MODEL,
+            COMPLETION_TOKEN_BUDGETS["light"],
+        ),
+    }
+    if REVIEW_TRIAGE_MODEL:
+        routes["triage"] = ReviewRoute(
+            "triage",
+            TRIAGE_PROMPT_TEMPLATE,
+            REVIEW_TRIAGE_MODEL,
+            TRIAGE_MAX_COMPLETION_TOKENS,
+        )
+    return routes
+
+
+_TRIAGE_VERDICT_RE = re.compile(r"VERDICT:\s*\**\s*(OK|REVIEW)\b", re.IGNORECASE)
+
+
+def parse_triage_verdict(text: str):
+    """
+    Returns (needs_review, reason) for a triage reply. Replies without a
+    verdict count as REVIEW, so a confused triage model never hides a chunk.
+    """
+    match = _TRIAGE_VERDICT_RE.search(text or "")
+    if match is None:
+        return True, "no verdict in the triage reply"
+    reason = " ".join(text[match.end():].split()).lstrip(" -:")
+    return match.group(1).upper() == "REVIEW", reason
+
+
+def build_review_messages(prompt_template: str, chunk_text: str, chunk_label: str = None):
+    """Chat messages for one chunk; chunk_label is None when the diff is a single chunk."""
+    chunk_intro = ""
+    if chunk_label is not None:
+        chunk_intro = (
+            f"This is chunk {chunk_label} of a larger code diff. "
+            "Please focus your review on this specific chunk, considering it "
+            "in the context of a larger set of changes.\n\n"
+        )
+
+    return [
+        {"role": "system", "content": prompt_template},
+        {"role": "user", "content": chunk_intro + chunk_text},
+    ]
+
+
+@dataclasses.dataclass
+class ChunkReview:
+    index: int
+    text: str
+    succeeded: bool
+    tokens_used: int = 0
+    cached: bool = False
+    # Set when the triage model found nothing notable; text is its reason
+    cleared_by_triage: bool = False
+    # Cut off at the completion budget: shown, but never cached or recorded as reviewed
+    truncated: bool = False
+    # Set when the chunk failed transiently and should be re-queued after this many seconds
+    retry_delay: float = None
+
+    def render(self, total_chunks: int) -> str:
+        """This chunk's part of review.txt: the review under a banner, or the error line."""
+        if not self.succeeded:
+            return self.text
+        cached_note = " (cached)" if self.cached else ""
+        of_total = f"/{total_chunks}" if total_chunks is not None else ""
+        if self.cleared_by_triage:
+            return f"--- Chunk {self.index + 1}{of_total} cleared by triage{cached_note} ---\n{self.text}"
+        return f"--- Review for Chunk {self.index + 1}{of_total}{cached_note} ---\n{self.text}"
+
+
+class ChunkReviewer:
+    """
+    Sends diff chunks to the API for review. One instance is shared by the
+    worker threads of a run; it owns the client, the limiter and the flags
+    that stop further chunks after a fatal error or the time limit.
+
+    With a triage_limiter (and REVIEW_TRIAGE_MODEL set), each chunk is first
+    triaged on the "triage" route, paced by triage_limiter; only chunks the
+    triage model flags are reviewed on their own route.
+    """
+
+    def __init__(self, client, limiter, prompt_template, review_mode, script_start_time, cache=None, metrics=None,
+                 triage_limiter=None):
+        self.client = client
+        self.limiter = limiter
+        self.triage_limiter = triage_limiter
+        self.cache = cache
+        self.metrics = metrics or RunMetrics()
+        self.prompt_template = prompt_template
+        self.review_mode = review_mode
+        self.routes = build_review_routes(prompt_template, review_mode)
+        self.triage_route = self.routes.get("triage") if triage_limiter is not None else None
+        # Chunks the triage model flagged; their retries skip triage
+        self._escalated = set()
+        # Chunks cut off at the completion budget once; retried with a larger one
+        self._budget_raised = set()
+        # What the chunks cleared by triage would have cost in full, and what triage cost
+        self._triage_totals = {
+            "cleared_prompt_tokens": 0,
+            "cleared_completion_budget": 0,
+            "triage_tokens": 0,
+            "triage_seconds": 0.0,
+            "full_reviews": 0,
+            "full_review_tokens": 0,
+            "full_completion_tokens": 0,
+        }
+        self._triage_lock = threading.Lock()
+        # Unknown until the chunk stream is exhausted
+        self.total_chunks = None
+        self.script_start_time = script_start_time
+        self.latency = LatencyEstimator(ESTIMATED_CALL_SECONDS)
+        self.stop_event = threading.Event()
+        self.time_limit_reached = False
+        # Last (TPM, RPM) quota reported by the API per limiter, for logging changes
+        self.observed_limits = {}
+        self._limits_lock = threading.Lock()
+
+    def _chunk_label(self, chunk_no: int) -> str:
+        if self.total_chunks is None:
+            return f"{chunk_no}"
+        return f"{chunk_no} of {self.total_chunks}"
+
+    def remaining_seconds(self) -> float:
+        return MAX_SCRIPT_DURATION_SECONDS - (time.time() - self.script_start_time)
+
+    def stop_for_time_limit(self, message: str):
+        print(message, file=sys.stderr)
+        self.time_limit_reached = True
+        self.stop_event.set()
+
+    def _failed(self, index: int, error_msg_part: str, stop: bool) -> ChunkReview:
+        print(error_msg_part, file=sys.stderr)
+        if stop:
+            self.stop_event.set()
+        return ChunkReview(index, error_msg_part, succeeded=False)
+
+    def _retry_or_fail(self, index, attempt, error, error_msg_part, rate_limited=False, stop_on_give_up=False):
+        """
+        Turns a transient failure into a ChunkReview asking for the chunk to
+        be re-queued, or into a final failure once retries or time run out.
+        """
+        if attempt + 1 >= RETRY_MAX_ATTEMPTS:
+            return self._failed(
+                index,
+                f"{error_msg_part} (giving up after {attempt + 1} attempts)",
+                stop=stop_on_give_up,
+            )
+
+        retry_delay = compute_retry_delay(error, attempt)
+        if retry_delay >= self.remaining_seconds():
+            return self._failed(
+                index,
+                f"{error_msg_part} (no time left to retry)",
+                stop=stop_on_give_up,
+            )
+
+        if rate_limited:
+            # The quota is shared, so hold back every chunk, not just this one
+            self.limiter.block_for(retry_delay)
+
+        self.metrics.incr("retries")
+        self.metrics.add_time("retry_backoff", retry_delay)
+
+        print(
+            f"{error_msg_part}\nRe-queueing chunk {index + 1} in {retry_delay:.1f}s "
+            f"(attempt {attempt + 2}/{RETRY_MAX_ATTEMPTS})...",
+            file=sys.stderr,
+        )
+        return ChunkReview(index, error_msg_part, succeeded=False, retry_delay=retry_delay)
+
+    def observe_rate_limits(self, headers, route: ReviewRoute = None):
+        """
+        Feeds x-ratelimit-* headers to the limiter of the route's tier and
+        logs that tier's quota whenever it changes.
+        """
+        if not RATE_LIMIT_FROM_HEADERS:
+            return
+
+        triage = route is not None and route.name == "triage"
+        observed = (self.triage_limiter if triage else self.limiter).observe_headers(headers)
+        if not observed:
+            return
+
+        tier = "triage" if triage else "review"
+        limits = (observed.get("limit-tokens"), observed.get("limit-requests"))
+        with self._limits_lock:
+            changed = limits != self.observed_limits.get(tier) and any(limits)
+            if changed:
+                self.observed_limits[tier] = limits
+        if changed:
+            configured = (TRIAGE_TPM_LIMIT, TRIAGE_RPM_LIMIT) if triage else (YOUR_TPM_LIMIT, YOUR_RPM_LIMIT)
+            print(
+                f"Observed API rate limits{' for triage' if triage else ''}: "
+                f"{limits[0] or '?'} TPM, {limits[1] or '?'} RPM "
+                f"(configured: {configured[0]} TPM, {configured[1]} RPM)."
+            )
+
+        prefix = "triage_ratelimit" if triage else "ratelimit"
+        for name, value in observed.items():
+            self.metrics.observe_gauge(f"{prefix}_{name.replace('-', '_')}", value)
+
+    def _create_completion(self, index: int, attempt: int, messages, predicted_prompt_tokens: int, route: ReviewRoute,
+                           limiter, reserved_tokens: int):
+        """
+        Makes the API call, recording its latency, usage and outcome in the run
+        metrics. Returns the parsed response and its HTTP headers.
+
+        If the call fails, nothing was processed: the reservation goes back to
+        `limiter` before any x-ratelimit-* headers of the error response are
+        applied, so the server's remaining budget has the last word.
+        """
+        call_start = time.monotonic()
+        outcome = "ok"
+        response = None
+        try:
+            with self.metrics.span("api_call", chunk=index + 1, attempt=attempt + 1, model=route.model):
+                # The raw response exposes the x-ratelimit-* headers alongside the parsed body
+                raw_response = self.client.chat.completions.with_raw_response.create(
+                    model=route.model,
+                    messages=messages,
+                    max_completion_tokens=route.completion_budget,
+                )
+                response = raw_response.parse()
+            return response, raw_response.headers
+        except Exception as e:
+            outcome = type(e).__name__
+            limiter.settle(reserved_tokens, 0)
+            self.observe_rate_limits(getattr(getattr(e, "response", None), "headers", None), route)
+            raise
+        finally:
+            latency = time.monotonic() - call_start
+            if route.name == "triage":
+                with self._triage_lock:
+                    self._triage_totals["triage_seconds"] += latency
+            elif response is not None:
+                # Scheduling estimates are for full reviews
+                self.latency.observe(latency)
+            self.metrics.record_call(
+                index,
+                attempt,
+                latency,
+                outcome,
+                getattr(response, "usage", None),
+                predicted_prompt_tokens,
+                route.model,
+            )
+
+    def _triage(self, index: int, chunk_text: str, route: ReviewRoute):
+        """
+        Asks the triage model whether a chunk needs its full review. Returns
+        a ChunkReview clearing the chunk, or None to escalate it, which is
+        also what every triage failure does: triage only ever saves work.
+        """
+        chunk_no = index + 1
+        triage = self.triage_route
+        self.metrics.incr("chunks_triaged")
+
+        cache_key = None
+        verdict_text = None
+        if self.cache is not None:
+            cache_key = ReviewCache.make_key(chunk_text, triage.model, triage.prompt_template)
+            verdict_text = self.cache.get(cache_key, triage=True)
+
+        cached = verdict_text is not None
+        if not cached:
+            messages = build_review_messages(triage.prompt_template, chunk_text)
+            prompt_tokens = count_message_tokens(messages, triage.model)
+            reserved_tokens = prompt_tokens + triage.completion_budget
+            waited = self.triage_limiter.acquire(reserved_tokens, max_wait=self.remaining_seconds())
+            if waited is None:
+                self.metrics.incr("chunks_escalated")
+                return None
+            self.metrics.add_time("triage_rate_limit_wait", waited)
+            if self.stop_event.is_set():
+                self.triage_limiter.settle(reserved_tokens, 0)
+                return None
+
+            self.metrics.incr("api_calls_triage")
+            try:
+                response, response_headers = self._create_completion(
+                    index, 0, messages, prompt_tokens, triage, self.triage_limiter, reserved_tokens
+                )
+            except Exception as e:
+                if isinstance(e, openai.RateLimitError) and getattr(e, "code", None) != "insufficient_quota":
+                    self.triage_limiter.block_for(compute_retry_delay(e, 0))
+                print(f"⚠️ Triage of chunk {chunk_no} failed ({type(e).__name__}); escalating.", file=sys.stderr)
+                self.metrics.incr("triage_errors")
+                self.metrics.incr("chunks_escalated")
+                return None
+
+            tokens_used = reserved_tokens
+            if response.usage and response.usage.total_tokens:
+                tokens_used = response.usage.total_tokens
+            self.triage_limiter.settle(reserved_tokens, tokens_used)
+            self.observe_rate_limits(response_headers, triage)
+            with self._triage_lock:
+                self._triage_totals["triage_tokens"] += tokens_used
+            verdict_text = response.choices[0].message.content or ""
+
+        needs_review, reason = parse_triage_verdict(verdict_text)
+        if cache_key is not None and not cached and verdict_text:
+            self.cache.put(cache_key, verdict_text, triage.model, "triage")
+        if needs_review:
+            print(f"Triage flagged chunk {chunk_no} for a full review: {reason}")
+            self.metrics.incr("chunks_escalated")
+            return None
+
+        # What the full review would have cost: its exact prompt and, later, the typical reply
+        full_messages = build_review_messages(
+            route.prompt_template,
+            chunk_text,
+            self._chunk_label(chunk_no) if self.total_chunks != 1 else None,
+        )
+        with self._triage_lock:
+            self._triage_totals["cleared_prompt_tokens"] += count_message_tokens(full_messages, route.model)
+            self._triage_totals["cleared_completion_budget"] += route.completion_budget
+        self.metrics.incr("chunks_cleared_by_triage")
+        print(f"Chunk {chunk_no} cleared by triage ({triage.model}){' (cached)' if cached else ''}.")
+        return ChunkReview(
+            index,
+            f"✅ Nothing notable ({triage.model}): {reason or 'no reason given'}",
+            succeeded=True,
+            cached=cached,
+            cleared_by_triage=True,
+        )
+
+    def routing_savings(self, concurrency: int) -> dict:
+        """
+        Estimated effect of triage on this run, or None without triage.
+        Chunks cleared by triage are priced at their exact full-review
+        prompt plus the mean observed full-review reply (their completion
+        budget if no full review finished), and timed the way
+        ChunkScheduler.estimated_seconds does, except that tokens covered by
+        the limiter's initially full bucket cost no time. The time of every
+        triage call is subtracted.
+        """
+        if self.triage_route is None:
+            return None
+
+        with self._triage_lock:
+            totals = dict(self._triage_totals)
+        counters = self.metrics.counters
+        cleared = counters.get("chunks_cleared_by_triage", 0)
+        if totals["full_reviews"]:
+            avoided_completion = round(cleared * totals["full_completion_tokens"] / totals["full_reviews"])
+        else:
+            avoided_completion = totals["cleared_completion_budget"]
+        avoided_tokens = totals["cleared_prompt_tokens"] + avoided_completion
+
+        call_seconds = cleared * self.latency.seconds / concurrency
+        tpm_limit = self.limiter.tpm_limit
+        used_tokens = totals["full_review_tokens"]
+        budget_seconds = (
+            max(0, used_tokens + avoided_tokens - tpm_limit) - max(0, used_tokens - tpm_limit)
+        ) * 60.0 / tpm_limit
+        avoided_seconds = max(call_seconds, budget_seconds)
+        return {
+            "triage_model": self.triage_route.model,
+            "chunks_triaged": counters.get("chunks_triaged", 0),
+            "chunks_cleared": cleared,
+            "chunks_escalated": counters.get("chunks_escalated", 0),
+            "triage_tokens": totals["triage_tokens"],
+            # Tokens not sent to the full-review models; triage reads every chunk,
+            # so the net total can be negative while the expensive tier saves
+            "full_review_tokens_avoided_estimate": avoided_tokens,
+            "net_tokens_saved_estimate": avoided_tokens - totals["triage_tokens"],
+            "triage_seconds": round(totals["triage_seconds"], 3),
+            "full_review_seconds_avoided_estimate": round(avoided_seconds, 3),
+            "wall_seconds_saved_estimate": round(avoided_seconds - totals["triage_seconds"] / concurrency, 3),
+            # Until a full review is observed, latency is the ESTIMATED_CALL_SECONDS guess
+            "full_review_latency_observed": self.latency.observed > 0,
+        }
+
+    def review(self, index: int, chunk_text: str, attempt: int = 0, route: str = "code"):
+        """
+        Reviews one chunk on the given route. Returns a ChunkReview, or None
+        if the chunk was never sent because the run was stopped before it started.
+        """
+        if self.stop_event.is_set():
+            return None
+
+        chunk_no = index + 1
+        elapsed_time = time.time() - self.script_start_time
+        if self.remaining_seconds() <= 0:
+            self.stop_for_time_limit(
+                f"Warning: Script execution time limit "
+                f"({MAX_SCRIPT_DURATION_SECONDS}s) reached. "
+                "Stopping further chunk processing."
+            )
+            return None
+
+        route = self.routes[route]
+        if index in self._budget_raised:
+            route = dataclasses.replace(
+                route, completion_budget=int(route.completion_budget * COMPLETION_BUDGET_RETRY_FACTOR)
+            )
+        cache_key = None
+        if self.cache is not None:
+            cache_key = ReviewCache.make_key(chunk_text, route.model, route.prompt_template)
+        # Looked up on the first attempt only, so retries don't count as misses
+        if cache_key is not None and attempt == 0:
+            cached_review_text = self.cache.get(cache_key)
+            if cached_review_text is not None:
+                print(f"Chunk {chunk_no} unchanged since a previous run; reusing cached review.")
+                return ChunkReview(index, cached_review_text, succeeded=True, cached=True)
+
+        if self.triage_route is not None and index not in self._escalated:
+            cleared = self._triage(index, chunk_text, route)
+            if cleared is not None or self.stop_event.is_set():
+                return cleared
+            self._escalated.add(index)
+
+        retry_note = f", attempt {attempt + 1}/{RETRY_MAX_ATTEMPTS}" if attempt else ""
+        print(
+            f"Processing chunk {self._chunk_label(chunk_no)} "
+            f"(Elapsed time: {elapsed_time:.0f}s{retry_note})..."
+        )
+
+        messages = build_review_messages(
+            route.prompt_template,
+            chunk_text,
+            self._chunk_label(chunk_no) if self.total_chunks != 1 else None,
+        )
+
+        # Pace from the predicted cost: the exact prompt plus the capped reply
+        prompt_tokens = count_message_tokens(messages, route.model)
+        reserved_tokens = prompt_tokens + route.completion_budget
+        waited = self.limiter.acquire(reserved_tokens, max_wait=self.remaining_seconds())
+        if waited is None:
+            self.stop_for_time_limit(
+                f"Warning: Waiting for TPM/RPM budget for chunk {chunk_no} "
+                "would exceed total time limit. Stopping further processing."
+            )
+            return None
+        self.metrics.add_time("rate_limit_wait", waited)
+        if waited >= 0.01:
+            print(f"Delayed chunk {chunk_no} for {waited:.2f} seconds to respect TPM/RPM limits.")
+
+        # The run may have been stopped while this chunk was waiting for budget
+        if self.stop_event.is_set():
+            self.limiter.settle(reserved_tokens, 0)
+            return None
+
+        try:
+            print(
+                f"Attempting API call for chunk {chunk_no} "
+                f"(Model: {route.model}, Mode: {self.review_mode}, Route: {route.name})..."
+            )
+            self.metrics.incr(f"api_calls_{route.name}")
+            response, response_headers = self._create_completion(
+                index, attempt, messages, prompt_tokens, route, self.limiter, reserved_tokens
+            )
+
+            choice = response.choices[0]
+            chunk_review_text = choice.message.content
+
+            tokens_used_this_call = reserved_tokens
+            if response.usage and response.usage.total_tokens:
+                tokens_used_this_call = response.usage.total_tokens
+                print(f"Tokens used for chunk {chunk_no}: {tokens_used_this_call}")
+            self.limiter.settle(reserved_tokens, tokens_used_this_call)
+            # After settling, so the server's remaining budget has the last word
+            self.observe_rate_limits(response_headers, route)
+            with self._triage_lock:
+                self._triage_totals["full_review_tokens"] += tokens_used_this_call
+                if response.usage and response.usage.completion_tokens:
+                    self._triage_totals["full_reviews"] += 1
+                    self._triage_totals["full_completion_tokens"] += response.usage.completion_tokens
+
+            truncated = choice.finish_reason == "length"
+            if truncated:
+                self.metrics.incr("reviews_cut_off")
+                cut_off = (
+                    f"⚠️ Review of chunk {chunk_no} was cut off at the {route.name} route's "
+                    f"completion budget ({route.completion_budget} tokens)"
+                )
+                if index not in self._budget_raised and attempt + 1 < RETRY_MAX_ATTEMPTS:
+                    self._budget_raised.add(index)
+                    larger_budget = int(route.completion_budget * COMPLETION_BUDGET_RETRY_FACTOR)
+                    print(f"{cut_off}; re-queueing it with {larger_budget} tokens.", file=sys.stderr)
+                    return ChunkReview(index, cut_off + ".", succeeded=False, retry_delay=0.0)
+                print(cut_off + ".", file=sys.stderr)
+                chunk_review_text = (chunk_review_text or "") + (
+                    "\n\n⚠️ This review was cut off at the completion token budget."
+                )
+
+            if cache_key is not None and chunk_review_text and not truncated:
+                self.cache.put(cache_key, chunk_review_text, route.model, self.review_mode)
+
+            print(f"Chunk {chunk_no} processed successfully.")
+            return ChunkReview(
+                index,
+                chunk_review_text,
+                succeeded=True,
+                tokens_used=tokens_used_this_call,
+                truncated=truncated,
+            )
+
+        except openai.RateLimitError as e:
+            # _create_completion has returned the reserved budget
+            if getattr(e, "code", None) == "insufficient_quota":
+                # Billing, not pacing: no retry can succeed, so stop every chunk
+                return self._failed(
+                    index,
+                    f"❌ OpenAI quota exhausted on chunk {chunk_no} (mode: {self.review_mode}): {e}. "
+                    "Check the plan and billing of the API key's project.",
+                    stop=True,
+                )
+            return self._retry_or_fail(
+                index,
+                attempt,
+                e,
+                f"❌ Rate limit exceeded on chunk {chunk_no} (mode: {self.review_mode}): {e}",
+                rate_limited=True,
+            )
+
+        except openai.APIConnectionError as e:
+            return self._retry_or_fail(
+                index,
+                attempt,
+                e,
+                f"❌ API connection error on chunk {chunk_no} (mode: {self.review_mode}): {e}",
+                stop_on_give_up=True,
+            )
+
+        except openai.AuthenticationError as e:
+            return self._failed(
+                index,
+                f"❌ Authentication error on chunk {chunk_no} (mode: {self.review_mode}): {e}",
+                stop=True,
+            )
+
+        except openai.BadRequestError as e:
+            # stop further chunks; likely persistent
+            return self._failed(
+                index,
+                f"❌ Invalid request on chunk {chunk_no} (mode: {self.review_mode}): {e}",
+                stop=True,
+            )
+
+        except openai.InternalServerError as e:
+            return self._retry_or_fail(
+                index,
+                attempt,
+                e,
+                f"❌ OpenAI server error on chunk {chunk_no} (mode: {self.review_mode}): {e}",
+                stop_on_give_up=True,
+            )
+
+        except openai.APIError as e:
+            # stop further chunks; likely persistent
+            return self._failed(
+                index,
+                f"❌ OpenAI API error on chunk {chunk_no} (mode: {self.review_mode}): {e}",
+                stop=True,
+            )
+
+        except Exception as e:
+            traceback.print_exc()
+            return self._failed(
+                index,
+                f"❌ Unexpected error on chunk {chunk_no} (mode: {self.review_mode}): {e}",
+                stop=True,
+            )
+
+
+def write_review_file(text: str, path: str = None):
+    """
+    Replaces the review file atomically (temp file + rename), so a reader
+    or a killed runner never sees a half-written file.
+    """
+    path = path or REVIEW_OUTPUT_FILE
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".review-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class ReviewWriter:
+    """
+    Keeps the review file current while chunks complete. Every finished
+    chunk triggers an atomic rewrite with all reviews so far in chunk order,
+    followed by an in-progress marker, so a partial file is always usable.
+    """
+
+    IN_PROGRESS_MARKER = "--- Review in progress"
+
+    def __init__(self, path: str = None):
+        self.path = path or REVIEW_OUTPUT_FILE
+        self._reviews = {}
+        self._lock = threading.Lock()
+
+    def add(self, chunk_review, total_chunks):
+        with self._lock:
+            self._reviews[chunk_review.index] = chunk_review
+            parts = [self._reviews[i].render(total_chunks) for i in sorted(self._reviews)]
+            of_total = f" of {total_chunks}" if total_chunks is not None else ""
+            parts.append(
+                f"{self.IN_PROGRESS_MARKER}: {len(self._reviews)}{of_total} chunks done ---"
+            )
+            try:
+                write_review_file("\n\n".join(parts), self.path)
+            except OSError as e:
+                print(f"Warning: Could not update {self.path}: {e}", file=sys.stderr)
+
+
+class ChunkScheduler:
+    """
+    Feeds chunks to a ChunkReviewer with up to `concurrency` calls in flight.
+
+    Chunks are pulled lazily, only `prefetch` ahead of the calls, so the
+    first call starts as soon as the first chunk is packed and memory stays
+    bounded. While the remaining work (the buffer, plus the unread chunks
+    from `expected_chunks`) is predicted to finish before the deadline,
+    chunks go out in diff order. When it is not, the buffer grows
+    to `lookahead` chunks and is served by value per predicted second
+    (chunk_priority over estimated cost), so what the time budget allows
+    goes to the most valuable chunks. Chunks that fail transiently are
+    re-queued with their retry delay.
+    """
+
+    def __init__(self, reviewer, concurrency: int, writer=None, lookahead: int = SCHEDULE_LOOKAHEAD_CHUNKS,
+                 prefetch: int = SCHEDULE_PREFETCH_CHUNKS, expected_chunks: int = None):
+        self.reviewer = reviewer
+        # Rough chunk count of the whole diff, so the deadline check covers chunks not read yet
+        self.expected_chunks = expected_chunks
+        self.concurrency = concurrency
+        self.writer = writer
+        self.lookahead = max(1, lookahead)
+        self.prefetch = max(1, min(prefetch, self.lookahead))
+        # One entry per chunk in diff order; None until the chunk is reviewed
+        self.results = []
+        self.chunk_paths = {}
+        self._chunk_iter = iter(())
+        self._exhausted = False
+        self._buffer = []
+        self._prioritising = False
+
+    def _fill_buffer(self):
+        target = self.lookahead if self._prioritising else self.prefetch
+        while not self._exhausted and len(self._buffer) < target:
+            chunk = next(self._chunk_iter, None)
+            if chunk is None:
+                self._exhausted = True
+                self.reviewer.total_chunks = len(self.results)
+                break
+            self._buffer.append((self._register(chunk), chunk))
+
+    def _register(self, chunk) -> int:
+        index = len(self.results)
+        self.results.append(None)
+        self.chunk_paths[index] = chunk.paths
+        return index
+
+    def _drop_unsent(self):
+        """Forgets buffered chunks and counts the unread rest, so the report has real totals."""
+        self._buffer.clear()
+        if not self._exhausted:
+            for chunk in self._chunk_iter:
+                self._register(chunk)
+            self._exhausted = True
+            self.reviewer.total_chunks = len(self.results)
+
+    def estimated_seconds(self, chunk) -> float:
+        """Predicted wall time one chunk adds to the run at the current concurrency and TPM."""
+        call_seconds = self.reviewer.latency.seconds / self.concurrency
+        predicted_tokens = chunk.tokens + CHUNK_OVERHEAD_TOKENS + self.reviewer.routes[chunk.route].completion_budget
+        budget_seconds = predicted_tokens * 60.0 / self.reviewer.limiter.tpm_limit
+        return max(call_seconds, budget_seconds)
+
+    def _predicted_seconds(self) -> float:
+        """Predicted time for the buffered chunks and, until the diff is read, the expected rest."""
+        buffered_seconds = sum(self.estimated_seconds(chunk) for _, chunk in self._buffer)
+        unread = 0
+        if not self._exhausted and self.expected_chunks:
+            unread = max(0, self.expected_chunks - len(self.results))
+        return buffered_seconds + unread * buffered_seconds / len(self._buffer)
+
+    def _next_chunk(self):
+        """Pops the next chunk to send, or None if nothing (more) can be sent."""
+        if not self._buffer:
+            return None
+
+        remaining = self.reviewer.remaining_seconds()
+        if self.reviewer.latency.seconds > remaining:
+            self.reviewer.stop_for_time_limit(
+                f"Warning: Predicted call latency ({self.reviewer.latency.seconds:.0f}s) exceeds "
+                f"the {remaining:.0f}s left. Not sending further chunks."
+            )
+            return None
+
+        queued_seconds = self._predicted_seconds()
+        prioritise = queued_seconds > remaining
+        if prioritise and not self._prioritising:
+            # Read further ahead, so the time left goes to the most valuable chunks
+            self._prioritising = True
+            self._fill_buffer()
+            print(
+                f"Predicted {queued_seconds:.0f}s for the remaining chunks but only "
+                f"{remaining:.0f}s left; reviewing the highest-value of the next "
+                f"{len(self._buffer)} chunks first."
+            )
+        self._prioritising = prioritise
+
+        position = 0
+        if prioritise:
+            position = max(
+                range(len(self._buffer)),
+                key=lambda k: chunk_priority(self._buffer[k][1]) / self.estimated_seconds(self._buffer[k][1]),
+            )
+        return self._buffer.pop(position)
+
+    def run(self, diff_chunks) -> list:
+        """
+        Reviews all chunks and returns one entry per chunk, in diff order
+        (None for chunks never reviewed). Finished chunks go to the writer
+        as soon as they complete.
+        """
+        self._chunk_iter = iter(diff_chunks)
+        chunks_in_progress = {}
+        # Heap of (ready_at, index, attempt) for re-queued chunks
+        pending = []
+        in_flight = {}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while True:
+                self._fill_buffer()
+                if self.reviewer.stop_event.is_set():
+                    # Re-queued chunks keep their last error in `results`
+                    pending.clear()
+                    self._drop_unsent()
+
+                if not (pending or in_flight or self._buffer):
+                    break
+
+                now = time.monotonic()
+                while len(in_flight) < self.concurrency:
+                    if pending and pending[0][0] <= now:
+                        _, index, attempt = heapq.heappop(pending)
+                        chunk = chunks_in_progress[index]
+                    else:
+                        picked = self._next_chunk()
+                        if picked is None:
+                            break
+                        (index, chunk), attempt = picked, 0
+                        chunks_in_progress[index] = chunk
+                        self._fill_buffer()
+
+                    future = executor.submit(self.reviewer.review, index, chunk.text, attempt, chunk.route)
+                    in_flight[future] = (index, attempt)
+
+                if not in_flight:
+                    if pending:
+                        time.sleep(max(0.0, pending[0][0] - now))
+                    continue
+
+                timeout = None
+                if pending and len(in_flight) < self.concurrency:
+                    timeout = max(0.0, pending[0][0] - now)
+
+                done, _ = concurrent.futures.wait(
+                    in_flight, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    index, attempt = in_flight.pop(future)
+                    chunk_review = future.result()
+                    if chunk_review is not None:
+                        self.results[index] = chunk_review
+                    if chunk_review is not None and chunk_review.retry_delay is not None:
+                        heapq.heappush(
+                            pending, (time.monotonic() + chunk_review.retry_delay, index, attempt + 1)
+                        )
+                    else:
+                        chunks_in_progress.pop(index, None)
+                        if chunk_review is not None and self.writer is not None:
+                            self.writer.add(chunk_review, self.reviewer.total_chunks)
+
+        return self.results
+
+    def not_reviewed_summary(self, max_listed: int = 50) -> str:
+        """Lists chunks that were never reviewed, with their files; empty if none."""
+        reason = "time limit" if self.reviewer.time_limit_reached else "stopped after an error"
+        return format_not_reviewed(self.results, self.chunk_paths, reason, max_listed)
+
+
+def format_cleared_by_triage(chunk_reviews, chunk_paths, max_listed: int = 50) -> str:
+    """Lists chunks the triage model cleared, with their files and its reason."""
+    lines = [f"--- Cleared by triage ({REVIEW_TRIAGE_MODEL}): {len(chunk_reviews)} chunks ---"]
+    for chunk_review in chunk_reviews[:max_listed]:
+        paths = ", ".join(chunk_paths[chunk_review.index]) or "(no file)"
+        reason = chunk_review.text.partition(": ")[2]
+        lines.append(f"- Chunk {chunk_review.index + 1}: {paths} - {reason}")
+    if len(chunk_reviews) > max_listed:
+        lines.append(f"- ... and {len(chunk_reviews) - max_listed} more")
+    return "\n".join(lines)
+
+
+def format_not_reviewed(results, chunk_paths, reason: str, max_listed: int = 50) -> str:
+    """Lists chunks whose result is None, with their files; empty if none."""
+    missing = [index for index, result in enumerate(results) if result is None]
+    if not missing:
+        return ""
+
+    lines = [f"--- Not reviewed ({reason}): {len(missing)} of {len(results)} chunks ---"]
+    for index in missing[:max_listed]:
+        lines.append(f"- Chunk {index + 1}: {', '.join(chunk_paths[index]) or '(no file)'}")
+    if len(missing) > max_listed:
+        lines.append(f"- ... and {len(missing) - max_listed} more")
+    return "\n".join(lines)
+
+
+class BatchReviewer:
+    """
+    Reviews every chunk through the Batch API instead of live calls: the
+    requests are written to a JSONL file, submitted as one batch, polled
+    until it finishes or the time limit is hit, and the results are mapped
+    back to chunks by custom_id. Cached chunks are not submitted.
+    """
+
+    TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+    def __init__(self, client, prompt_template, review_mode, script_start_time, cache=None, metrics=None):
+        self.client = client
+        self.cache = cache
+        self.metrics = metrics or RunMetrics()
+        self.prompt_template = prompt_template
+        self.review_mode = review_mode
+        self.routes = build_review_routes(prompt_template, review_mode)
+        self.script_start_time = script_start_time
+        self.batch_id = None
+        self.batch_status = None
+        self.time_limit_reached = False
+        self.error_message = None
+        self.results = []
+        self.chunk_paths = []
+        self._cache_keys = {}
+        self._chunk_routes = {}
+
+    @staticmethod
+    def custom_id(index: int) -> str:
+        return f"chunk-{index + 1:05d}"
+
+    def remaining_seconds(self) -> float:
+        return MAX_SCRIPT_DURATION_SECONDS - (time.time() - self.script_start_time)
+
+    def write_requests(self, diff_chunks, path: str) -> int:
+        """Writes one batch request line per uncached chunk; returns how many were written."""
+        written = 0
+        with open(path, "w", encoding="utf-8") as f:
+            for index, chunk in enumerate(diff_chunks):
+                self.results.append(None)
+                self.chunk_paths.append(chunk.paths)
+                route = self.routes[chunk.route]
+                self._chunk_routes[index] = route
+
+                if self.cache is not None:
+                    cache_key = ReviewCache.make_key(chunk.text, route.model, route.prompt_template)
+                    cached_review_text = self.cache.get(cache_key)
+                    if cached_review_text is not None:
+                        self.results[index] = ChunkReview(index, cached_review_text, succeeded=True, cached=True)
+                        continue
+                    self._cache_keys[index] = cache_key
+
+                # The chunk count is unknown while streaming, so chunks are labelled by number only
+                request = {
+                    "custom_id": self.custom_id(index),
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": route.model,
+                        "messages": build_review_messages(route.prompt_template, chunk.text, f"{index + 1}"),
+                        "max_completion_tokens": route.completion_budget,
+                    },
+                }
+                f.write(json.dumps(request) + "\n")
+                self.metrics.incr(f"batch_requests_{route.name}")
+                written += 1
+        return written
+
+    def submit(self, path: str) -> str:
+        with open(path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+            metadata={"source": "gpt_review", "review_mode": self.review_mode},
+        )
+        print(f"Submitted batch {batch.id} ({path}).")
+        return batch.id
+
+    def wait(self):
+        """Polls the batch until it reaches a terminal status or the time limit; returns the last state."""
+        wait_start = time.monotonic()
+        try:
+            while True:
+                batch = self.client.batches.retrieve(self.batch_id)
+                self.batch_status = batch.status
+                counts = batch.request_counts
+                progress = f" ({counts.completed + counts.failed}/{counts.total} requests done)" if counts else ""
+                print(f"Batch {batch.id}: {batch.status}{progress}")
+
+                if batch.status in self.TERMINAL_STATUSES:
+                    return batch
+
+                remaining = self.remaining_seconds()
+                if remaining <= 0:
+                    self.time_limit_reached = True
+                    print(
+                        f"Warning: Script execution time limit ({MAX_SCRIPT_DURATION_SECONDS}s) reached "
+                        f"while batch {batch.id} is {batch.status}.",
+                        file=sys.stderr,
+                    )
+                    return batch
+                time.sleep(min(BATCH_POLL_INTERVAL_SECONDS, remaining))
+        finally:
+            self.metrics.add_time("batch_wait", time.monotonic() - wait_start)
+
+    def _read_file_lines(self, file_id):
+        if not file_id:
+            return []
+        return self.client.files.content(file_id).text.splitlines()
+
+    def collect(self, batch):
+        """Maps output and error file lines back onto chunk results."""
+        index_by_custom_id = {self.custom_id(index): index for index in range(len(self.results))}
+
+        lines = self._read_file_lines(batch.output_file_id) + self._read_file_lines(batch.error_file_id)
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                item = None
+            if not isinstance(item, dict):
+                print(f"Warning: Skipping unreadable batch result line: {line[:200]}", file=sys.stderr)
+                continue
+
+            index = index_by_custom_id.get(item.get("custom_id"))
+            if index is None or (self.results[index] is not None and self.results[index].cached):
+                continue
+
+            chunk_no = index + 1
+            response = item.get("response") or {}
+            body = response.get("body") or {}
+            failure = None
+            if item.get("error") or response.get("status_code") != 200:
+                error = item.get("error") or body.get("error") or {}
+                failure = error.get("message") or response.get("status_code") or "unknown error"
+            else:
+                # One malformed result fails its own chunk, not the whole batch
+                choice = (body.get("choices") or [{}])[0]
+                message = choice.get("message") if isinstance(choice, dict) else None
+                if not isinstance(message, dict):
+                    failure = "result has no review message"
+            if failure is not None:
+                self.metrics.incr("batch_requests_failed")
+                self.results[index] = ChunkReview(
+                    index,
+                    f"❌ Batch request failed for chunk {chunk_no} (mode: {self.review_mode}): {failure}",
+                    succeeded=False,
+                )
+                continue
+
+            review_text = message.get("content") or ""
+            # No second round trip in batch mode; a cut-off review is shown but not kept
+            truncated = choice.get("finish_reason") == "length"
+            if truncated:
+                self.metrics.incr("reviews_cut_off")
+                review_text += "\n\n⚠️ This review was cut off at the completion token budget."
+            usage = body.get("usage") or {}
+            self.metrics.incr("batch_prompt_tokens", usage.get("prompt_tokens") or 0)
+            self.metrics.incr("batch_completion_tokens", usage.get("completion_tokens") or 0)
+
+            cache_key = self._cache_keys.get(index)
+            if cache_key is not None and review_text and not truncated:
+                self.cache.put(cache_key, review_text, self._chunk_routes[index].model, self.review_mode)
+
+            self.results[index] = ChunkReview(
+                index, review_text, succeeded=True, tokens_used=usage.get("total_tokens") or 0, truncated=truncated
+            )
+
+    def run(self, diff_chunks, requests_file: str = BATCH_REQUESTS_FILE):
+        """Submits (or resumes) the batch and returns per-chunk results in diff order; None = not reviewed."""
+        written = self.write_requests(diff_chunks, requests_file)
+        self.metrics.incr("batch_requests", written)
+        if written == 0:
+            return self.results
+        if written > BATCH_MAX_REQUESTS:
+            self.error_message = (
+                f"{written} chunks exceed the Batch API limit of {BATCH_MAX_REQUESTS} requests per batch"
+            )
+            print(f"❌ {self.error_message}.", file=sys.stderr)
+            return self.results
+
+        try:
+            if REVIEW_BATCH_ID:
+                self.batch_id = REVIEW_BATCH_ID
+                print(f"Collecting results of batch {self.batch_id}.")
+            else:
+                self.batch_id = self.submit(requests_file)
+
+            batch = self.wait()
+            self.collect(batch)
+        except openai.APIError as e:
+            self.error_message = f"Batch API error: {e}"
+            print(f"❌ {self.error_message}", file=sys.stderr)
+
+        return self.results
+
+    def not_reviewed_summary(self, max_listed: int = 50) -> str:
+        """Lists chunks without a batch result, and how to collect them later."""
+        if self.error_message:
+            reason = self.error_message
+        elif self.time_limit_reached:
+            reason = (
+                f"batch {self.batch_id} still {self.batch_status}; "
+                f"rerun with REVIEW_BATCH_ID={self.batch_id} to collect it"
+            )
+        else:
+            reason = f"batch {self.batch_id} {self.batch_status}"
+        return format_not_reviewed(self.results, self.chunk_paths, reason, max_listed)
+
+
+_LIST_ITEM_RE = re.compile(r"^\s{0,3}(?:[-*+]|\d+[.)])\s+")
+_HEADING_RE = re.compile(r"^\s{0,3}#{1,6}\s+")
+_WORD_RE = re.compile(r"[a-z0-9_]+")
+# One-line lead-ins and sign-offs split_findings drops from a review
+REMARK_MAX_CHARS = 120
+_LEAD_IN_RE = re.compile(r"^(?:here (?:are|is)|i (?:have )?reviewed|i found)\b", re.IGNORECASE)
+_SIGN_OFF_RE = re.compile(
+    r"\b(?:overall|otherwise|lgtm|looks? good|let me know|hope (?:this|that) helps|in summary|"
+    r"no other (?:issues|concerns)|the rest|nice work|good work|great work)\b",
+    re.IGNORECASE,
+)
+
+# (score, keywords) used to rank findings; the first matching tier wins
+SEVERITY_KEYWORDS = (
+    (3, ("security", "vulnerab", "injection", "xss", "csrf", "secret", "crash", "data loss", "race condition")),
+    (2, ("bug", "incorrect", "broken", "error", "exception", "null", "undefined", "fail", "leak")),
+    (1, ("performance", "slow", "memory", "unnecessary", "redundant", "n+1")),
+)
+
+
+@dataclasses.dataclass
+class Finding:
+    text: str
+    # File the finding is about, or "" when it names none of the chunk's files
+    path: str
+    chunk_no: int
+    shingles: frozenset
+    severity: int
+
+
+@dataclasses.dataclass
+class FindingCluster:
+    findings: list
+
+    @property
+    def representative(self) -> Finding:
+        # The most detailed wording stands for the whole cluster
+        return max(self.findings, key=lambda finding: len(finding.text))
+
+    @property
+    def paths(self) -> list:
+        return sorted({finding.path for finding in self.findings if finding.path})
+
+    @property
+    def severity(self) -> int:
+        return max(finding.severity for finding in self.findings)
+
+
+def _is_remark(text: str, lead_in: bool) -> bool:
+    """A short one-line lead-in ("Here are my comments:") or sign-off ("Otherwise LGTM.")."""
+    if "\n" in text or len(text) > REMARK_MAX_CHARS or "`" in text:
+        return False
+    if lead_in:
+        return text.endswith(":") or bool(_LEAD_IN_RE.match(text))
+    return bool(_SIGN_OFF_RE.search(text)) and _severity(text) == 0
+
+
+def split_findings(review_text: str) -> list:
+    """
+    Splits one chunk review into findings: top-level list items, headed
+    sections and paragraphs. Code blocks and indented continuation lines
+    stay with the finding they follow, a heading stays with the text under
+    it, and a plain paragraph right after a list item is that item's
+    explanation. A short lead-in line before the findings and a short
+    sign-off after them are dropped.
+    """
+    # (text, kind) per block; kind is "list", "heading" or "paragraph"
+    blocks = []
+    current = []
+    in_fence = False
+    after_blank = False
+
+    def flush():
+        lines = [line for line in current if line.strip()]
+        if lines and not (len(lines) == 1 and _HEADING_RE.match(lines[0])):
+            if _LIST_ITEM_RE.match(lines[0]):
+                kind = "list"
+            elif _HEADING_RE.match(lines[0]):
+                kind = "heading"
+            else:
+                kind = "paragraph"
+            blocks.append(("\n".join(lines).strip(), kind))
+        current.clear()
+
+    for line in review_text.splitlines():
+        stripped = line.strip()
+        if stripped.startswith("```"):
+            in_fence = not in_fence
+            current.append(line)
+            after_blank = False
+            continue
+        if in_fence:
+            current.append(line)
+            continue
+        if not stripped:
+            after_blank = True
+            continue
+
+        # A heading keeps the paragraph under it, blank line or not
+        under_heading = len(current) == 1 and _HEADING_RE.match(current[0])
+        starts_new = (
+            _LIST_ITEM_RE.match(line)
+            or _HEADING_RE.match(line)
+            or (after_blank and not line[:1].isspace() and not under_heading)
+        )
+        if starts_new:
+            flush()
+        current.append(line)
+        after_blank = False
+
+    flush()
+    if len(blocks) > 1 and blocks[0][1] == "paragraph" and _is_remark(blocks[0][0], lead_in=True):
+        blocks.pop(0)
+    if len(blocks) > 1 and blocks[-1][1] == "paragraph" and _is_remark(blocks[-1][0], lead_in=False):
+        blocks.pop()
+
+    findings = []
+    previous_kind = None
+    for text, kind in blocks:
+        if kind == "paragraph" and previous_kind == "list":
+            findings[-1] += "\n" + text
+            continue
+        findings.append(text)
+        previous_kind = kind
+    return findings
+
+
+_FENCED_CODE_RE = re.compile(r"```.*?(?:```|$)", re.DOTALL)
+_FILE_NAME_RE = re.compile(r"[\w./-]+\.[A-Za-z]\w*")
+
+
+def _shingles(text: str) -> frozenset:
+    # Compare the prose only: the same advice about two files, or with a
+    # different code sample, is still the same finding
+    prose = _FILE_NAME_RE.sub(" file ", _FENCED_CODE_RE.sub(" ", text))
+    words = _WORD_RE.findall(prose.lower())
+    if len(words) < 2:
+        return frozenset(words)
+    return frozenset(hash(pair) for pair in zip(words, words[1:]))
+
+
+def _severity(text: str) -> int:
+    lowered = text.lower()
+    for score, keywords in SEVERITY_KEYWORDS:
+        if any(keyword in lowered for keyword in keywords):
+            return score
+    return 0
+
+
+def _finding_path(text: str, chunk_paths) -> str:
+    """The chunk file a finding mentions first (by path or file name), else the only file, else ""."""
+    best_position, best_path = None, ""
+    for path in chunk_paths:
+        for needle in (path, os.path.basename(path)):
+            position = text.find(needle)
+            if position >= 0 and (best_position is None or position < best_position):
+                best_position, best_path = position, path
+    if best_path:
+        return best_path
+    return chunk_paths[0] if len(chunk_paths) == 1 else ""
+
+
+def cluster_findings(chunk_reviews, chunk_paths, similarity: float) -> list:
+    """
+    Splits successful chunk reviews into findings and greedily clusters
+    near-duplicates (word-bigram Jaccard >= similarity). Returns clusters
+    ranked by severity, then by how many chunks raised them.
+    """
+    clusters = []
+    for chunk_review in chunk_reviews:
+        if chunk_review is None or not chunk_review.succeeded or chunk_review.cleared_by_triage:
+            continue
+        paths = chunk_paths[chunk_review.index] if chunk_review.index < len(chunk_paths) else []
+        for text in split_findings(chunk_review.text or ""):
+            text = _LIST_ITEM_RE.sub("", text, count=1)
+            finding = Finding(
+                text,
+                _finding_path(text, paths),
+                chunk_review.index + 1,
+                _shingles(text),
+                _severity(text),
+            )
+            for cluster in clusters:
+                other = cluster.findings[0].shingles
+                union = len(finding.shingles | other)
+                if union and len(finding.shingles & other) / union >= similarity:
+                    cluster.findings.append(finding)
+                    break
+            else:
+                clusters.append(FindingCluster([finding]))
+
+    clusters.sort(key=lambda cluster: (-cluster.severity, -len(cluster.findings)))
+    return clusters
+
+
+def render_consolidated_report(clusters, reviewed_chunks: int) -> str:
+    """Ranked findings grouped by file; findings seen in several files get their own section."""
+    finding_count = sum(len(cluster.findings) for cluster in clusters)
+    sections = {}
+    for cluster in clusters:
+        paths = cluster.paths
+        if len(paths) == 1:
+            heading = paths[0]
+        elif paths:
+            heading = "Across multiple files"
+        else:
+            heading = "General"
+        sections.setdefault(heading, []).append(cluster)
+
+    parts = [
+        f"--- Consolidated review: {len(clusters)} findings from {reviewed_chunks} chunks "
+        f"({finding_count - len(clusters)} duplicates merged) ---"
+    ]
+    # Sections (files, cross-file and general) in order of their most severe
+    # finding; sorting is stable, so ties keep the clusters' ranking
+    ordered = sorted(sections, key=lambda heading: -max(cluster.severity for cluster in sections[heading]))
+    for heading in ordered:
+        lines = [f"### {heading}"]
+        for number, cluster in enumerate(sections[heading], 1):
+            chunks = sorted({finding.chunk_no for finding in cluster.findings})
+            seen = f"chunk {chunks[0]}" if len(chunks) == 1 else f"chunks {', '.join(map(str, chunks))}"
+            if len(cluster.findings) > 1:
+                seen = f"×{len(cluster.findings)}, {seen}"
+            if heading == "Across multiple files":
+                seen += f"; {', '.join(cluster.paths)}"
+            first_line, _, rest = cluster.representative.text.partition("\n")
+            body = first_line + textwrap.indent("\n" + textwrap.dedent(rest), "   ") if rest else first_line
+            lines.append(f"{number}. [{seen}] {body}")
+        parts.append("\n".join(lines))
+    return "\n\n".join(parts)
+
+
+def consolidate_with_model(client, report: str, review_mode: str, limiter=None, max_wait: float = 0.0):
+    """
+    Rewrites the merged findings into a compact ranked report with one
+    bounded call. The input is cut to REVIEW_CONSOLIDATE_MAX_INPUT_TOKENS by
+    dropping trailing (lowest-ranked) findings. Returns None on any failure.
+    """
+    lines = report.splitlines(keepends=True)
+    line_counts = get_line_token_counts(lines, OPENAI_MODEL)
+    budget = REVIEW_CONSOLIDATE_MAX_INPUT_TOKENS
+    kept, used = [], 0
+    for line, line_tokens in zip(lines, line_counts):
+        if used + line_tokens > budget:
+            break
+        kept.append(line)
+        used += line_tokens
+
+    messages = [
+        {"role": "system", "content": CONSOLIDATION_PROMPT_TEMPLATE},
+        {"role": "user", "content": "".join(kept)},
+    ]
+    completion_budget = COMPLETION_TOKEN_BUDGETS.get(review_mode, COMPLETION_TOKEN_BUDGETS["default"])
+    reserved_tokens = count_message_tokens(messages, OPENAI_MODEL) + completion_budget
+
+    if limiter is not None and limiter.acquire(reserved_tokens, max_wait=max_wait) is None:
+        print("Warning: No TPM budget left for the consolidation call; keeping merged findings.", file=sys.stderr)
+        return None
+
+    tokens_used = 0
+    try:
+        print(f"Consolidating findings with one call ({used} of {budget} input tokens)...")
+        response = client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=messages,
+            max_completion_tokens=completion_budget,
+        )
+        if response.usage and response.usage.total_tokens:
+            tokens_used = response.usage.total_tokens
+        return response.choices[0].message.content or None
+    except openai.APIError as e:
+        print(f"Warning: Consolidation call failed ({e}); keeping merged findings.", file=sys.stderr)
+        return None
+    finally:
+        if limiter is not None:
+            limiter.settle(reserved_tokens, tokens_used)
+
+
+def select_prompt(labels_json: str):
+    """Returns (prompt template, review mode) for a PR's labels JSON."""
+    prompt_template_to_use = DEFAULT_PROMPT_TEMPLATE
+    review_mode = "default"
+
+    try:
+        labels_data = json.loads(labels_json or "[]")
+        label_names = {
+            label.get("name")
+            for label in labels_data
+            if isinstance(label.get("name"), str)
+        }
+
+        if "gpt-review-strict" in label_names:
+            prompt_template_to_use = STRICT_PROMPT_TEMPLATE
+            review_mode = "strict"
+        elif "gpt-review-light" in label_names:
+            prompt_template_to_use = LIGHT_PROMPT_TEMPLATE
+            review_mode = "light"
+        elif "gpt-review-default" in label_names:
+            prompt_template_to_use = DEFAULT_PROMPT_TEMPLATE
+            review_mode = "default"
+
+        print(f"Determined review mode: {review_mode}")
+    except Exception as e:
+        print(
+            f"Warning: Label parsing failed: {e}. Falling back to default prompt.",
+            file=sys.stderr,
+        )
+
+    return prompt_template_to_use, review_mode
+
+
+@dataclasses.dataclass
+class ReviewJob:
+    """One diff to review and where its outputs go. main() builds it from the environment."""
+    diff_file: str
+    labels_json: str = None
+    output_file: str = REVIEW_OUTPUT_FILE
+    metrics_file: str = REVIEW_METRICS_FILE
+    state_file: str = REVIEW_STATE_FILE
+    head_sha: str = REVIEW_HEAD_SHA
+    batch_requests_file: str = BATCH_REQUESTS_FILE
+
+
+def _not_sent_summary(diff_filter: DiffFilter, analyzer: HunkAnalyzer) -> str:
+    """Collapsed hunks and skipped files for review.txt; empty if every change was sent."""
+    return "\n\n".join(summary for summary in (analyzer.collapsed_summary(), diff_filter.skipped_summary()) if summary)
+
+
+def _finish_without_chunks(job: ReviewJob, diff_filter: DiffFilter, analyzer: HunkAnalyzer, review_state,
+                           metrics: RunMetrics) -> int:
+    """
+    Writes the review of a run with nothing to send: every file filtered
+    out, collapsed by the analyzer or already reviewed.
+    """
+    skipped_summary = _not_sent_summary(diff_filter, analyzer)
+    metrics.incr("files_skipped", len(diff_filter.skipped))
+    metrics.incr("skipped_tokens_estimate", sum(f.estimated_tokens for f in diff_filter.skipped))
+    analyzer.record_metrics(metrics)
+
+    carried_forward_text = review_state.render_carried_forward() if review_state is not None else ""
+    if carried_forward_text:
+        metrics.incr("hunks_carried_forward", review_state.carried_hunks)
+        metrics.incr("reviews_carried_forward", len(review_state.carried_forward()))
+        since = f" since {review_state.previous_sha[:12]}" if review_state.previous_sha else ""
+        print(f"No new or changed hunks{since}; carrying earlier reviews forward.")
+        write_review_file(
+            f"✅ No new or changed hunks{since}.\n\n" + carried_forward_text
+            + ("\n\n" + skipped_summary if skipped_summary else ""),
+            job.output_file,
+        )
+        review_state.save(job.head_sha, [])
+        metrics.write(job.metrics_file)
+        return 0
+
+    if analyzer.collapsed:
+        print("Only whitespace-only changes and renames left after filtering; nothing to send.")
+        headline = "✅ Nothing to review: the remaining changes are whitespace-only or renames."
+    else:
+        print("No reviewable files left after filtering.")
+        headline = "❓ Review skipped: every changed file was filtered out."
+    write_review_file(headline + "\n\n" + skipped_summary, job.output_file)
+    metrics.write(job.metrics_file)
+    return 0
+
+
+def review_job(job: ReviewJob, client, limiter, start_time: float, concurrency: int = REVIEW_CONCURRENCY,
+               connection_stats=None, api_key: str = None, preflight: bool = False, triage_limiter=None) -> int:
+    """
+    Reviews one diff end to end and writes its review file. client and the
+    limiters may be shared with other jobs; when None, they are built (from
+    api_key) only once the diff turns out to need a review. triage_limiter
+    paces the triage model when REVIEW_TRIAGE_MODEL is set. Returns the
+    process exit code.
+    """
+    prompt_template_to_use, review_mode = select_prompt(job.labels_json)
+
+    # --- Read diff file ---
+    if not job.diff_file:
+        error_message = (
+            f"❌ GPT Review failed (mode: {review_mode}): "
+            "DIFF_FILE environment variable not set."
+        )
+        print(error_message, file=sys.stderr)
+        write_review_file(error_message, job.output_file)
+        return 1
+
+    # The diff is streamed line by line; nothing below holds all of it in memory.
+    try:
+        diff_stream = open(job.diff_file, "r", encoding="utf-8", errors="replace")
+        # Only leading blank lines are read up front, to spot empty diffs
+        leading_lines = []
+        for line in diff_stream:
+            leading_lines.append(line)
+            if line.strip():
+                break
+    except Exception as e:
+        error_message = (
+            f"❌ GPT Review failed (mode: {review_mode}): "
+            f"Error reading diff file '{job.diff_file}' - {e}"
+        )
+        print(error_message, file=sys.stderr)
+        write_review_file(error_message, job.output_file)
+        return 1
+
+    if not any(line.strip() for line in leading_lines):
+        diff_stream.close()
+        print("Warning: Diff content is empty or whitespace only.", file=sys.stderr)
+        write_review_file("❓ Review skipped: Diff content is empty or whitespace only.", job.output_file)
+        return 0
+
+    # --- Filter and chunk diff (lazily, as chunks are requested) ---
+    diff_filter = DiffFilter(
+        _split_globs(REVIEW_INCLUDE_GLOBS),
+        _split_globs(REVIEW_EXCLUDE_GLOBS),
+        REVIEW_MAX_FILE_DIFF_KB * 1024,
+        REVIEW_MAX_LINE_CHARS,
+    )
+    metrics = RunMetrics(trace=REVIEW_TRACE)
+    diff_files = diff_filter.filter_files(itertools.chain(leading_lines, diff_stream))
+
+    # Incremental mode: drop hunks an earlier run already reviewed
+    review_state = None
+    if job.state_file:
+        # Any route's model or prompt changing (incl. triage) invalidates earlier reviews
+        routes = sorted(build_review_routes(prompt_template_to_use, review_mode).values(), key=lambda r: r.name)
+        review_state = ReviewState(
+            job.state_file,
+            ReviewCache.make_key(
+                "",
+                "\n".join(f"{route.name}={route.model}" for route in routes),
+                "\n".join(route.prompt_template for route in routes),
+            ),
+        )
+        review_state.load()
+        diff_files = review_state.pending_files(diff_files)
+
+    # Collapse whitespace-only hunks and renames; route the rest by kind of change
+    analyzer = HunkAnalyzer()
+    diff_files = analyzer.analyze_files(diff_files)
+
+    # Nothing to review: exit before loading the tokenizer or the OpenAI client
+    first_file = next(diff_files, None)
+    if first_file is None:
+        diff_stream.close()
+        return _finish_without_chunks(job, diff_filter, analyzer, review_state, metrics)
+
+    # --- Pre-flight: don't start a run that cannot reach the API ---
+    if preflight:
+        preflight_ok, preflight_message = debug_openai_connection.preflight_check(
+            api_key, deadline_seconds=REVIEW_PREFLIGHT_SECONDS
+        )
+        print(f"Pre-flight: {preflight_message}")
+        if not preflight_ok:
+            diff_stream.close()
+            error_message = f"❌ GPT Review skipped (mode: {review_mode}): {preflight_message}."
+            print(error_message, file=sys.stderr)
+            write_review_file(error_message, job.output_file)
+            return 0
+
+    if client is None:
+        # Retries are scheduled by ChunkScheduler so waiting chunks don't hold a worker.
+        # One keep-alive connection per in-flight chunk, so handshakes are paid once.
+        connection_stats = http_client.ConnectionStats()
+        client = openai.OpenAI(
+            api_key=api_key,
+            max_retries=0,
+            http_client=http_client.build_http_client(concurrency, connection_stats),
+        )
+    if limiter is None:
+        limiter = TokenBucketLimiter(YOUR_TPM_LIMIT, YOUR_RPM_LIMIT)
+    if REVIEW_TRIAGE_MODEL and triage_limiter is None:
+        triage_limiter = TokenBucketLimiter(TRIAGE_TPM_LIMIT, TRIAGE_RPM_LIMIT)
+
+    diff_chunks = iter_chunks_from_files(itertools.chain([first_file], diff_files), MAX_CHUNK_INPUT_TOKENS, OPENAI_MODEL)
+    if review_state is not None:
+        diff_chunks = review_state.track_chunks(diff_chunks)
+    # Time spent reading, filtering, tokenizing and packing the diff
+    diff_chunks = metrics.timed_iter(diff_chunks, "chunking")
+
+    review_cache = None
+    if REVIEW_CACHE_DIR:
+        review_cache = ReviewCache(
+            REVIEW_CACHE_DIR,
+            REVIEW_CACHE_MAX_AGE_DAYS,
+            int(REVIEW_CACHE_MAX_MB * 1024 * 1024),
+        )
+
+    if REVIEW_EXECUTION_MODE == "batch":
+        # The Batch API paces itself; the few file/batch calls made here
+        # use the client's own retries.
+        print("Reviewing through the Batch API.")
+        if REVIEW_TRIAGE_MODEL:
+            print("REVIEW_TRIAGE_MODEL is ignored in batch mode; every chunk gets its full review.")
+        batch_reviewer = BatchReviewer(
+            client.with_options(max_retries=2),
+            prompt_template_to_use,
+            review_mode,
+            start_time,
+            cache=review_cache,
+            metrics=metrics,
+        )
+        with diff_stream:
+            chunk_reviews = batch_reviewer.run(diff_chunks, job.batch_requests_file)
+        time_limit_reached = batch_reviewer.time_limit_reached
+        not_reviewed_summary = batch_reviewer.not_reviewed_summary()
+        chunk_paths = batch_reviewer.chunk_paths
+        limiter = None
+    else:
+        reviewer = ChunkReviewer(
+            client,
+            limiter,
+            prompt_template_to_use,
+            review_mode,
+            start_time,
+            cache=review_cache,
+            metrics=metrics,
+            triage_limiter=triage_limiter,
+        )
+        if reviewer.triage_route is not None:
+            print(
+                f"Triaging chunks with {REVIEW_TRIAGE_MODEL} "
+                f"(TRIAGE_TPM_LIMIT={TRIAGE_TPM_LIMIT}, TRIAGE_RPM_LIMIT={TRIAGE_RPM_LIMIT}); "
+                "only flagged chunks get a full review."
+            )
+
+        # Keep up to `concurrency` chunks in flight; the limiter paces them
+        # against the shared TPM/RPM budget, the scheduler orders them against the
+        # deadline, and results are reassembled in diff order.
+        print(f"Reviewing with up to {concurrency} chunks in flight.")
+        # ~4 characters per token of the files the filter keeps (one more pass
+        # over the diff, a file at a time); already-reviewed and collapsed
+        # hunks still make this an overestimate
+        with open(job.diff_file, "r", encoding="utf-8", errors="replace") as f:
+            expected_chunks = diff_filter.reviewable_chars(f) // (4 * MAX_CHUNK_INPUT_TOKENS) + 1
+        scheduler = ChunkScheduler(
+            reviewer, concurrency, writer=ReviewWriter(job.output_file), expected_chunks=expected_chunks
+        )
+        with diff_stream:
+            chunk_reviews = scheduler.run(diff_chunks)
+        time_limit_reached = reviewer.time_limit_reached
+        not_reviewed_summary = scheduler.not_reviewed_summary()
+        chunk_paths = scheduler.chunk_paths
+
+        routing = reviewer.routing_savings(concurrency)
+        if routing is not None:
+            metrics.set_section("routing", routing)
+            guessed = "" if routing["full_review_latency_observed"] else " (no full review observed; latency guessed)"
+            print(
+                f"Triage ({routing['triage_model']}) cleared {routing['chunks_cleared']} of "
+                f"{routing['chunks_triaged']} chunks for {routing['triage_tokens']} triage tokens. "
+                f"Estimated full-review work avoided: {routing['full_review_tokens_avoided_estimate']} tokens, "
+                f"{routing['wall_seconds_saved_estimate']:.0f}s of wall time net of triage{guessed}."
+            )
+
+    if not chunk_reviews:
+        return _finish_without_chunks(job, diff_filter, analyzer, review_state, metrics)
+
+    total_chunks = len(chunk_reviews)
+    skipped_summary = _not_sent_summary(diff_filter, analyzer)
+    analyzer.record_metrics(metrics)
+
+    metrics.incr("chunks_total", total_chunks)
+    metrics.incr("chunks_reviewed", sum(1 for r in chunk_reviews if r is not None and r.succeeded))
+    metrics.incr("chunks_failed", sum(1 for r in chunk_reviews if r is not None and not r.succeeded))
+    metrics.incr("chunks_not_sent", sum(1 for r in chunk_reviews if r is None))
+    metrics.incr("files_skipped", len(diff_filter.skipped))
+    metrics.incr("skipped_tokens_estimate", sum(f.estimated_tokens for f in diff_filter.skipped))
+    if review_cache is not None:
+        metrics.incr("cache_hits", review_cache.hits)
+        metrics.incr("cache_misses", review_cache.misses)
+        metrics.incr("cache_triage_hits", review_cache.triage_hits)
+        metrics.incr("cache_triage_misses", review_cache.triage_misses)
+    if connection_stats is not None:
+        http_stats = connection_stats.to_dict()
+        for name in ("requests", "new_connections", "reused_requests", "tls_handshakes"):
+            metrics.incr(f"http_{name}", http_stats[name])
+        metrics.add_time("http_connect", http_stats["connect_seconds"])
+        metrics.add_time("http_tls", http_stats["tls_seconds"])
+        if connection_stats.requests:
+            print(connection_stats.summary())
+
+    carried_forward_text = ""
+    if review_state is not None:
+        carried_forward_text = review_state.render_carried_forward()
+        metrics.incr("hunks_carried_forward", review_state.carried_hunks)
+        metrics.incr("reviews_carried_forward", len(review_state.carried_forward()))
+
+    print(f"Diff was split into {total_chunks} chunks.")
+
+    all_review_parts = [r.render(total_chunks) for r in chunk_reviews if r is not None]
+
+    # Reduce: merge near-duplicate findings across chunks into one ranked report
+    succeeded_reviews = [r for r in chunk_reviews if r is not None and r.succeeded]
+    if REVIEW_CONSOLIDATE and len(succeeded_reviews) > 1:
+        clusters = cluster_findings(chunk_reviews, chunk_paths, REVIEW_DEDUP_SIMILARITY)
+        cleared = [r for r in succeeded_reviews if r.cleared_by_triage]
+        report = render_consolidated_report(clusters, len(succeeded_reviews) - len(cleared))
+        if cleared:
+            report += "\n\n" + format_cleared_by_triage(cleared, chunk_paths)
+        metrics.incr("findings", sum(len(cluster.findings) for cluster in clusters))
+        metrics.incr("findings_after_dedup", len(clusters))
+
+        if REVIEW_CONSOLIDATE_CALL:
+            remaining = MAX_SCRIPT_DURATION_SECONDS - (time.time() - start_time)
+            consolidated = consolidate_with_model(client, report, review_mode, limiter, max_wait=remaining)
+            if consolidated:
+                report = (
+                    f"--- Consolidated review ({len(clusters)} findings from "
+                    f"{len(succeeded_reviews) - len(cleared)} chunks) ---\n{consolidated}"
+                )
+                if cleared:
+                    report += "\n\n" + format_cleared_by_triage(cleared, chunk_paths)
+
+        failed_parts = [r.render(total_chunks) for r in chunk_reviews if r is not None and not r.succeeded]
+        all_review_parts = [report] + failed_parts
+    overall_api_call_succeeded = all(r is not None and r.succeeded for r in chunk_reviews)
+    if time_limit_reached:
+        all_review_parts.append(TIME_LIMIT_NOTICE)
+
+    if not_reviewed_summary:
+        all_review_parts.append(not_reviewed_summary)
+
+    if carried_forward_text:
+        all_review_parts.append(carried_forward_text)
+
+    if review_cache is not None:
+        print(
+            f"Review cache: {review_cache.hits} hits, {review_cache.misses} misses"
+            + (
+                f"; triage: {review_cache.triage_hits} hits, {review_cache.triage_misses} misses"
+                if review_cache.triage_hits or review_cache.triage_misses else ""
+            )
+            + f" (dir: {REVIEW_CACHE_DIR})."
+        )
+        review_cache.evict()
+
+    final_review_text = "\n\n".join(all_review_parts)
+    if not final_review_text.strip():
+        final_review_text = (
+            "⚠️ Review generation process completed, but no content was generated "
+            "or an error occurred."
+        )
+
+    if time_limit_reached and "REVIEW TRUNCATED DUE TO TIME LIMIT" not in final_review_text:
+        final_review_text += TIME_LIMIT_NOTICE
+
+    if skipped_summary:
+        final_review_text += "\n\n" + skipped_summary
+
+    try:
+        write_review_file(final_review_text, job.output_file)
+
+        if overall_api_call_succeeded and all_review_parts and not time_limit_reached:
+            print(f"Overall review generated successfully and written to {job.output_file}.")
+        elif time_limit_reached:
+            print(f"Review process truncated due to time limit; partial results written to {job.output_file}.")
+        else:
+            print(f"Review process completed with errors or no content; details written to {job.output_file}.")
+    except Exception as e:
+        print(f"FATAL: Error writing {job.output_file} file: {e}", file=sys.stderr)
+        return 1
+
+    if review_state is not None:
+        review_state.save(job.head_sha, chunk_reviews)
+
+    metrics.write(job.metrics_file)
+
+    # If we had errors (but still produced some text), don't fail the PR pipeline
+    # unless you want strict CI. Keep consistent with other repos.
+    return 0
+
+
+def main():
+    script_start_time = time.time()
+
+    # --- Validate API key ---
+    if not api_key_from_env:
+        error_message = "❌ Configuration Error: OPENAI_API_KEY secret not set."
+        print(error_message, file=sys.stderr)
+        write_review_file(error_message)
+        sys.exit(1)
+
+    api_key = api_key_from_env.strip()
+    if not api_key:
+        error_message = "❌ Configuration Error: OPENAI_API_KEY is empty after stripping whitespace."
+        print(error_message, file=sys.stderr)
+        write_review_file(error_message)
+        sys.exit(1)
+
+    job = ReviewJob(diff_file_path, pr_labels_json)
+    sys.exit(review_job(
+        job,
+        None,
+        None,
+        script_start_time,
+        api_key=api_key,
+        preflight=REVIEW_PREFLIGHT_SECONDS > 0,
+    ))
 
 
 if __name__ == "__main__":
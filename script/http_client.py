@@ -0,0 +1,135 @@
+# script/http_client.py
+#
+# Shared httpx transport settings for the scripts that talk to the OpenAI API
+# (gpt_review.py, debug_openai_connection.py): a keep-alive connection pool
+# sized to the request concurrency, optional HTTP/2, per-phase timeouts, and
+# connection reuse statistics gathered from httpcore's trace hooks.
+import os
+import sys
+import threading
+import time
+
+import httpx
+
+# --- Configuration ---
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "0") == "1"  # needs the `h2` package
+HTTP_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("HTTP_KEEPALIVE_EXPIRY_SECONDS", "60"))
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", "10"))
+# Reviews of large chunks can take minutes before the first byte arrives
+HTTP_READ_TIMEOUT_SECONDS = float(os.getenv("HTTP_READ_TIMEOUT_SECONDS", "300"))
+HTTP_WRITE_TIMEOUT_SECONDS = float(os.getenv("HTTP_WRITE_TIMEOUT_SECONDS", "30"))
+HTTP_POOL_TIMEOUT_SECONDS = float(os.getenv("HTTP_POOL_TIMEOUT_SECONDS", "30"))
+
+
+class ConnectionStats:
+    """
+    Counts requests against newly opened connections and TLS handshakes,
+    so a run can show whether handshakes were amortised over many calls.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.tls_handshakes = 0
+        self.connect_seconds = 0.0
+        self.tls_seconds = 0.0
+        self.http_versions = {}
+        self._lock = threading.Lock()
+
+    def _make_trace(self):
+        """Returns an httpcore trace callback for one request."""
+        started = {}
+
+        def trace(event_name, info):
+            # Events look like "connection.connect_tcp.started" / ".complete"
+            step, _, phase = event_name.rpartition(".")
+            if phase == "started":
+                started[step] = time.monotonic()
+                return
+            if phase != "complete" or step not in started:
+                return
+
+            elapsed = time.monotonic() - started.pop(step)
+            with self._lock:
+                if step == "connection.connect_tcp":
+                    self.new_connections += 1
+                    self.connect_seconds += elapsed
+                elif step == "connection.start_tls":
+                    self.tls_handshakes += 1
+                    self.tls_seconds += elapsed
+
+        return trace
+
+    def on_request(self, request):
+        with self._lock:
+            self.requests += 1
+        request.extensions["trace"] = self._make_trace()
+
+    def on_response(self, response):
+        version = response.http_version
+        with self._lock:
+            self.http_versions[version] = self.http_versions.get(version, 0) + 1
+
+    async def on_request_async(self, request):
+        self.on_request(request)
+
+    async def on_response_async(self, response):
+        self.on_response(response)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused_requests": max(0, self.requests - self.new_connections),
+                "tls_handshakes": self.tls_handshakes,
+                "connect_seconds": round(self.connect_seconds, 3),
+                "tls_seconds": round(self.tls_seconds, 3),
+                "http_versions": dict(self.http_versions),
+            }
+
+    def summary(self) -> str:
+        data = self.to_dict()
+        versions = ", ".join(f"{v}: {n}" for v, n in sorted(data["http_versions"].items())) or "none"
+        return (
+            f"HTTP connections: {data['requests']} requests over {data['new_connections']} "
+            f"new connections ({data['reused_requests']} reused, {data['tls_handshakes']} TLS handshakes, "
+            f"{data['connect_seconds'] + data['tls_seconds']:.2f}s connecting; {versions})."
+        )
+
+
+def build_http_client(max_connections: int, stats: ConnectionStats = None, asynchronous: bool = False):
+    """
+    Builds an httpx client whose keep-alive pool holds max_connections
+    connections, with per-phase timeouts and, if enabled and available,
+    HTTP/2. Pass the result to openai.OpenAI(http_client=...).
+    """
+    max_connections = max(1, max_connections)
+    options = dict(
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_SECONDS,
+        ),
+        timeout=httpx.Timeout(
+            connect=HTTP_CONNECT_TIMEOUT_SECONDS,
+            read=HTTP_READ_TIMEOUT_SECONDS,
+            write=HTTP_WRITE_TIMEOUT_SECONDS,
+            pool=HTTP_POOL_TIMEOUT_SECONDS,
+        ),
+        http2=HTTP2_ENABLED,
+    )
+    if stats is not None:
+        if asynchronous:
+            options["event_hooks"] = {"request": [stats.on_request_async], "response": [stats.on_response_async]}
+        else:
+            options["event_hooks"] = {"request": [stats.on_request], "response": [stats.on_response]}
+
+    client_class = httpx.AsyncClient if asynchronous else httpx.Client
+    try:
+        return client_class(**options)
+    except ImportError as e:
+        # http2=True without the h2 package
+        print(f"Warning: HTTP/2 unavailable ({e}); falling back to HTTP/1.1.", file=sys.stderr)
+        options["http2"] = False
+        return client_class(**options)
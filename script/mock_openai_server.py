@@ -0,0 +1,491 @@
+# script/mock_openai_server.py
+#
+# Local stand-in for the OpenAI chat-completions endpoint (plus the files and
+# batches endpoints used by batch mode), used to exercise gpt_review.py
+# without spending real tokens.
+#
+# Usage:
+#   python script/mock_openai_server.py --port 8089 --latency 1.5 \
+#       --rate-limit-rate 0.1 --server-error-rate 0.05 [--tpm-limit 60000]
+#   OPENAI_BASE_URL=http://127.0.0.1:8089/v1 OPENAI_API_KEY=test \
+#       DIFF_FILE=some.diff python script/gpt_review.py
+#
+# Two-tier runs (REVIEW_TRIAGE_MODEL): --model-latency mini=0.2 gives the
+# triage model its own latency, and --triage-flag-rate sets the share of
+# chunks it escalates.
+import argparse
+import email.policy
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    server_version = "MockOpenAI/1.0"
+    # Keep-alive, like the real API, so client connection reuse can be measured
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, payload: dict, headers: dict = None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _not_found(self):
+        self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        path = self.path.rstrip("/")
+        if path.endswith("/chat/completions"):
+            self._chat_completions(self._read_json())
+        elif path.endswith("/files"):
+            self._upload_file()
+        elif path.endswith("/batches"):
+            self._create_batch(self._read_json())
+        else:
+            self._not_found()
+
+    def do_GET(self):
+        parts = self.path.rstrip("/").split("/")
+        if parts[-1] == "models":
+            self._send_json(200, {"object": "list", "data": [
+                {"id": "mock-model", "object": "model", "created": 0, "owned_by": "mock"},
+            ]})
+        elif len(parts) >= 2 and parts[-2] == "batches":
+            batch = self.server.batches.get(parts[-1])
+            if batch is None:
+                return self._not_found()
+            with self.server.stats_lock:
+                self._send_json(200, dict(batch))
+        elif len(parts) >= 3 and parts[-3] == "files" and parts[-1] == "content":
+            stored = self.server.files.get(parts[-2])
+            if stored is None:
+                return self._not_found()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(stored["content"])))
+            self.end_headers()
+            self.wfile.write(stored["content"])
+        else:
+            self._not_found()
+
+    def _upload_file(self):
+        """Accepts the multipart upload the SDK sends to /files."""
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        message = BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode("latin-1") + body
+        )
+
+        fields = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            fields[name] = (part.get_filename(), part.get_payload(decode=True) or b"")
+
+        filename, content = fields.get("file", ("upload.jsonl", b""))
+        purpose = (fields.get("purpose") or (None, b"batch"))[1].decode("utf-8")
+        self._send_json(200, self.server.store_file(content, filename or "upload.jsonl", purpose))
+
+    def _create_batch(self, request: dict):
+        if request.get("input_file_id") not in self.server.files:
+            self._send_json(400, {"error": {"message": "Unknown input_file_id (mock).", "type": "invalid_request_error"}})
+            return
+        self._send_json(200, self.server.start_batch(request))
+
+    def _chat_completions(self, request: dict):
+        with self.server.stats_lock:
+            self.server.stats["requests"] += 1
+            self.server.stats["in_flight"] += 1
+            self.server.stats["max_in_flight"] = max(
+                self.server.stats["max_in_flight"], self.server.stats["in_flight"]
+            )
+
+        try:
+            time.sleep(self.server.latency_for(request.get("model")))
+
+            if self.server.insufficient_quota:
+                self._send_json(
+                    429,
+                    {"error": {
+                        "message": "You exceeded your current quota, please check your plan and billing details (mock).",
+                        "type": "insufficient_quota",
+                        "code": "insufficient_quota",
+                    }},
+                )
+                return
+
+            payload = self.server.completion_payload(request)
+            usage = payload["usage"]
+
+            quota_wait, quota_headers = self.server.take_quota(usage["total_tokens"])
+            if quota_wait is not None:
+                self._send_json(
+                    429,
+                    {"error": {
+                        "message": "Rate limit reached for tokens per min (mock quota).",
+                        "type": "tokens",
+                        "code": "rate_limit_exceeded",
+                    }},
+                    headers={"retry-after": f"{max(1, round(quota_wait))}", **quota_headers},
+                )
+                return
+
+            failure = self.server.pick_failure()
+            if failure == "rate_limit":
+                self._send_json(
+                    429,
+                    {"error": {
+                        "message": "Rate limit reached for requests (mock).",
+                        "type": "requests",
+                        "code": "rate_limit_exceeded",
+                    }},
+                    headers={
+                        "retry-after": f"{self.server.retry_after:g}",
+                        "x-ratelimit-reset-tokens": f"{self.server.retry_after:g}s",
+                        **quota_headers,
+                    },
+                )
+                return
+            if failure == "server_error":
+                self._send_json(
+                    503,
+                    {"error": {"message": "The server is overloaded (mock).", "type": "server_error"}},
+                    headers=quota_headers,
+                )
+                return
+
+            self.server.count_usage(usage)
+            self._send_json(200, payload, headers=quota_headers)
+        finally:
+            with self.server.stats_lock:
+                self.server.stats["in_flight"] -= 1
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        latency: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        server_error_rate: float = 0.0,
+        retry_after: float = 1.0,
+        seed: int = None,
+        verbose: bool = False,
+        tpm_limit: int = None,
+        rpm_limit: int = None,
+        batch_delay: float = 1.0,
+        model_latency: dict = None,
+        triage_flag_rate: float = 0.3,
+        insufficient_quota: bool = False,
+    ):
+        super().__init__(address, MockOpenAIHandler)
+        self.latency = latency
+        # Model name -> latency, overriding `latency` (e.g. a fast triage model)
+        self.model_latency = dict(model_latency or {})
+        # Share of triage requests answered "VERDICT: REVIEW"
+        self.triage_flag_rate = triage_flag_rate
+        # Answer every chat call with the billing 429 that retrying cannot fix
+        self.insufficient_quota = insufficient_quota
+        # Seconds a batch stays in_progress before its results are written
+        self.batch_delay = batch_delay
+        self.files = {}
+        self.batches = {}
+        # Optional per-minute quota, enforced with 429s and reported in x-ratelimit-* headers
+        self.tpm_limit = tpm_limit
+        self.rpm_limit = rpm_limit or (500 if tpm_limit else None)
+        self._quota_tokens = float(tpm_limit or 0)
+        self._quota_requests = float(self.rpm_limit or 0)
+        self._quota_updated = time.monotonic()
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.retry_after = retry_after
+        self.verbose = verbose
+        self.rng = random.Random(seed)
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "in_flight": 0,
+            "max_in_flight": 0,
+            "rate_limited": 0,
+            "server_errors": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "batches": 0,
+        }
+
+    def latency_for(self, model: str) -> float:
+        return self.model_latency.get(model, self.latency)
+
+    def triage_verdict(self, messages) -> str:
+        """
+        Answer to a triage prompt. Whether a chunk is escalated depends only
+        on its content, so baseline and two-tier runs see the same split.
+        """
+        chunk = "".join(m.get("content") or "" for m in messages if m.get("role") != "system")
+        bucket = int.from_bytes(hashlib.sha256(chunk.encode("utf-8")).digest()[:4], "big") / 2**32
+        if bucket < self.triage_flag_rate:
+            return "VERDICT: REVIEW\nChanges control flow; worth a closer look (mock)."
+        return "VERDICT: OK\nRoutine change with nothing notable (mock)."
+
+    def completion_payload(self, request: dict) -> dict:
+        """Builds a chat.completion body for a request, honouring max_completion_tokens."""
+        messages = request.get("messages", [])
+        prompt_chars = sum(len(m.get("content") or "") for m in messages)
+        prompt_tokens = max(1, prompt_chars // 4)
+        system_prompt = "".join(m.get("content") or "" for m in messages if m.get("role") == "system")
+        if "VERDICT:" in system_prompt:
+            content = self.triage_verdict(messages)
+        else:
+            content = (
+                f"Mock review of {prompt_chars} characters: no issues found in this chunk."
+            )
+        completion_tokens = max(1, len(content) // 4)
+        finish_reason = "stop"
+        max_completion_tokens = request.get("max_completion_tokens") or request.get("max_tokens")
+        if max_completion_tokens and completion_tokens > max_completion_tokens:
+            content = content[: max_completion_tokens * 4]
+            completion_tokens = max_completion_tokens
+            finish_reason = "length"
+
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": finish_reason,
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def count_usage(self, usage: dict):
+        with self.stats_lock:
+            self.stats["prompt_tokens"] += usage["prompt_tokens"]
+            self.stats["completion_tokens"] += usage["completion_tokens"]
+
+    def store_file(self, content: bytes, filename: str, purpose: str) -> dict:
+        file_object = {
+            "id": f"file-{uuid.uuid4().hex}",
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+        with self.stats_lock:
+            self.files[file_object["id"]] = {**file_object, "content": content}
+        return file_object
+
+    def start_batch(self, request: dict) -> dict:
+        """Registers a batch and processes it on a background thread after batch_delay seconds."""
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}",
+            "object": "batch",
+            "endpoint": request.get("endpoint", "/v1/chat/completions"),
+            "input_file_id": request["input_file_id"],
+            "completion_window": request.get("completion_window", "24h"),
+            "status": "validating",
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None,
+            "metadata": request.get("metadata"),
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        with self.stats_lock:
+            self.batches[batch["id"]] = batch
+            self.stats["batches"] += 1
+        threading.Thread(target=self._process_batch, args=(batch["id"],), daemon=True).start()
+        return dict(batch)
+
+    def _process_batch(self, batch_id: str):
+        batch = self.batches[batch_id]
+        lines = [line for line in self.files[batch["input_file_id"]]["content"].splitlines() if line.strip()]
+        with self.stats_lock:
+            batch["status"] = "in_progress"
+            batch["request_counts"]["total"] = len(lines)
+        time.sleep(self.batch_delay)
+
+        output, errors = [], []
+        for line in lines:
+            item = json.loads(line)
+            if self.pick_failure() is not None:
+                errors.append({
+                    "id": f"batch_req_{uuid.uuid4().hex}",
+                    "custom_id": item["custom_id"],
+                    "response": None,
+                    "error": {"code": "server_error", "message": "The server is overloaded (mock)."},
+                })
+                counter = "failed"
+            else:
+                payload = self.completion_payload(item["body"])
+                self.count_usage(payload["usage"])
+                output.append({
+                    "id": f"batch_req_{uuid.uuid4().hex}",
+                    "custom_id": item["custom_id"],
+                    "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": payload},
+                    "error": None,
+                })
+                counter = "completed"
+            with self.stats_lock:
+                batch["request_counts"][counter] += 1
+
+        def to_jsonl(items):
+            return "".join(json.dumps(i) + "\n" for i in items).encode("utf-8")
+
+        output_file = self.store_file(to_jsonl(output), "batch_output.jsonl", "batch_output") if output else None
+        error_file = self.store_file(to_jsonl(errors), "batch_errors.jsonl", "batch_output") if errors else None
+        with self.stats_lock:
+            batch["output_file_id"] = output_file and output_file["id"]
+            batch["error_file_id"] = error_file and error_file["id"]
+            batch["status"] = "completed"
+            batch["completed_at"] = int(time.time())
+
+    def pick_failure(self):
+        """Returns "rate_limit", "server_error" or None for the current request."""
+        with self.stats_lock:
+            roll = self.rng.random()
+            if roll < self.rate_limit_rate:
+                self.stats["rate_limited"] += 1
+                return "rate_limit"
+            if roll < self.rate_limit_rate + self.server_error_rate:
+                self.stats["server_errors"] += 1
+                return "server_error"
+        return None
+
+    def take_quota(self, tokens: int):
+        """
+        Charges one request and `tokens` against the mock quota. Returns
+        (seconds until it would fit or None if it was charged, x-ratelimit headers).
+        """
+        if not self.tpm_limit:
+            return None, {}
+
+        with self.stats_lock:
+            now = time.monotonic()
+            elapsed = now - self._quota_updated
+            self._quota_updated = now
+            self._quota_tokens = min(self.tpm_limit, self._quota_tokens + elapsed * self.tpm_limit / 60.0)
+            self._quota_requests = min(self.rpm_limit, self._quota_requests + elapsed * self.rpm_limit / 60.0)
+
+            wait = max(
+                (tokens - self._quota_tokens) * 60.0 / self.tpm_limit,
+                (1 - self._quota_requests) * 60.0 / self.rpm_limit,
+            )
+            if wait <= 0:
+                self._quota_tokens -= tokens
+                self._quota_requests -= 1
+                wait = None
+            else:
+                self.stats["rate_limited"] += 1
+
+            headers = {
+                "x-ratelimit-limit-tokens": str(self.tpm_limit),
+                "x-ratelimit-limit-requests": str(self.rpm_limit),
+                "x-ratelimit-remaining-tokens": str(max(0, int(self._quota_tokens))),
+                "x-ratelimit-remaining-requests": str(max(0, int(self._quota_requests))),
+                "x-ratelimit-reset-tokens": f"{(self.tpm_limit - self._quota_tokens) * 60.0 / self.tpm_limit:.3f}s",
+                "x-ratelimit-reset-requests": f"{(self.rpm_limit - self._quota_requests) * 60.0 / self.rpm_limit:.3f}s",
+            }
+        return wait, headers
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+
+def start_mock_server(host: str = "127.0.0.1", port: int = 0, **options) -> MockOpenAIServer:
+    """Starts a mock server on a background thread; port 0 picks a free port."""
+    server = MockOpenAIServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of the OpenAI chat-completions API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds to wait before each response.")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of calls answered with 429.")
+    parser.add_argument("--server-error-rate", type=float, default=0.0, help="Fraction of calls answered with 503.")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="retry-after seconds sent with 429s.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for reproducible failure injection.")
+    parser.add_argument("--tpm-limit", type=int, default=None, help="Enforce and report a tokens-per-minute quota.")
+    parser.add_argument("--rpm-limit", type=int, default=None, help="Requests-per-minute quota (default 500 with --tpm-limit).")
+    parser.add_argument("--batch-delay", type=float, default=1.0, help="Seconds before a batch completes.")
+    parser.add_argument(
+        "--model-latency",
+        action="append",
+        default=[],
+        metavar="MODEL=SECONDS",
+        help="Latency for one model, overriding --latency (repeatable).",
+    )
+    parser.add_argument(
+        "--triage-flag-rate", type=float, default=0.3, help="Share of triage requests answered VERDICT: REVIEW."
+    )
+    parser.add_argument(
+        "--insufficient-quota", action="store_true", help="Answer every chat call with 429 insufficient_quota."
+    )
+    parser.add_argument("--verbose", action="store_true", help="Log every request.")
+    args = parser.parse_args()
+
+    model_latency = {}
+    for item in args.model_latency:
+        model, _, seconds = item.rpartition("=")
+        if not model:
+            parser.error(f"--model-latency expects MODEL=SECONDS, got {item!r}")
+        model_latency[model] = float(seconds)
+
+    server = MockOpenAIServer(
+        (args.host, args.port),
+        latency=args.latency,
+        rate_limit_rate=args.rate_limit_rate,
+        server_error_rate=args.server_error_rate,
+        retry_after=args.retry_after,
+        seed=args.seed,
+        verbose=args.verbose,
+        tpm_limit=args.tpm_limit,
+        rpm_limit=args.rpm_limit,
+        batch_delay=args.batch_delay,
+        model_latency=model_latency,
+        triage_flag_rate=args.triage_flag_rate,
+        insufficient_quota=args.insufficient_quota,
+    )
+    print(f"Mock OpenAI server listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Mock server stats: {json.dumps(server.stats)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+# script/review_worker.py
+#
+# Long-running review worker. Reviews many PRs from one process so that they
+# share a single token/request budget (TPM_LIMIT / RPM_LIMIT, synced with the
+# x-ratelimit-* headers) instead of each CI job throttling on its own view of
+# the quota. Chunks from concurrent jobs get budget round-robin by job, so one
+# large PR cannot starve the rest.
+#
+# Jobs live in a directory queue, one JSON file per job, moved between
+# pending/, running/, done/ and failed/ with atomic renames. Each job's
+# diff, review.txt and metrics.json are kept in jobs/<job id>/.
+#
+# Usage:
+#   python script/review_worker.py enqueue --queue-dir review-queue \
+#       --diff-file pr-123.diff [--labels-json '[{"name": "gpt-review-strict"}]'] [--job-id pr-123]
+#   python script/review_worker.py run --queue-dir review-queue [--max-jobs 4] [--once] [--requeue-running]
+#
+# The budget is shared within one worker process; run one worker per API key.
+# With REVIEW_TRIAGE_MODEL set, triage calls share a second budget
+# (TRIAGE_TPM_LIMIT / TRIAGE_RPM_LIMIT) the same way.
+# Point OPENAI_BASE_URL at mock_openai_server.py (e.g. with --tpm-limit) to
+# try it without spending tokens.
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+import uuid
+
+import openai
+
+import gpt_review
+from debug_openai_connection import preflight_check
+from http_client import ConnectionStats, build_http_client
+
+# --- Configuration ---
+WORKER_QUEUE_DIR = os.getenv("WORKER_QUEUE_DIR", "review-queue")
+WORKER_MAX_JOBS = int(os.getenv("WORKER_MAX_JOBS", "4"))  # PRs reviewed at the same time
+WORKER_POLL_SECONDS = float(os.getenv("WORKER_POLL_SECONDS", "2"))
+
+QUEUE_STATES = ("pending", "running", "done", "failed")
+
+
+class JobQueue:
+    """
+    Directory-backed FIFO of review jobs. Claiming a job is an atomic rename
+    from pending/ to running/, so several workers may poll the same queue.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        for state in QUEUE_STATES:
+            os.makedirs(os.path.join(root, state), exist_ok=True)
+        os.makedirs(os.path.join(root, "jobs"), exist_ok=True)
+
+    def _path(self, state: str, job_id: str) -> str:
+        return os.path.join(self.root, state, f"{job_id}.json")
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(self.root, "jobs", job_id)
+
+    def _write(self, state: str, job: dict):
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".job-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(job, f, indent=2)
+            os.replace(tmp_path, self._path(state, job["id"]))
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+            raise
+
+    def enqueue(self, diff_file: str, labels_json: str = None, job_id: str = None,
+                head_sha: str = None, state_file: str = None, output_file: str = None) -> dict:
+        """Copies the diff into the queue and adds a pending job for it."""
+        # Time-ordered ids keep pending/ in arrival order
+        job_id = job_id or f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        if any(os.path.exists(self._path(state, job_id)) for state in QUEUE_STATES):
+            raise ValueError(f"Job {job_id} already exists in {self.root}")
+
+        job_dir = self.job_dir(job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        queued_diff = os.path.join(job_dir, "pr.diff")
+        shutil.copyfile(diff_file, queued_diff)
+
+        job = {
+            "id": job_id,
+            "diff_file": queued_diff,
+            "labels_json": labels_json or "[]",
+            "head_sha": head_sha or "",
+            "state_file": state_file or "",
+            "output_file": output_file or os.path.join(job_dir, "review.txt"),
+            "enqueued_at": time.time(),
+        }
+        self._write("pending", job)
+        return job
+
+    def claim(self):
+        """Moves the oldest pending job to running/ and returns it, or None if the queue is empty."""
+        for name in sorted(os.listdir(os.path.join(self.root, "pending"))):
+            if not name.endswith(".json"):
+                continue
+            job_id = name[: -len(".json")]
+            running_path = self._path("running", job_id)
+            try:
+                os.rename(self._path("pending", job_id), running_path)
+            except FileNotFoundError:
+                continue  # Claimed by another worker
+            with open(running_path, encoding="utf-8") as f:
+                return json.load(f)
+        return None
+
+    def finish(self, job: dict, exit_code: int, error: str = None):
+        """Records the outcome and moves the job from running/ to done/ or failed/."""
+        job = dict(job, exit_code=exit_code, finished_at=time.time())
+        if error:
+            job["error"] = error
+        self._write("done" if exit_code == 0 else "failed", job)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self._path("running", job["id"]))
+
+    def requeue_running(self) -> int:
+        """Puts jobs left in running/ by a stopped worker back into pending/."""
+        requeued = 0
+        for name in os.listdir(os.path.join(self.root, "running")):
+            if name.endswith(".json"):
+                job_id = name[: -len(".json")]
+                with contextlib.suppress(FileNotFoundError):
+                    os.rename(self._path("running", job_id), self._path("pending", job_id))
+                    requeued += 1
+        return requeued
+
+
+def run_job(queue: JobQueue, job: dict, client, fair_limiter: gpt_review.FairShareLimiter,
+            fair_triage_limiter: gpt_review.FairShareLimiter = None) -> int:
+    """Reviews one claimed job and records its outcome in the queue."""
+    job_dir = queue.job_dir(job["id"])
+    review_job = gpt_review.ReviewJob(
+        diff_file=job["diff_file"],
+        labels_json=job.get("labels_json"),
+        output_file=job["output_file"],
+        metrics_file=os.path.join(job_dir, "metrics.json"),
+        state_file=job.get("state_file") or "",
+        head_sha=job.get("head_sha") or "",
+        batch_requests_file=os.path.join(job_dir, "batch_requests.jsonl"),
+    )
+
+    print(f"[{job['id']}] Started.")
+    start_time = time.time()
+    try:
+        with contextlib.ExitStack() as stack:
+            limiter = stack.enter_context(fair_limiter.job(job["id"]))
+            triage_limiter = None
+            if fair_triage_limiter is not None:
+                triage_limiter = stack.enter_context(fair_triage_limiter.job(job["id"]))
+            exit_code = gpt_review.review_job(review_job, client, limiter, start_time, triage_limiter=triage_limiter)
+    except Exception as e:
+        traceback.print_exc()
+        error_message = f"❌ GPT Review failed: unexpected worker error - {e}"
+        gpt_review.write_review_file(error_message, review_job.output_file)
+        queue.finish(job, 1, error=str(e))
+        print(f"[{job['id']}] Failed after {time.time() - start_time:.1f}s: {e}", file=sys.stderr)
+        return 1
+
+    queue.finish(job, exit_code)
+    print(f"[{job['id']}] Finished in {time.time() - start_time:.1f}s (exit {exit_code}); review in {review_job.output_file}.")
+    return exit_code
+
+
+def run_worker(queue: JobQueue, max_jobs: int, once: bool, poll_seconds: float, requeue: bool = False) -> int:
+    api_key = (gpt_review.api_key_from_env or "").strip()
+    if not api_key:
+        print("❌ Configuration Error: OPENAI_API_KEY secret not set.", file=sys.stderr)
+        return 1
+
+    if requeue:
+        requeued = queue.requeue_running()
+        print(f"Requeued {requeued} job(s) left running by an earlier worker.")
+
+    if gpt_review.REVIEW_PREFLIGHT_SECONDS > 0:
+        preflight_ok, preflight_message = preflight_check(
+            api_key, deadline_seconds=gpt_review.REVIEW_PREFLIGHT_SECONDS
+        )
+        print(f"Pre-flight: {preflight_message}")
+        if not preflight_ok:
+            # A worker outlives network blips; jobs report their own failures
+            print("⚠️ Starting anyway; jobs will fail until the API is reachable.", file=sys.stderr)
+
+    # One client and one budget for every job this worker runs
+    connection_stats = ConnectionStats()
+    client = openai.OpenAI(
+        api_key=api_key,
+        max_retries=0,
+        http_client=build_http_client(max_jobs * gpt_review.REVIEW_CONCURRENCY, connection_stats),
+    )
+    fair_limiter = gpt_review.FairShareLimiter(
+        gpt_review.TokenBucketLimiter(gpt_review.YOUR_TPM_LIMIT, gpt_review.YOUR_RPM_LIMIT)
+    )
+    fair_triage_limiter = None
+    if gpt_review.REVIEW_TRIAGE_MODEL:
+        fair_triage_limiter = gpt_review.FairShareLimiter(
+            gpt_review.TokenBucketLimiter(gpt_review.TRIAGE_TPM_LIMIT, gpt_review.TRIAGE_RPM_LIMIT)
+        )
+    print(
+        f"Worker polling {queue.root} with up to {max_jobs} jobs at a time "
+        f"(TPM_LIMIT={gpt_review.YOUR_TPM_LIMIT}, RPM_LIMIT={gpt_review.YOUR_RPM_LIMIT})."
+    )
+
+    failed_jobs = 0
+    active = {}
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="job")
+    try:
+        while True:
+            while len(active) < max_jobs:
+                job = queue.claim()
+                if job is None:
+                    break
+                active[executor.submit(run_job, queue, job, client, fair_limiter, fair_triage_limiter)] = job
+
+            if not active:
+                if once:
+                    break
+                time.sleep(poll_seconds)
+                continue
+
+            finished, _ = concurrent.futures.wait(
+                active, timeout=poll_seconds, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in finished:
+                del active[future]
+                failed_jobs += 1 if future.result() != 0 else 0
+    except KeyboardInterrupt:
+        print(f"Stopping; waiting for {len(active)} running job(s) to finish.", file=sys.stderr)
+    finally:
+        executor.shutdown(wait=True)
+
+    print(connection_stats.summary())
+    return 1 if once and failed_jobs else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Review many PRs against one shared OpenAI rate budget.")
+    parser.add_argument("--queue-dir", default=WORKER_QUEUE_DIR, help="Queue directory (default: WORKER_QUEUE_DIR).")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="Add a diff to the queue.")
+    enqueue_parser.add_argument("--diff-file", required=True)
+    enqueue_parser.add_argument("--labels-json", default=os.getenv("PR_LABELS_JSON"), help="PR labels as JSON (default: PR_LABELS_JSON).")
+    enqueue_parser.add_argument("--job-id", help="Job id, e.g. pr-123 (default: time-ordered random id).")
+    enqueue_parser.add_argument("--head-sha", help="Head commit, recorded with --state-file for incremental reviews.")
+    enqueue_parser.add_argument("--state-file", help="Review state file for incremental reviews of this PR.")
+    enqueue_parser.add_argument("--output-file", help="Where to write the review (default: jobs/<id>/review.txt).")
+
+    run_parser = subparsers.add_parser("run", help="Review queued jobs.")
+    run_parser.add_argument("--max-jobs", type=int, default=WORKER_MAX_JOBS, help="Jobs reviewed concurrently.")
+    run_parser.add_argument("--once", action="store_true", help="Exit once the queue is empty.")
+    run_parser.add_argument("--poll-seconds", type=float, default=WORKER_POLL_SECONDS)
+    run_parser.add_argument(
+        "--requeue-running",
+        action="store_true",
+        help="Move jobs left in running/ by a stopped worker back to pending/ first. "
+        "Only safe when no other worker uses the queue.",
+    )
+
+    args = parser.parse_args()
+    queue = JobQueue(args.queue_dir)
+
+    if args.command == "enqueue":
+        try:
+            job = queue.enqueue(
+                args.diff_file, args.labels_json, args.job_id, args.head_sha, args.state_file, args.output_file
+            )
+        except (OSError, ValueError) as e:
+            print(f"❌ Could not enqueue {args.diff_file}: {e}", file=sys.stderr)
+            sys.exit(1)
+        print(f"Queued job {job['id']}; review will be written to {job['output_file']}.")
+    else:
+        sys.exit(run_worker(queue, max(1, args.max_jobs), args.once, args.poll_seconds, args.requeue_running))
+
+
+if __name__ == "__main__":
+    main()
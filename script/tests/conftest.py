@@ -0,0 +1,59 @@
+import os
+import sys
+
+import pytest
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SCRIPT_DIR)
+
+# Keep the tokenizer cache out of the home directory while testing
+os.environ["TOKENIZER_CACHE_DIR"] = ""
+
+import gpt_review  # noqa: E402
+
+
+@pytest.fixture
+def char_tokens(monkeypatch):
+    """Counts tokens with the ~4 characters per token fallback, so results don't depend on tiktoken."""
+    monkeypatch.setattr(gpt_review, "get_encoding", lambda model_name: None)
+
+
+@pytest.fixture
+def byte_encoding(monkeypatch):
+    """
+    A small byte-level tiktoken encoding with a few merges, one of them
+    across a line break, so token attribution can be checked by hand.
+    """
+    tiktoken = pytest.importorskip("tiktoken")
+    mergeable_ranks = {bytes([byte]): byte for byte in range(256)}
+    mergeable_ranks[b"ab"] = 256
+    mergeable_ranks[b"\n+"] = 257
+    mergeable_ranks["é".encode("utf-8")] = 258
+    encoding = tiktoken.Encoding(
+        "test-bytes", pat_str=r"[\s\S]+", mergeable_ranks=mergeable_ranks, special_tokens={}
+    )
+    monkeypatch.setattr(gpt_review, "get_encoding", lambda model_name: encoding)
+    monkeypatch.setattr(
+        gpt_review, "get_token_byte_lengths", lambda model_name: gpt_review.TokenByteLengths(encoding)
+    )
+    return encoding
+
+
+def make_diff(files):
+    """
+    Builds a unified diff from {path: [hunk body lines, ...]}; each hunk body
+    is a list of "+", "-" or " " prefixed lines without line endings.
+    """
+    lines = []
+    for path, hunks in files.items():
+        lines.append(f"diff --git a/{path} b/{path}\n")
+        lines.append(f"--- a/{path}\n")
+        lines.append(f"+++ b/{path}\n")
+        start = 1
+        for body in hunks:
+            old_count = sum(1 for line in body if not line.startswith("+"))
+            new_count = sum(1 for line in body if not line.startswith("-"))
+            lines.append(f"@@ -{start},{old_count} +{start},{new_count} @@\n")
+            lines.extend(line + "\n" for line in body)
+            start += old_count + 10
+    return "".join(lines)
@@ -0,0 +1,65 @@
+import json
+import time
+import types
+
+import gpt_review
+
+
+class _FilesClient:
+    """Serves a batch output file's lines through client.files.content()."""
+
+    def __init__(self, lines):
+        self.files = self
+        self.lines = lines
+
+    def content(self, file_id):
+        return types.SimpleNamespace(text="\n".join(self.lines))
+
+
+def _result(index, body=None, status_code=200, error=None):
+    return json.dumps({
+        "custom_id": gpt_review.BatchReviewer.custom_id(index),
+        "response": {"status_code": status_code, "body": body},
+        "error": error,
+    })
+
+
+def _body(content, finish_reason="stop"):
+    return {
+        "choices": [{"message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}],
+        "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120},
+    }
+
+
+def _collect(lines, chunks):
+    reviewer = gpt_review.BatchReviewer(
+        _FilesClient(lines), gpt_review.DEFAULT_PROMPT_TEMPLATE, "default", time.time()
+    )
+    reviewer.results = [None] * chunks
+    reviewer._chunk_routes = {index: reviewer.routes["code"] for index in range(chunks)}
+    reviewer.collect(types.SimpleNamespace(output_file_id="file-out", error_file_id=None))
+    return reviewer
+
+
+def test_malformed_results_fail_only_their_chunk():
+    reviewer = _collect([
+        _result(0, _body("Looks fine.")),
+        _result(1, {"choices": []}),
+        _result(2, {"id": "no choices or usage"}),
+        _result(3, {"choices": [{"message": None}]}),
+        _result(4, {"choices": [{"message": {"content": "Cut"}, "finish_reason": "length"}]}),
+        _result(5, {"error": {"message": "model overloaded"}}, status_code=500),
+        "not json",
+        json.dumps(["not", "an", "object"]),
+        _result(6, _body("Also fine.")),
+    ], chunks=8)
+
+    results = reviewer.results
+    assert [result.succeeded if result else None for result in results] == [
+        True, False, False, False, True, False, True, None
+    ]
+    assert results[0].text == "Looks fine." and results[0].tokens_used == 120
+    assert results[1].text.endswith("result has no review message")
+    assert results[4].truncated
+    assert results[5].text.endswith("model overloaded")
+    assert reviewer.metrics.counters["batch_requests_failed"] == 4
@@ -0,0 +1,86 @@
+import collections
+import random
+
+import pytest
+
+import gpt_review
+from conftest import make_diff
+
+SAFE_MAX = 200
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(char_tokens, monkeypatch):
+    monkeypatch.setattr(gpt_review, "CHUNK_OVERHEAD_TOKENS", 0)
+    monkeypatch.setattr(gpt_review, "PACK_WINDOW_CHUNKS", 2)
+
+
+def _line(path, hunk, number, sign="+"):
+    # 40 characters with the newline: 10 tokens with the char fallback
+    return f"{sign}{path} h{hunk} l{number}".ljust(39, ".")
+
+
+def _random_diff(seed):
+    rng = random.Random(seed)
+    files = {}
+    for file_number in range(12):
+        path = f"src/f{file_number}.py"
+        files[path] = [
+            [_line(path, hunk, number, rng.choice("+- ")) for number in range(rng.randint(1, 14))]
+            for hunk in range(rng.randint(1, 4))
+        ]
+    return make_diff(files)
+
+
+def _chunks(diff):
+    diff_files = list(gpt_review.iter_diff_files(diff.splitlines(keepends=True)))
+    return diff_files, list(gpt_review.iter_chunks_from_files(diff_files, SAFE_MAX, "test-model"))
+
+
+def _body_lines(text):
+    return [
+        line for line in text.splitlines(keepends=True)
+        if not line.startswith(("diff --git ", "--- a/", "+++ b/", "@@"))
+    ]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_every_line_is_sent_exactly_once(seed):
+    diff = _random_diff(seed)
+    _, chunks = _chunks(diff)
+    sent = collections.Counter(line for chunk in chunks for line in _body_lines(chunk.text))
+    assert sent == collections.Counter(_body_lines(diff))
+    assert all(chunk.tokens <= SAFE_MAX for chunk in chunks)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_hunks_that_fit_are_never_split(seed):
+    diff_files, chunks = _chunks(_random_diff(seed))
+    for diff_file in diff_files:
+        header = "".join(diff_file.header_lines)
+        for hunk in diff_file.hunks:
+            text = "".join(hunk)
+            if (len(header) + len(text)) // 4 > SAFE_MAX:
+                continue
+            holding = [chunk for chunk in chunks if text in chunk.text]
+            assert len(holding) == 1
+            # The file header comes before the hunk in that chunk
+            assert holding[0].text.index(header) < holding[0].text.index(text)
+            assert gpt_review.hunk_fingerprint(diff_file.path, hunk) in holding[0].hunk_keys
+
+
+def test_oversized_hunk_is_split_with_repeated_headers():
+    path = "src/big.py"
+    body = [_line(path, 0, number) for number in range(50)]
+    diff = make_diff({path: [body]})
+    diff_files, chunks = _chunks(diff)
+
+    hunk_header = diff_files[0].hunks[0][0]
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert chunk.text.startswith("".join(diff_files[0].header_lines) + hunk_header)
+    assert [line for chunk in chunks for line in _body_lines(chunk.text)] == _body_lines(diff)
+    # Every piece is reviewed under the one hunk's key
+    key = gpt_review.hunk_fingerprint(path, diff_files[0].hunks[0])
+    assert all(chunk.hunk_keys == [key] for chunk in chunks)
+
@@ -0,0 +1,67 @@
+import gpt_review
+from conftest import make_diff
+
+
+def _filter(include="", exclude=gpt_review.REVIEW_EXCLUDE_GLOBS, max_file_chars=2000, max_line_chars=200):
+    return gpt_review.DiffFilter(
+        gpt_review._split_globs(include), gpt_review._split_globs(exclude), max_file_chars, max_line_chars
+    )
+
+
+def _kept(diff_filter, diff):
+    return [diff_file.path for diff_file in diff_filter.filter_files(diff.splitlines(keepends=True))]
+
+
+def test_default_excludes():
+    diff = make_diff({
+        path: [["+x"]]
+        for path in ("src/app.js", "package-lock.json", "web/yarn.lock", "dist/app.js", "api/users.json",
+                     "src/vendor.min.js", "assets/logo.png", "src/dist/helper.js")
+    })
+    diff_filter = _filter()
+    # Globs with "/" match the whole path; the others match the file name anywhere
+    assert _kept(diff_filter, diff) == ["src/app.js", "src/dist/helper.js"]
+    assert {skipped.reason for skipped in diff_filter.skipped} == {"excluded by pattern"}
+
+
+def test_include_globs():
+    diff = make_diff({"src/app.js": [["+x"]], "docs/readme.md": [["+x"]]})
+    diff_filter = _filter(include="src/*", exclude="")
+    assert _kept(diff_filter, diff) == ["src/app.js"]
+    assert [(skipped.path, skipped.reason) for skipped in diff_filter.skipped] == [
+        ("docs/readme.md", "not in include patterns")
+    ]
+
+
+def test_content_checks():
+    diff = make_diff({
+        "src/big.js": [[f"+line {number}" for number in range(300)]],
+        "src/bundle.js": [["+" + "x" * 300]],
+        "src/app.js": [["+x"]],
+    })
+    binary = (
+        "diff --git a/img.bin b/img.bin\n"
+        "index 1234567..89abcde 100644\n"
+        "Binary files a/img.bin and b/img.bin differ\n"
+    )
+    diff_filter = _filter(exclude="")
+    assert _kept(diff_filter, diff + binary) == ["src/app.js"]
+    assert [(skipped.path, skipped.reason) for skipped in diff_filter.skipped] == [
+        ("src/big.js", "diff larger than 1 KB"),
+        ("src/bundle.js", "minified or generated content"),
+        ("img.bin", "binary file"),
+    ]
+
+
+def test_skipped_files_are_measured_not_kept():
+    lockfile = make_diff({"package-lock.json": [[f'+  "dep{number}": "1.0.0",' for number in range(100)]]})
+    diff_files = list(gpt_review.iter_diff_files(
+        lockfile.splitlines(keepends=True), _filter().skip_reason_for_path
+    ))
+    assert diff_files[0].hunks == []
+    assert diff_files[0].size == len(lockfile)
+
+    diff_filter = _filter()
+    _kept(diff_filter, lockfile)
+    assert diff_filter.skipped[0].estimated_tokens == len(lockfile) // 4
+    assert diff_filter.skipped_summary().startswith("--- Skipped 1 file(s) without review")
@@ -0,0 +1,99 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import SCRIPT_DIR, make_diff
+from mock_openai_server import start_mock_server
+
+# The review scripts run against the mock server through the OpenAI client
+pytest.importorskip("openai")
+pytest.importorskip("httpx")
+
+
+@pytest.fixture
+def mock_server():
+    server = start_mock_server(latency=0.05, batch_delay=0.2, seed=1)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def review_env(tmp_path, mock_server):
+    diff_file = tmp_path / "pr.diff"
+    diff_file.write_text(make_diff({
+        f"src/module{number}.js": [
+            [f"+export const value{number}_{line} = {line};" for line in range(20)],
+            [" function f() {", f"-  return {number};", f"+  return {number + 1};", " }"],
+        ]
+        for number in range(6)
+    }))
+    env = dict(
+        os.environ,
+        OPENAI_BASE_URL=mock_server.base_url,
+        OPENAI_API_KEY="test-key",
+        DIFF_FILE=str(diff_file),
+        REVIEW_OUTPUT_FILE=str(tmp_path / "review.txt"),
+        REVIEW_METRICS_FILE=str(tmp_path / "metrics.json"),
+        REVIEW_CACHE_DIR="",
+        TOKENIZER_CACHE_DIR="",
+        REVIEW_PREFLIGHT_SECONDS="0",
+        ESTIMATED_CALL_SECONDS="1",
+        MAX_SCRIPT_DURATION_SECONDS="120",
+        # Several chunks from a small diff
+        MAX_CHUNK_INPUT_TOKENS="600",
+        BATCH_POLL_INTERVAL_SECONDS="0.1",
+        BATCH_REQUESTS_FILE=str(tmp_path / "batch_requests.jsonl"),
+    )
+    return env
+
+
+def _run(script, *args, env, cwd):
+    result = subprocess.run(
+        [sys.executable, os.path.join(SCRIPT_DIR, script), *args],
+        env=env, cwd=cwd, capture_output=True, text=True, timeout=120,
+    )
+    assert result.returncode == 0, result.stdout[-2000:] + result.stderr[-2000:]
+    return result
+
+
+def _check_review(review_file, metrics_file):
+    with open(review_file, encoding="utf-8") as f:
+        review = f.read()
+    with open(metrics_file, encoding="utf-8") as f:
+        counters = json.load(f)["counters"]
+    assert counters["chunks_total"] > 1
+    assert counters["chunks_reviewed"] == counters["chunks_total"]
+    assert counters["chunks_failed"] == 0
+    assert "Mock review" in review
+    assert "❌" not in review
+
+
+def test_sync_review(review_env, tmp_path):
+    _run("gpt_review.py", env=review_env, cwd=tmp_path)
+    _check_review(review_env["REVIEW_OUTPUT_FILE"], review_env["REVIEW_METRICS_FILE"])
+
+
+
+def test_batch_review(review_env, tmp_path):
+    review_env["REVIEW_EXECUTION_MODE"] = "batch"
+    _run("gpt_review.py", env=review_env, cwd=tmp_path)
+    _check_review(review_env["REVIEW_OUTPUT_FILE"], review_env["REVIEW_METRICS_FILE"])
+    assert os.path.exists(review_env["BATCH_REQUESTS_FILE"])
+
+
+def test_worker(review_env, tmp_path):
+    worker = ["review_worker.py", "--queue-dir", str(tmp_path / "queue")]
+    for job_id in ("pr-1", "pr-2"):
+        _run(*worker, "enqueue", "--diff-file", review_env["DIFF_FILE"], "--job-id", job_id,
+             env=review_env, cwd=tmp_path)
+    _run(*worker, "run", "--once", "--max-jobs", "2", env=review_env, cwd=tmp_path)
+
+    for job_id in ("pr-1", "pr-2"):
+        assert (tmp_path / "queue" / "done" / f"{job_id}.json").exists()
+        job_dir = tmp_path / "queue" / "jobs" / job_id
+        _check_review(job_dir / "review.txt", job_dir / "metrics.json")
+    assert os.listdir(tmp_path / "queue" / "failed") == []
@@ -0,0 +1,119 @@
+import gpt_review
+
+
+def test_list_review_drops_lead_in_and_sign_off():
+    review = (
+        "Here are my comments:\n"
+        "\n"
+        "1. `load()` swallows the error from `fetch`.\n"
+        "2. The loop re-renders on every tick.\n"
+        "   Memoise the list instead.\n"
+        "\n"
+        "Otherwise the change looks good."
+    )
+    assert gpt_review.split_findings(review) == [
+        "1. `load()` swallows the error from `fetch`.",
+        "2. The loop re-renders on every tick.\n   Memoise the list instead.",
+    ]
+
+
+def test_headed_sections_are_kept_next_to_a_list():
+    review = (
+        "### Security\n"
+        "The auth token is stored in localStorage, where any XSS can read it.\n"
+        "\n"
+        "### Style\n"
+        "\n"
+        "- Rename `tmp` to `pending`.\n"
+        "- Drop the unused import."
+    )
+    assert gpt_review.split_findings(review) == [
+        "### Security\nThe auth token is stored in localStorage, where any XSS can read it.",
+        "- Rename `tmp` to `pending`.",
+        "- Drop the unused import.",
+    ]
+
+
+def test_heading_keeps_the_paragraph_after_a_blank_line():
+    review = "## Bug\n\nThe retry count is never reset."
+    assert gpt_review.split_findings(review) == ["## Bug\nThe retry count is never reset."]
+
+
+def test_paragraph_after_a_list_item_explains_it():
+    review = (
+        "1. `parse()` returns undefined for empty input.\n"
+        "\n"
+        "Callers index into the result, so this throws.\n"
+        "\n"
+        "```js\n"
+        "\n"
+        "parse('')[0]\n"
+        "```\n"
+        "2. Use `const` here."
+    )
+    assert gpt_review.split_findings(review) == [
+        "1. `parse()` returns undefined for empty input.\n"
+        "Callers index into the result, so this throws.\n"
+        "```js\nparse('')[0]\n```",
+        "2. Use `const` here.",
+    ]
+
+
+def test_paragraph_review():
+    review = (
+        "The new cache is never invalidated, so stale data is served after an update.\n"
+        "\n"
+        "Consider naming the flag `isReady`."
+    )
+    assert gpt_review.split_findings(review) == [
+        "The new cache is never invalidated, so stale data is served after an update.",
+        "Consider naming the flag `isReady`.",
+    ]
+
+
+def test_single_remark_is_kept():
+    assert gpt_review.split_findings("Looks good to me.") == ["Looks good to me."]
+
+
+def _review(index, text, **kwargs):
+    return gpt_review.ChunkReview(index, text, kwargs.pop("succeeded", True), **kwargs)
+
+
+def test_cluster_findings_merges_duplicates_across_chunks():
+    chunk_paths = [["src/a.js"], ["src/b.js"], ["src/c.js"]]
+    reviews = [
+        _review(0, "- Missing error handling when the request to the server fails in a.js."),
+        _review(1, "- Missing error handling when the request to the server fails in b.js.\n"
+                   "- Rename `x` to something clearer."),
+        _review(2, "- SQL injection: the query in c.js concatenates user input."),
+    ]
+    clusters = gpt_review.cluster_findings(reviews, chunk_paths, similarity=0.6)
+
+    assert [len(cluster.findings) for cluster in clusters] == [1, 2, 1]
+    # Ranked by severity, then by how many chunks raised the finding
+    assert clusters[0].findings[0].text.startswith("SQL injection")
+    assert clusters[0].severity == 3
+    assert clusters[1].paths == ["src/a.js", "src/b.js"]
+    assert [finding.chunk_no for finding in clusters[1].findings] == [1, 2]
+    assert clusters[2].representative.text == "Rename `x` to something clearer."
+    assert clusters[2].severity == 0
+
+
+def test_cluster_findings_attributes_paths():
+    chunk_paths = [["src/a.js", "src/util/b.js"]]
+    reviews = [_review(0, "- In b.js the timer leaks.\n- Add a changelog entry.")]
+    clusters = gpt_review.cluster_findings(reviews, chunk_paths, similarity=0.6)
+    assert {cluster.findings[0].text: cluster.findings[0].path for cluster in clusters} == {
+        "In b.js the timer leaks.": "src/util/b.js",
+        "Add a changelog entry.": "",
+    }
+
+
+def test_cluster_findings_skips_failed_and_cleared_reviews():
+    chunk_paths = [["a.js"], ["b.js"], ["c.js"]]
+    reviews = [
+        _review(0, "❌ Chunk failed", succeeded=False),
+        _review(1, "Nothing to review.", cleared_by_triage=True),
+        None,
+    ]
+    assert gpt_review.cluster_findings(reviews, chunk_paths, similarity=0.6) == []
@@ -0,0 +1,72 @@
+import threading
+import time
+
+import gpt_review
+
+# 100 tokens per second, so a 10-token call waits 0.1s on an empty bucket
+TPM = 6000
+
+
+def _drained_limiter():
+    limiter = gpt_review.TokenBucketLimiter(TPM, 100000)
+    assert limiter.acquire(TPM, max_wait=0) is not None
+    return limiter
+
+
+def _run_in_order(callers, stagger: float = 0.01):
+    """Starts each (name, acquire) caller in turn and returns the names in the order they got budget."""
+    granted = []
+    lock = threading.Lock()
+
+    def call(name, acquire):
+        if acquire() is not None:
+            with lock:
+                granted.append(name)
+
+    threads = []
+    for name, acquire in callers:
+        thread = threading.Thread(target=call, args=(name, acquire))
+        thread.start()
+        threads.append(thread)
+        time.sleep(stagger)
+    for thread in threads:
+        thread.join()
+    return granted
+
+
+def test_token_bucket_grants_in_arrival_order():
+    limiter = _drained_limiter()
+    callers = [(number, lambda: limiter.acquire(10, max_wait=5)) for number in range(5)]
+    assert _run_in_order(callers) == list(range(5))
+
+
+def test_token_bucket_gives_up_past_max_wait():
+    limiter = _drained_limiter()
+    start = time.monotonic()
+    assert limiter.acquire(100, max_wait=0.1) is None
+    assert time.monotonic() - start < 0.5
+
+
+def test_settle_returns_unused_tokens():
+    limiter = _drained_limiter()
+    limiter.settle(TPM, 0)
+    assert limiter.acquire(TPM // 2, max_wait=0) is not None
+
+
+def test_fair_share_serves_jobs_round_robin():
+    shared = gpt_review.FairShareLimiter(_drained_limiter())
+    with shared.job("big") as big, shared.job("small") as small:
+        callers = [(f"big{number}", lambda: big.acquire(10, max_wait=5)) for number in range(4)]
+        callers.append(("small0", lambda: small.acquire(10, max_wait=5)))
+        granted = _run_in_order(callers)
+    # The small job's only call goes right after the big job's first one,
+    # not behind its whole backlog
+    assert granted == ["big0", "small0", "big1", "big2", "big3"]
+
+
+def test_fair_share_splits_budget_between_active_jobs():
+    shared = gpt_review.FairShareLimiter(gpt_review.TokenBucketLimiter(TPM, 100000))
+    with shared.job("a") as a:
+        assert a.tpm_limit == TPM
+        with shared.job("b"):
+            assert a.tpm_limit == TPM / 2
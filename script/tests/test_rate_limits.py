@@ -0,0 +1,118 @@
+import email.utils
+import time
+import types
+
+import pytest
+
+import gpt_review
+
+TPM = 10000
+
+
+@pytest.mark.parametrize("value, seconds", [
+    ("1s", 1.0),
+    ("250ms", 0.25),
+    ("6m0s", 360.0),
+    ("1h2m3.5s", 3723.5),
+    ("", None),
+    (None, None),
+    ("soon", None),
+])
+def test_parse_reset_duration(value, seconds):
+    assert gpt_review.parse_reset_duration(value) == seconds
+
+
+def test_get_retry_after_seconds():
+    assert gpt_review.get_retry_after_seconds(None) is None
+    assert gpt_review.get_retry_after_seconds({}) is None
+    assert gpt_review.get_retry_after_seconds({"retry-after-ms": "1500", "retry-after": "9"}) == 1.5
+    assert gpt_review.get_retry_after_seconds({"retry-after-ms": "x", "retry-after": "9"}) == 9.0
+    assert gpt_review.get_retry_after_seconds({"x-ratelimit-reset-tokens": "2m"}) == 120.0
+
+    in_a_minute = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert gpt_review.get_retry_after_seconds({"retry-after": in_a_minute}) == pytest.approx(60, abs=2)
+
+
+def _error_with_headers(headers):
+    return Exception("rate limited") if headers is None else types.SimpleNamespace(
+        response=types.SimpleNamespace(headers=headers)
+    )
+
+
+def test_retry_delay_honours_long_server_waits(monkeypatch):
+    monkeypatch.setattr(gpt_review, "RETRY_MAX_DELAY_SECONDS", 60)
+    delay = gpt_review.compute_retry_delay(_error_with_headers({"retry-after": "90"}), attempt=0)
+    assert 90 <= delay <= 90 + gpt_review.RETRY_BASE_DELAY_SECONDS
+
+
+def test_retry_backoff_is_capped(monkeypatch):
+    monkeypatch.setattr(gpt_review, "RETRY_BASE_DELAY_SECONDS", 2)
+    monkeypatch.setattr(gpt_review, "RETRY_MAX_DELAY_SECONDS", 60)
+    assert 1 <= gpt_review.compute_retry_delay(_error_with_headers(None), attempt=0) <= 2
+    assert 8 <= gpt_review.compute_retry_delay(_error_with_headers(None), attempt=3) <= 16
+    assert 30 <= gpt_review.compute_retry_delay(_error_with_headers(None), attempt=10) <= 60
+
+
+def test_observe_headers_replaces_the_local_budget():
+    limiter = gpt_review.TokenBucketLimiter(TPM, 100)
+    observed = limiter.observe_headers({
+        "x-ratelimit-limit-tokens": "20000",
+        "x-ratelimit-limit-requests": "50",
+        "x-ratelimit-remaining-tokens": "1200",
+        "x-ratelimit-remaining-requests": "7",
+        "x-ratelimit-reset-tokens": "6m0s",
+        "x-ratelimit-reset-requests": "not a duration",
+    })
+    assert observed == {
+        "limit-tokens": 20000,
+        "limit-requests": 50,
+        "remaining-tokens": 1200,
+        "remaining-requests": 7,
+        "reset-tokens": 360.0,
+    }
+    assert (limiter.tpm_limit, limiter.rpm_limit) == (20000, 50)
+    assert limiter._tokens == pytest.approx(1200, abs=5)
+    assert limiter._requests == pytest.approx(7, abs=0.1)
+
+
+def test_observe_headers_without_rate_limit_headers():
+    limiter = gpt_review.TokenBucketLimiter(TPM, 100)
+    assert limiter.observe_headers(None) is None
+    assert limiter.observe_headers({"content-type": "application/json"}) is None
+    assert limiter.tpm_limit == TPM
+
+
+class _RaisingClient:
+    """Stands in for the OpenAI client; every chat call raises `error`."""
+
+    def __init__(self, error):
+        self.chat = self
+        self.completions = self
+        self.with_raw_response = self
+        self.error = error
+
+    def create(self, **kwargs):
+        raise self.error
+
+
+def _status_error(error_type, status_code, headers):
+    httpx = pytest.importorskip("httpx")
+    request = httpx.Request("POST", "https://api.example.test/v1/chat/completions")
+    response = httpx.Response(status_code, headers=headers, request=request)
+    return error_type(f"Error code: {status_code}", response=response, body=None)
+
+
+@pytest.mark.parametrize("error_type, status_code", [("RateLimitError", 429), ("InternalServerError", 500)])
+def test_failed_call_keeps_the_servers_remaining_budget(error_type, status_code):
+    openai = pytest.importorskip("openai")
+    error = _status_error(getattr(openai, error_type), status_code, {"x-ratelimit-remaining-tokens": "0"})
+    limiter = gpt_review.TokenBucketLimiter(TPM, 100)
+    reviewer = gpt_review.ChunkReviewer(
+        _RaisingClient(error), limiter, gpt_review.DEFAULT_PROMPT_TEMPLATE, "default", time.time()
+    )
+
+    chunk_review = reviewer.review(0, "diff --git a/a.js b/a.js\n@@ -1 +1 @@\n-a\n+b\n")
+
+    assert not chunk_review.succeeded and chunk_review.retry_delay is not None
+    # The reservation went back before the server's "0 remaining" was applied
+    assert limiter._tokens < 100
@@ -0,0 +1,68 @@
+import time
+
+import pytest
+
+import gpt_review
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return gpt_review.ReviewCache(str(tmp_path / "cache"), max_age_days=1, max_bytes=10 ** 6)
+
+
+def test_key_covers_chunk_model_and_prompt():
+    key = gpt_review.ReviewCache.make_key("chunk", "model", "prompt")
+    assert key == gpt_review.ReviewCache.make_key("chunk", "model", "prompt")
+    assert key != gpt_review.ReviewCache.make_key("chunk", "other-model", "prompt")
+    assert key != gpt_review.ReviewCache.make_key("chunk", "model", "other prompt")
+    # Parts are length-prefixed, so moving text between them changes the key
+    assert gpt_review.ReviewCache.make_key("ab", "c", "") != gpt_review.ReviewCache.make_key("a", "bc", "")
+
+
+def test_hits_and_misses_are_counted_apart_for_triage(cache):
+    key = gpt_review.ReviewCache.make_key("chunk", "model", "prompt")
+    assert cache.get(key) is None
+    cache.put(key, "Looks fine.", "model", "default")
+    assert cache.get(key) == "Looks fine."
+    assert cache.get(key, triage=True) == "Looks fine."
+    assert cache.get("0" * 64, triage=True) is None
+
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert (cache.triage_hits, cache.triage_misses) == (1, 1)
+
+
+def test_expired_entries_miss(cache, monkeypatch):
+    key = gpt_review.ReviewCache.make_key("chunk", "model", "prompt")
+    cache.put(key, "Looks fine.", "model", "default")
+    monkeypatch.setattr(time, "time", lambda: 2 * 86400 + gpt_review.os.path.getmtime(cache._path(key)))
+    assert cache.get(key) is None
+
+
+class _FailingClient:
+    """Stands in for the OpenAI client; every chat call fails to connect."""
+
+    def __init__(self):
+        self.chat = self
+        self.completions = self
+        self.with_raw_response = self
+
+    def create(self, **kwargs):
+        httpx = pytest.importorskip("httpx")
+        openai = pytest.importorskip("openai")
+        raise openai.APIConnectionError(request=httpx.Request("POST", "https://api.example.test/v1"))
+
+
+def test_retries_do_not_count_as_more_misses(cache):
+    pytest.importorskip("openai")
+    reviewer = gpt_review.ChunkReviewer(
+        _FailingClient(),
+        gpt_review.TokenBucketLimiter(10 ** 6, 1000),
+        gpt_review.DEFAULT_PROMPT_TEMPLATE,
+        "default",
+        time.time(),
+        cache=cache,
+    )
+    for attempt in range(3):
+        chunk_review = reviewer.review(0, "diff --git a/a.js b/a.js\n", attempt)
+        assert chunk_review.retry_delay is not None
+    assert (cache.hits, cache.misses) == (0, 1)
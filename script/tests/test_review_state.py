@@ -0,0 +1,99 @@
+import pytest
+
+import gpt_review
+from conftest import make_diff
+
+PROMPT_KEY = "code=test-model"
+
+
+@pytest.fixture(autouse=True)
+def hunk_per_chunk(char_tokens, monkeypatch):
+    # Each test hunk (~130 tokens with its file header) gets a chunk of its own
+    monkeypatch.setattr(gpt_review, "CHUNK_OVERHEAD_TOKENS", 0)
+
+
+def _body(name, sign="+"):
+    return [f"{sign}{name} line {number}".ljust(39, ".") for number in range(10)]
+
+
+def _files(diff):
+    return list(gpt_review.iter_diff_files(diff.splitlines(keepends=True)))
+
+
+def _review(state_path, diff, prompt_key=PROMPT_KEY):
+    """Runs one push through a ReviewState: returns it with the hunks left to review and their chunks."""
+    state = gpt_review.ReviewState(str(state_path), prompt_key)
+    state.load()
+    pending = list(state.pending_files(_files(diff)))
+    chunks = list(state.track_chunks(gpt_review.iter_chunks_from_files(pending, 200, "test-model")))
+    return state, pending, chunks
+
+
+def _pending_hunks(pending):
+    return [(diff_file.path, hunk[1]) for diff_file in pending for hunk in diff_file.hunks]
+
+
+@pytest.fixture
+def first_push(tmp_path):
+    diff = make_diff({"a.py": [_body("a1"), _body("a2")], "b.py": [_body("b1")]})
+    state_path = tmp_path / "state.json"
+    state, pending, chunks = _review(state_path, diff)
+    assert len(chunks) == 3
+    state.save("1111111aaaa", [
+        gpt_review.ChunkReview(index, f"Review of {', '.join(chunk.paths)} #{index}", True)
+        for index, chunk in enumerate(chunks)
+    ])
+    return state_path, diff
+
+
+def test_unchanged_hunks_are_carried_forward(first_push):
+    state_path, diff = first_push
+    # Edits elsewhere moved every hunk; only c.py is new
+    moved = diff.replace("@@ -1,", "@@ -7,").replace("+1,", "+9,")
+    second = moved + make_diff({"c.py": [_body("c1")]})
+
+    state, pending, chunks = _review(state_path, second)
+    assert [diff_file.path for diff_file in pending] == ["c.py"]
+    assert state.carried_hunks == 3
+    assert state.previous_sha == "1111111aaaa"
+    assert [complete for _, complete in state.carried_forward()] == [True, True, True]
+
+    rendered = state.render_carried_forward()
+    assert "3 earlier review(s) carried forward for 3 unchanged hunk(s)" in rendered
+    assert "Carried forward from 1111111 (a.py)" in rendered
+    assert "Review of b.py #2" in rendered
+
+
+def test_edited_hunk_is_reviewed_again(first_push, tmp_path):
+    state_path, diff = first_push
+    edited = diff.replace("+a2 line 3", "+a2 edited 3")
+
+    state, pending, chunks = _review(state_path, edited)
+    assert _pending_hunks(pending) == [("a.py", _body("a2")[0] + "\n")]
+    state.save("2222222bbbb", [gpt_review.ChunkReview(0, "Review of the edit", True)])
+
+    state, pending, _ = _review(state_path, edited)
+    assert pending == []
+    texts = [review["text"] for review, _ in state.carried_forward()]
+    assert texts == ["Review of a.py #0", "Review of b.py #2", "Review of the edit"]
+
+
+def test_failed_and_cut_off_reviews_are_not_recorded(tmp_path):
+    diff = make_diff({"a.py": [_body("a1"), _body("a2")], "b.py": [_body("b1")]})
+    state_path = tmp_path / "state.json"
+    state, _, chunks = _review(state_path, diff)
+    state.save("1111111aaaa", [
+        gpt_review.ChunkReview(0, "Fine", True),
+        gpt_review.ChunkReview(1, "❌ Failed", False),
+        gpt_review.ChunkReview(2, "Cut off", True, truncated=True),
+    ])
+
+    _, pending, _ = _review(state_path, diff)
+    assert _pending_hunks(pending) == [("a.py", _body("a2")[0] + "\n"), ("b.py", _body("b1")[0] + "\n")]
+
+
+def test_other_models_or_prompts_start_over(first_push):
+    state_path, diff = first_push
+    state, pending, _ = _review(state_path, diff, prompt_key="code=other-model")
+    assert len(_pending_hunks(pending)) == 3
+    assert state.carried_forward() == []
@@ -0,0 +1,105 @@
+import threading
+import types
+
+import gpt_review
+from conftest import make_diff
+
+
+class _Reviewer:
+    """The parts of ChunkReviewer that ChunkScheduler uses; every review succeeds instantly."""
+
+    def __init__(self, remaining_seconds: float, call_seconds: float = 1.0, retry_once=()):
+        self.remaining = remaining_seconds
+        self.latency = types.SimpleNamespace(seconds=call_seconds)
+        self.limiter = types.SimpleNamespace(tpm_limit=10 ** 9)
+        self.routes = {"code": types.SimpleNamespace(completion_budget=0)}
+        self.stop_event = threading.Event()
+        self.time_limit_reached = False
+        self.total_chunks = None
+        self.retry_once = set(retry_once)
+        self.reviewed = []
+        self.read_when_first_reviewed = None
+
+    def remaining_seconds(self) -> float:
+        return self.remaining
+
+    def stop_for_time_limit(self, message: str):
+        self.time_limit_reached = True
+        self.stop_event.set()
+
+    def review(self, index, chunk_text, attempt=0, route="code"):
+        self.reviewed.append((index, attempt))
+        if index in self.retry_once and attempt == 0:
+            return gpt_review.ChunkReview(index, "retry", succeeded=False, retry_delay=0.0)
+        return gpt_review.ChunkReview(index, f"review of {chunk_text}", succeeded=True)
+
+
+def _chunk(path, changed_lines=1):
+    return gpt_review.DiffChunk(path, 100, {path: changed_lines})
+
+
+def _run(reviewer, chunks, **kwargs):
+    read = []
+
+    def chunk_stream():
+        for chunk in chunks:
+            read.append(chunk)
+            if reviewer.reviewed and reviewer.read_when_first_reviewed is None:
+                reviewer.read_when_first_reviewed = len(read) - 1
+            yield chunk
+
+    scheduler = gpt_review.ChunkScheduler(reviewer, 1, **kwargs)
+    return scheduler, scheduler.run(chunk_stream())
+
+
+def test_reviews_in_diff_order_when_time_allows():
+    reviewer = _Reviewer(remaining_seconds=1000)
+    chunks = [_chunk(f"src/f{number}.js") for number in range(10)]
+    _, results = _run(reviewer, chunks, prefetch=2, lookahead=8)
+
+    assert [index for index, _ in reviewer.reviewed] == list(range(10))
+    assert [result.text for result in results] == [f"review of src/f{number}.js" for number in range(10)]
+    assert reviewer.total_chunks == 10
+    # The first call went out after only the prefetched chunks were read
+    assert reviewer.read_when_first_reviewed <= 3
+
+
+def test_prioritises_valuable_chunks_when_short_of_time(capsys):
+    reviewer = _Reviewer(remaining_seconds=5)
+    chunks = [_chunk(f"config/c{number}.json") for number in range(6)] + [_chunk("src/app.js", 40)]
+    _, results = _run(reviewer, chunks, prefetch=2, lookahead=8, expected_chunks=len(chunks))
+
+    assert reviewer.reviewed[0] == (6, 0)
+    assert "reviewing the highest-value of the next" in capsys.readouterr().out
+    assert all(result.succeeded for result in results)
+
+
+def test_expected_chunks_count_towards_the_deadline(capsys):
+    # Two chunks fit the deadline, but a diff expected to hold 20 does not
+    reviewer = _Reviewer(remaining_seconds=5)
+    chunks = [_chunk("config/c.json"), _chunk("src/app.js", 40), _chunk("config/d.json")]
+    _run(reviewer, chunks, prefetch=2, lookahead=8, expected_chunks=20)
+    assert "Predicted 20s for the remaining chunks" in capsys.readouterr().out
+
+    reviewer = _Reviewer(remaining_seconds=5)
+    _run(reviewer, chunks, prefetch=2, lookahead=8, expected_chunks=3)
+    assert [index for index, _ in reviewer.reviewed] == [0, 1, 2]
+    assert "Predicted" not in capsys.readouterr().out
+
+
+def test_requeues_transient_failures():
+    reviewer = _Reviewer(remaining_seconds=1000, retry_once={1})
+    _, results = _run(reviewer, [_chunk(f"f{number}.js") for number in range(3)])
+    assert (1, 1) in reviewer.reviewed
+    assert all(result.succeeded for result in results)
+
+
+def test_reviewable_chars_leave_out_filtered_files():
+    diff_filter = gpt_review.DiffFilter([], ["package-lock.json"], 100 * 1024, 500)
+    kept = make_diff({"src/app.js": [["+const a = 1;"]]})
+    lockfile = make_diff({"package-lock.json": [[f'+  "dep{number}": "1.0.0",' for number in range(5000)]]})
+    minified = make_diff({"dist/app.min.js": [["+" + "x" * 600]]})
+    diff = kept + lockfile + minified
+
+    assert diff_filter.reviewable_chars(diff.splitlines(keepends=True)) == len(kept)
+    assert diff_filter.skipped == []
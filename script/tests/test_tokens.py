@@ -0,0 +1,30 @@
+import gpt_review
+
+
+def test_tokens_are_attributed_to_the_line_they_start_on(byte_encoding):
+    # "ab" | "\n+" | "ab" | "\n": the "\n+" token starts on the first line
+    counts = gpt_review.get_line_token_counts(["ab\n", "+ab\n"], "test-model")
+    assert counts == [2, 2]
+
+
+def test_multibyte_characters_count_once(byte_encoding):
+    counts = gpt_review.get_line_token_counts(["é\n", "xé\n"], "test-model")
+    assert counts == [2, 3]
+
+
+def test_counts_sum_to_block_token_count(byte_encoding):
+    lines = ["diff --git a/é.py b/é.py\n", "@@ -1 +1 @@\n", "-abab\n", "+ab cd é\n", " \n", "+\n"]
+    counts = gpt_review.get_line_token_counts(lines, "test-model")
+    assert len(counts) == len(lines)
+    assert sum(counts) == len(byte_encoding.encode_ordinary("".join(lines)))
+
+
+def test_counts_are_per_block(byte_encoding, monkeypatch):
+    monkeypatch.setattr(gpt_review, "TOKENIZE_BLOCK_LINES", 1)
+    lines = ["ab\n", "+ab\n", "é\n"]
+    counts = gpt_review.get_line_token_counts(lines, "test-model")
+    assert counts == [len(byte_encoding.encode_ordinary(line)) for line in lines]
+
+
+def test_char_fallback(char_tokens):
+    assert gpt_review.get_line_token_counts(["x" * 40 + "\n", "\n"], "test-model") == [10, 1]
@@ -0,0 +1,43 @@
+import pytest
+
+import gpt_review
+
+
+def _hunk(*body):
+    return ["@@ -1,3 +1,3 @@\n"] + [line + "\n" for line in body]
+
+
+@pytest.mark.parametrize("hunk, language", [
+    (_hunk("-if (a) {", "+if (a)  {", " }"), "javascript"),
+    (_hunk("-  return  value;", "+  return value;"), "typescript"),
+    (_hunk("-a { color: red; margin: 0 }", "+a {", "+  color: red;", "+  margin: 0", "+}"), "css"),
+    (_hunk(' {', '-  "a": 1, "b": 2', '+  "a": 1,', '+  "b": 2', ' }'), "json"),
+    (_hunk(" # Title", "-Some text.  ", "+Some text."), "markdown"),
+    (_hunk(" def f():", "-    return 1   ", "+    return 1"), "python"),
+    (_hunk(" a:", "+", "   b: 1"), "yaml"),
+    (_hunk("-x = 1", "\\ No newline at end of file", "+x = 1"), "python"),
+])
+def test_whitespace_only(hunk, language):
+    assert gpt_review.is_whitespace_only(hunk, language)
+
+
+@pytest.mark.parametrize("hunk, language", [
+    # Moved code: same lines, different order
+    (_hunk("-a();", " b();", "+a();"), "javascript"),
+    (_hunk("-const s = 'a b';", "+const s = 'a  b';"), "javascript"),
+    (_hunk('-msg = "x y"', '+msg = "x  y"'), "other"),
+    (_hunk(" if x:", "-    y()", "+y()"), "python"),
+    (_hunk(" a:", "-  b: 1", "+    b: 1"), "yaml"),
+    (_hunk("-let a = 1;", "+let a = 2;"), "javascript"),
+    # Automatic semicolon insertion: `return` alone on a line returns undefined
+    (_hunk("-  return", "-    value;", "+  return value;"), "javascript"),
+    (_hunk("-const x = f(a, b);", "+const x = f(a,", "+    b);"), "typescript"),
+    # Indenting a markdown line turns it into a code block or nested list item
+    (_hunk(" - item", "-- child", "+  - child"), "markdown"),
+    (_hunk("-Some text.", "+    Some text."), "markdown"),
+    (_hunk(" <pre>", "-a  b", "+a b", " </pre>"), "html"),
+    # No changed lines at all
+    (_hunk(" a();", " b();"), "javascript"),
+])
+def test_not_whitespace_only(hunk, language):
+    assert not gpt_review.is_whitespace_only(hunk, language)